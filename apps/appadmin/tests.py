@@ -1,3 +1,86 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, override_settings
 
-# Create your tests here.
+from apps.appadmin.views import metrics as metrics_view
+from utils.metrics import METRICS_KEY, MetricsRegistry
+
+import threading
+from unittest import mock
+
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCAL_CACHES, METRICS_ENABLED=True, METRICS_AUTH_TOKEN='secret')
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry(flush_interval=3600)
+
+    def scrape(self, **headers):
+        with mock.patch('apps.appadmin.views.METRICS', self.registry):
+            return metrics_view(RequestFactory().get('/metrics', **headers))
+
+    def test_scrape_requires_bearer_token(self):
+        self.assertEqual(self.scrape().status_code, 401)
+        self.assertEqual(self.scrape()['WWW-Authenticate'], 'Bearer')
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Basic secret').status_code, 401)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        with override_settings(METRICS_AUTH_TOKEN=''), self.assertRaises(Http404):
+            self.scrape(HTTP_AUTHORIZATION='Bearer ')
+
+    def test_exposition(self):
+        for value in (0.03, 0.2, 20):
+            self.registry.observe('fetch_seconds', value, buckets=(0.05, 0.5), endpoint='directions')
+        self.registry.incr('requests_total', 2, view='map')
+        self.registry.incr('requests_total', view='map')
+
+        body = self.scrape(HTTP_AUTHORIZATION='Bearer secret').content.decode('utf-8')
+        self.assertEqual(body.splitlines(), [
+            '# TYPE fetch_seconds histogram',
+            'fetch_seconds_bucket{endpoint="directions",le="0.05"} 1',
+            'fetch_seconds_bucket{endpoint="directions",le="0.5"} 2',
+            'fetch_seconds_bucket{endpoint="directions",le="+Inf"} 3',
+            'fetch_seconds_count{endpoint="directions"} 3',
+            'fetch_seconds_sum{endpoint="directions"} 20.23',
+            '# TYPE requests_total counter',
+            'requests_total{view="map"} 3',
+        ])
+
+    def test_samples_do_not_wait_for_the_flush(self):
+        release = threading.Event()
+        redis = mock.Mock()
+        redis.pipeline.return_value.execute.side_effect = lambda: release.wait(5)
+        registry = MetricsRegistry(flush_interval=0)
+        registry._redis = redis
+
+        with mock.patch('utils.metrics.threading.Thread', wraps=threading.Thread) as thread:
+            registry.incr('requests_total')
+            # The flush is blocked on Redis, recording returns and starts no second flush
+            registry.incr('requests_total')
+            self.assertEqual(thread.call_count, 1)
+            release.set()
+        for started in threading.enumerate():
+            if started.name == 'metrics-flush':
+                started.join(5)
+        self.assertFalse(registry._flushing)
+        self.assertEqual(registry._pending, {'requests_total': 1})
+
+    def test_flush_keeps_deltas_after_redis_failure(self):
+        redis = mock.Mock()
+        pipeline = redis.pipeline.return_value
+        pipeline.execute.side_effect = [ConnectionError, None]
+        self.registry._redis = redis
+
+        self.registry.incr('requests_total', 2)
+        self.assertFalse(self.registry.flush())
+        self.registry.incr('requests_total', 3)
+        self.assertTrue(self.registry.flush())
+        self.assertEqual(
+            pipeline.hincrbyfloat.call_args_list[-1], mock.call(cache.make_key(METRICS_KEY), 'requests_total', 5)
+        )
+        # Nothing pending after a successful flush
+        pipeline.reset_mock()
+        self.assertTrue(self.registry.flush())
+        pipeline.execute.assert_not_called()
@@ -1,8 +1,14 @@
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import AuthenticationForm
+from django.conf import settings
 from django.urls import reverse
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
+from django.views.decorators.cache import never_cache
+
+from utils.metrics import METRICS
+
+import hmac
 
 
 def logout_user(request):
@@ -24,4 +30,18 @@ def login_user(request):
 				return render(request, 'appadmin/login.html', {'error_message': 'Your account has been disabled'})
 		else:
 			return render(request, 'appadmin/login.html', {'error_message': 'Invalid login', 'form' : form})
-	return render(request, 'appadmin/login.html', {'form' : form})
\ No newline at end of file
+	return render(request, 'appadmin/login.html', {'form' : form})
+
+
+@never_cache
+def metrics(request):
+	"""Prometheus scrape endpoint, `Authorization: Bearer <METRICS_AUTH_TOKEN>`"""
+	if not settings.METRICS_AUTH_TOKEN:
+		# Not exposed unless a token is configured
+		raise Http404
+	scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+	if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip(), settings.METRICS_AUTH_TOKEN):
+		response = HttpResponse(status=401)
+		response['WWW-Authenticate'] = 'Bearer'
+		return response
+	return HttpResponse(METRICS.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
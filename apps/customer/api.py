@@ -1,10 +1,98 @@
+from rest_framework import generics
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from .serializers import UserSerializer
+
+from utils.api import StandardResultsSetPagination, UserApiMixin
+
+from .models import Route, RouteStop, get_route_with_stops
+from .serializers import (
+    RouteSerializer, RouteStopInlineSerializer, RouteStopSerializer, UserSerializer
+)
+from .views.map_api import parse_bbox
 
 
 class CurrentUser(APIView):
 
     def get(self, *args, **kwargs):
         serializer = UserSerializer(self.request.user)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+
+class RouteListAPIView(UserApiMixin, generics.ListCreateAPIView):
+    """
+    Routes -> List and create, stops posted with a route are bulk imported
+    """
+    queryset = Route.objects.all()
+    serializer_class = RouteSerializer
+    pagination_class = StandardResultsSetPagination
+
+
+class RouteDetailAPIView(UserApiMixin, generics.RetrieveUpdateDestroyAPIView):
+    """
+    Route -> Retrieve returns the route with its ordered stops from one query
+    """
+    queryset = Route.objects.all()
+    serializer_class = RouteSerializer
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            route, stops = get_route_with_stops(kwargs['pk'], request.customer)
+        except Route.DoesNotExist:
+            self.handle_not_found_request('Route not found', 'route_not_found')
+        data = self.get_serializer(route).data
+        data['stops'] = RouteStopInlineSerializer(stops, many=True).data
+        return Response(data)
+
+
+class RouteStopListAPIView(UserApiMixin, generics.ListCreateAPIView):
+    """
+    Route Stops -> List and create
+
+    Query Parameters
+    -----------
+        route int
+            Only stops of this route
+        bbox str
+            `min_lng,min_lat,max_lng,max_lat`, only stops inside it
+        near str
+            `lat,lng`, only stops within `radius` miles, nearest first
+        radius float
+            Miles around `near`, default 10
+    """
+    queryset = RouteStop.objects.all()
+    serializer_class = RouteStopSerializer
+    pagination_class = StandardResultsSetPagination
+
+    def get_queryset(self, *args, **kwargs):
+        qs = super().get_queryset()
+        if self.request.query_params.get('route'):
+            qs = qs.filter(route_id=self.request.query_params['route'])
+        if self.request.query_params.get('bbox'):
+            try:
+                qs = qs.within_bbox(parse_bbox(self.request.query_params['bbox']))
+            except ValueError as e:
+                self.handle_invalid_request(str(e), 'invalid_bbox')
+        if self.request.query_params.get('near'):
+            try:
+                lat, lng = (float(part) for part in self.request.query_params['near'].split(','))
+                radius = float(self.request.query_params.get('radius', 10))
+            except ValueError:
+                self.handle_invalid_request('near must be `lat,lng` and radius a number', 'invalid_near')
+            qs = qs.within_radius(lat, lng, radius, order_by_distance=True)
+        return qs
+
+    def perform_create(self, serializer, **kwargs):
+        if serializer.validated_data['route'].customer_id != self.request.customer.pk:
+            self.handle_invalid_request('Route not found', 'route_not_found')
+        super().perform_create(serializer, **kwargs)
+
+
+class RouteStopDetailAPIView(UserApiMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = RouteStop.objects.all()
+    serializer_class = RouteStopSerializer
+
+    def perform_update(self, serializer, **kwargs):
+        route = serializer.validated_data.get('route')
+        if route is not None and route.customer_id != self.request.customer.pk:
+            self.handle_invalid_request('Route not found', 'route_not_found')
+        super().perform_update(serializer, **kwargs)
@@ -1,6 +1,12 @@
 from django.urls import path
-from .api import CurrentUser
+from .api import (
+    CurrentUser, RouteDetailAPIView, RouteListAPIView, RouteStopDetailAPIView, RouteStopListAPIView
+)
 
 urlpatterns = [
     path('current_user/', CurrentUser.as_view(), name="current_user"),
+    path('routes/', RouteListAPIView.as_view(), name="route_list"),
+    path('routes/<int:pk>/', RouteDetailAPIView.as_view(), name="route_detail"),
+    path('route_stops/', RouteStopListAPIView.as_view(), name="route_stop_list"),
+    path('route_stops/<int:pk>/', RouteStopDetailAPIView.as_view(), name="route_stop_detail"),
 ]
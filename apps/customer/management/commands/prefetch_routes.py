@@ -0,0 +1,28 @@
+"""
+Queue route prefetches for routes due to be viewed soon, run on a schedule
+(e.g. cron every 15 minutes) alongside `run_route_worker`.
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.customer.models import RouteStop
+from services.mapbox.tasks import enqueue_stops_prefetch
+
+from datetime import timedelta
+
+
+class Command(BaseCommand):
+    help = 'Queue route.prefetch tasks for upcoming routes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24, help='Routes scheduled within this many hours')
+
+    def get_route_paths(self, hours: float):
+        now = timezone.now()
+        stops = RouteStop.objects.filter(route__scheduled_on__range=(now, now + timedelta(hours=hours)))
+        return [route_path for _, route_path in stops.iter_route_paths() if len(route_path) > 1]
+
+    def handle(self, *args, **kwargs):
+        route_paths = self.get_route_paths(kwargs['hours'])
+        queued = sum(1 for route_path in route_paths if enqueue_stops_prefetch(route_path))
+        self.stdout.write(f'Queued {queued}/{len(route_paths)} route prefetches\n')
@@ -0,0 +1,19 @@
+"""
+Re-geocode stored addresses whose match confidence is below
+`MAPBOX_GEOCODE_MIN_CONFIDENCE`, run on a schedule or after data fixes.
+"""
+from django.core.management.base import BaseCommand
+
+from services.mapbox.geocoding import regeocode_low_confidence
+
+
+class Command(BaseCommand):
+    help = 'Re-geocode low confidence geocoding results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='Addresses per run')
+        parser.add_argument('--min-confidence', type=float, default=None, help='Defaults to MAPBOX_GEOCODE_MIN_CONFIDENCE')
+
+    def handle(self, *args, **kwargs):
+        refreshed = regeocode_low_confidence(min_confidence=kwargs['min_confidence'], limit=kwargs['limit'])
+        self.stdout.write(f'Re-geocoded {refreshed} addresses\n')
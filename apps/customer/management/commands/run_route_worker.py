@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from services.mapbox import get_client
+from services.mapbox.tasks import TASK_HANDLERS
+from utils.queue import QueueConnection, build_task_callback
+
+
+class Command(BaseCommand):
+    help = 'Consume routing tasks (route.prefetch, route.stops_prefetch, route.vrp) from the routing queue'
+
+    def handle(self, *args, **kwargs):
+        queue = settings.RABBITMQ_ROUTING_QUEUE
+        # Background work can wait for quota, web requests only briefly
+        get_client().rate_limit_wait = settings.MAPBOX_RATE_LIMIT_WORKER_WAIT
+        self.stdout.write(f'Consuming routing tasks from queue: `{queue}`\n')
+        connection = QueueConnection(queues=[queue])
+        connection.consume(callback=build_task_callback(TASK_HANDLERS), queue=queue)
@@ -0,0 +1,75 @@
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Route',
+            fields=[
+                ('id', models.BigAutoField(db_column='id', primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(db_index=True, default=uuid.uuid4, editable=False)),
+                ('created_on', models.DateTimeField(auto_now_add=True, db_column='created_on')),
+                ('updated_on', models.DateTimeField(auto_now=True, db_column='updated_on')),
+                ('name', models.CharField(max_length=200)),
+                ('scheduled_on', models.DateTimeField(blank=True, null=True)),
+                ('meta', django.contrib.postgres.fields.jsonb.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('created_by', models.ForeignKey(db_column='created_by', editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='route_created_by', to=settings.AUTH_USER_MODEL)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='routes', to='customer.Customer')),
+                ('updated_by', models.ForeignKey(db_column='updated_by', editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='route_updated_by', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Route',
+                'verbose_name_plural': 'Routes',
+                'db_table': 'cust_route',
+                'ordering': ('pk',),
+            },
+        ),
+        migrations.CreateModel(
+            name='RouteStop',
+            fields=[
+                ('id', models.BigAutoField(db_column='id', primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(db_index=True, default=uuid.uuid4, editable=False)),
+                ('created_on', models.DateTimeField(auto_now_add=True, db_column='created_on')),
+                ('updated_on', models.DateTimeField(auto_now=True, db_column='updated_on')),
+                ('sequence', models.PositiveIntegerField(default=0)),
+                ('display', models.CharField(blank=True, max_length=255, null=True)),
+                ('marker', models.CharField(blank=True, max_length=50, null=True)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('geohash', models.CharField(editable=False, max_length=12)),
+                ('meta', django.contrib.postgres.fields.jsonb.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('created_by', models.ForeignKey(db_column='created_by', editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='routestop_created_by', to=settings.AUTH_USER_MODEL)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='route_stops', to='customer.Customer')),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stops', to='customer.Route')),
+                ('updated_by', models.ForeignKey(db_column='updated_by', editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='routestop_updated_by', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Route Stop',
+                'verbose_name_plural': 'Route Stops',
+                'db_table': 'cust_route_stop',
+                'ordering': ('route', 'sequence'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='route',
+            index=models.Index(fields=['customer', 'scheduled_on'], name='cust_route_cust_sched_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='routestop',
+            index=models.Index(fields=['route', 'sequence'], name='cust_rstop_route_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='routestop',
+            index=models.Index(fields=['customer', 'geohash'], name='cust_rstop_cust_geohash_idx'),
+        ),
+    ]
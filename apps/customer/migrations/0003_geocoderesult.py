@@ -0,0 +1,46 @@
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0002_route_routestop'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeResult',
+            fields=[
+                ('id', models.BigAutoField(db_column='id', primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(db_index=True, default=uuid.uuid4, editable=False)),
+                ('created_on', models.DateTimeField(auto_now_add=True, db_column='created_on')),
+                ('updated_on', models.DateTimeField(auto_now=True, db_column='updated_on')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('query', models.CharField(max_length=500)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('place_name', models.CharField(blank=True, max_length=500, null=True)),
+                ('confidence', models.FloatField(default=0)),
+                ('accuracy', models.CharField(blank=True, max_length=50, null=True)),
+                ('provider', models.CharField(default='mapbox', max_length=20)),
+                ('meta', django.contrib.postgres.fields.jsonb.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('created_by', models.ForeignKey(db_column='created_by', editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='geocoderesult_created_by', to=settings.AUTH_USER_MODEL)),
+                ('updated_by', models.ForeignKey(db_column='updated_by', editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='geocoderesult_updated_by', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Geocode Result',
+                'verbose_name_plural': 'Geocode Results',
+                'db_table': 'cust_geocode_result',
+                'ordering': ('pk',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='geocoderesult',
+            index=models.Index(fields=['confidence'], name='cust_geocode_confidence_idx'),
+        ),
+    ]
@@ -3,7 +3,7 @@ from django.contrib.postgres.fields import JSONField
 from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
@@ -12,12 +12,21 @@ from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
 from services.customer import CustomerIntegration
+from services.mapbox.geocoding import geocode_batch
+from services.mapbox.tasks import enqueue_route_stops_prefetch
+from services.tiles import add_stops_to_cluster_index, invalidate_stop_tiles
+from utils.geometry import geohash_cover, geohash_encode, geohash_prefix_range
+from utils.models import Common, GeoQuerySetMixin
 
 
 CUSTOMER_INTEGRATION_OPTIONS = (
 	("STRIPE", "Stripe"),
 )
 
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterator, List, Tuple
 from uuid import uuid4
 
 
@@ -354,4 +363,237 @@ class CustomerUsage(models.Model):
 		ordering = ('pk',)
 
 	def __str__(self):
-		return f"{str(self.observation_datetime)}: {str(self.units)} ({str(self.unit_type)})"
\ No newline at end of file
+		return f"{str(self.observation_datetime)}: {str(self.units)} ({str(self.unit_type)})"
+
+
+# Routes
+class Route(Common):
+	customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='routes')
+	name = models.CharField(max_length=200)
+	scheduled_on = models.DateTimeField(blank=True, null=True) # Route due to be driven / viewed
+	meta = JSONField(encoder=DjangoJSONEncoder, blank=True, null=True)
+
+	class Meta:
+		db_table = 'cust_route'
+		verbose_name = 'Route'
+		verbose_name_plural = 'Routes'
+		ordering = ('pk',)
+		indexes = [
+			models.Index(fields=['customer', 'scheduled_on'], name='cust_route_cust_sched_idx'),
+		]
+
+	def get_route_path(self) -> List[Dict]:
+		return list(self.stops.order_by('sequence').route_path())
+
+	def __str__(self):
+		return f"{str(self.name)} ({str(self.customer_id)})"
+
+
+class RouteStopQuerySet(GeoQuerySetMixin, models.QuerySet):
+	ROUTE_PATH_FIELDS = ('display', 'longitude', 'latitude', 'marker')
+
+	def bbox_q(self, bbox: Tuple[float, float, float, float], max_cells: int = 16) -> Q:
+		"""
+		The geohash prefixes covering the bbox turn into range scans on
+		(customer, geohash), the lat/lng range then trims the cell edges
+		"""
+		min_lng, min_lat, max_lng, max_lat = bbox
+		if min_lng <= max_lng:
+			boxes = [bbox]
+		else:
+			# Crosses the antimeridian, cover each side
+			boxes = [(min_lng, min_lat, 180., max_lat), (-180., min_lat, max_lng, max_lat)]
+		prefixes = [prefix for box in boxes for prefix in geohash_cover(box, max_cells=max_cells)]
+		return self.geohash_q(prefixes) & super().bbox_q(bbox)
+
+	def geohash_q(self, prefixes: List[str]) -> Q:
+		"""
+		Stops under any of the geohash prefixes, as range scans on (customer, geohash)
+		"""
+		if not prefixes:
+			return Q(pk__in=[])
+		cells = Q()
+		for prefix in prefixes:
+			low, high = geohash_prefix_range(prefix)
+			cell = Q(geohash__gte=low)
+			if high is not None:
+				cell &= Q(geohash__lt=high)
+			cells |= cell
+		return cells
+
+	def within_geohash_cells(self, prefixes: List[str]):
+		return self.filter(self.geohash_q(prefixes))
+
+	def route_path(self):
+		# Same dict shape the map views and mapbox service consume
+		return self.values(*self.ROUTE_PATH_FIELDS)
+
+	def iter_route_paths(self, extra_fields: Tuple[str, ...] = ()) -> Iterator[Tuple[int, List[Dict]]]:
+		"""
+		(route id, route path) per route from a single streamed query,
+		`extra_fields` (columns or annotations) are added to every stop
+		"""
+		fields = self.ROUTE_PATH_FIELDS + tuple(extra_fields)
+		rows = self.order_by('route_id', 'sequence').values('route_id', *fields).iterator()
+		for route_id, group in groupby(rows, key=itemgetter('route_id')):
+			yield route_id, [{field: row[field] for field in fields} for row in group]
+
+	def bulk_import(self, route: Route, stops: List[Dict], batch_size: int = 1000) -> int:
+		"""
+		Insert stops for a route in batches, `bulk_create` skips `save()` and
+		signals so the geohash and cache invalidation are handled here once.
+		Stops without coordinates are geocoded from their `display` address,
+		raises ValueError when an address has no match
+		"""
+		stops = geocode_stops(stops)
+		objs = []
+		added = []
+		created = 0
+		for sequence, stop in enumerate(stops):
+			latitude, longitude = float(stop['latitude']), float(stop['longitude'])
+			objs.append(self.model(
+				customer_id=route.customer_id,
+				route=route,
+				sequence=stop.get('sequence', sequence),
+				display=stop.get('display'),
+				marker=stop.get('marker'),
+				latitude=latitude,
+				longitude=longitude,
+				geohash=geohash_encode(latitude, longitude),
+			))
+			if len(objs) >= batch_size:
+				self.bulk_create(objs, batch_size=batch_size)
+				created += len(objs)
+				added.extend(obj.cluster_point() for obj in objs)
+				objs = []
+		if objs:
+			self.bulk_create(objs, batch_size=batch_size)
+			created += len(objs)
+			added.extend(obj.cluster_point() for obj in objs)
+		transaction.on_commit(partial(route_stops_changed, route.customer_id, route.pk, added))
+		return created
+
+
+class RouteStop(Common):
+	# Customer is denormalized from the route so tenant scoped spatial queries
+	# stay on one table and one index
+	customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='route_stops')
+	route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='stops')
+	sequence = models.PositiveIntegerField(default=0)
+	display = models.CharField(max_length=255, blank=True, null=True)
+	marker = models.CharField(max_length=50, blank=True, null=True)
+	latitude = models.FloatField()
+	longitude = models.FloatField()
+	geohash = models.CharField(max_length=12, editable=False)
+	meta = JSONField(encoder=DjangoJSONEncoder, blank=True, null=True)
+
+	objects = RouteStopQuerySet.as_manager()
+
+	class Meta:
+		db_table = 'cust_route_stop'
+		verbose_name = 'Route Stop'
+		verbose_name_plural = 'Route Stops'
+		ordering = ('route', 'sequence')
+		indexes = [
+			models.Index(fields=['route', 'sequence'], name='cust_rstop_route_seq_idx'),
+			models.Index(fields=['customer', 'geohash'], name='cust_rstop_cust_geohash_idx'),
+		]
+
+	def save(self, *args, **kwargs):
+		self.geohash = geohash_encode(float(self.latitude), float(self.longitude))
+		super().save(*args, **kwargs)
+
+	def cluster_point(self) -> Dict:
+		# Same shape the cluster view loads, `id` is None before a bulk insert on some databases
+		return {'id': self.pk, **{field: getattr(self, field) for field in RouteStopQuerySet.ROUTE_PATH_FIELDS}}
+
+	def __str__(self):
+		return f"{str(self.route_id)} #{str(self.sequence)} - {str(self.display)}"
+
+
+def geocode_stops(stops: List[Dict]) -> List[Dict]:
+	"""
+	Fill in missing latitude / longitude from `display`, one batch lookup
+	"""
+	missing = [
+		index for index, stop in enumerate(stops)
+		if stop.get('latitude') is None or stop.get('longitude') is None
+	]
+	if not missing:
+		return stops
+	matches = geocode_batch([stops[index].get('display') or '' for index in missing])
+	unmatched = [
+		str(stops[index].get('display')) for index, match in zip(missing, matches)
+		if match is None or match.latitude is None
+	]
+	if unmatched:
+		raise ValueError(f"Could not geocode: {'; '.join(unmatched)}")
+	stops = list(stops)
+	for index, match in zip(missing, matches):
+		stops[index] = dict(stops[index], latitude=match.latitude, longitude=match.longitude)
+	return stops
+
+
+def get_route_with_stops(route_id, customer) -> Tuple[Route, List[RouteStop]]:
+	"""
+	Route and its ordered stops in one query, raises Route.DoesNotExist
+	"""
+	stops = list(
+		RouteStop.objects.select_related('route')
+		.filter(route_id=route_id, customer=customer)
+		.order_by('sequence')
+	)
+	if stops:
+		return stops[0].route, stops
+	return Route.objects.get(pk=route_id, customer=customer), []
+
+
+def route_stops_changed(customer_id, route_id, added: List[Dict] = None):
+	previous_version = invalidate_stop_tiles(customer_id)
+	if added:
+		# New stops go into this process' cluster index without a rebuild
+		add_stops_to_cluster_index(customer_id, added, previous_version)
+	# Debounced per route, the worker loads the stops so a burst of edits
+	# warms the route once for its final stops
+	enqueue_route_stops_prefetch(route_id)
+
+
+@receiver(post_save, sender=RouteStop)
+def route_stop_post_save_handler(sender, instance, created=False, **kwargs):
+	added = [instance.cluster_point()] if created else None
+	transaction.on_commit(partial(route_stops_changed, instance.customer_id, instance.route_id, added))
+
+
+@receiver(post_delete, sender=RouteStop)
+def route_stop_post_delete_handler(sender, instance, **kwargs):
+	transaction.on_commit(partial(route_stops_changed, instance.customer_id, instance.route_id))
+
+
+# Geocoding
+class GeocodeResult(Common):
+	# Shared across customers, an address resolves the same for everyone
+	key = models.CharField(max_length=255, unique=True) # Normalized address
+	query = models.CharField(max_length=500)
+	latitude = models.FloatField(blank=True, null=True) # Null when nothing matched
+	longitude = models.FloatField(blank=True, null=True)
+	place_name = models.CharField(max_length=500, blank=True, null=True)
+	confidence = models.FloatField(default=0) # Provider relevance 0 - 1
+	accuracy = models.CharField(max_length=50, blank=True, null=True) # e.g. rooftop, street, place
+	provider = models.CharField(max_length=20, default='mapbox')
+	meta = JSONField(encoder=DjangoJSONEncoder, blank=True, null=True)
+
+	class Meta:
+		db_table = 'cust_geocode_result'
+		verbose_name = 'Geocode Result'
+		verbose_name_plural = 'Geocode Results'
+		ordering = ('pk',)
+		indexes = [
+			models.Index(fields=['confidence'], name='cust_geocode_confidence_idx'),
+		]
+
+	@property
+	def matched(self) -> bool:
+		return self.latitude is not None and self.longitude is not None
+
+	def __str__(self):
+		return f"{str(self.query)} ({str(self.confidence)})"
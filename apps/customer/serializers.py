@@ -2,6 +2,8 @@ from django.contrib.auth import get_user_model
 
 from rest_framework import serializers
 
+from .models import Route, RouteStop, geocode_stops
+
 User = get_user_model()
 
 
@@ -9,4 +11,58 @@ class UserSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = User
-        fields = ('email',)
\ No newline at end of file
+        fields = ('email',)
+
+class RouteStopSerializer(serializers.ModelSerializer):
+    # Miles, only present on radius searches
+    distance = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = RouteStop
+        fields = (
+            'id', 'uuid', 'route', 'sequence', 'display', 'marker', 'latitude', 'longitude', 'geohash',
+            'distance'
+        )
+        read_only_fields = ('id', 'uuid', 'geohash')
+
+
+class RouteStopInlineSerializer(serializers.ModelSerializer):
+    # Stops without coordinates are geocoded from `display` on import
+    latitude = serializers.FloatField(required=False, allow_null=True)
+    longitude = serializers.FloatField(required=False, allow_null=True)
+
+    class Meta:
+        model = RouteStop
+        fields = ('id', 'sequence', 'display', 'marker', 'latitude', 'longitude')
+        read_only_fields = ('id',)
+
+    def validate(self, attrs):
+        if (attrs.get('latitude') is None or attrs.get('longitude') is None) and not attrs.get('display'):
+            raise serializers.ValidationError('latitude and longitude or a display address is required')
+        return attrs
+
+
+class RouteSerializer(serializers.ModelSerializer):
+    # Optional stops on create, imported in batches
+    stops = RouteStopInlineSerializer(many=True, required=False, write_only=True)
+
+    class Meta:
+        model = Route
+        fields = ('id', 'uuid', 'name', 'scheduled_on', 'meta', 'stops')
+        read_only_fields = ('id', 'uuid')
+
+    def create(self, validated_data):
+        stops = validated_data.pop('stops', [])
+        try:
+            # Geocode before the route exists so a bad address leaves nothing behind
+            stops = geocode_stops(stops)
+        except ValueError as e:
+            raise serializers.ValidationError({'stops': str(e)})
+        route = super().create(validated_data)
+        if stops:
+            RouteStop.objects.bulk_import(route, stops)
+        return route
+
+    def update(self, instance, validated_data):
+        validated_data.pop('stops', None)
+        return super().update(instance, validated_data)
@@ -1,3 +1,1875 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.http import StreamingHttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
 
-# Create your tests here.
+from apps.customer.models import Customer, Route, RouteStop, RouteStopQuerySet, get_route_with_stops
+from apps.customer.views.map_api import MapClusterView, MapFeaturesGeoJSONView, StopVectorTileView, accepts_encoding
+from apps.customer.views.map_view import RouteDataView, get_route_path_json
+from services.mapbox import geocoding, tasks
+from services.mapbox.basemap import STALE_MAX_AGE, TILE_PATH_RE, TileLRUIndex, TileProxy
+from services.mapbox.batch import get_directions_batch
+from services.mapbox.cache import ROUTE_CACHE, LocalLRUCache, RouteCache, pack_route, unpack_route
+from services.mapbox.codec import RouteView, decode_route, decode_varints, encode_route, encode_varints
+from services.mapbox.client import MapboxClient, MapboxError, MapboxRateLimited
+from services.mapbox.legs import get_leg_directions, split_legs, split_route_path, stitch_directions
+from services.mapbox.matrix import MatrixResult, estimate_matrix, get_matrix
+from services.routing.graph import RoadGraph
+from services.routing.optimizer import optimize_stop_order
+from services.routing.vrp import build_vrp_problem, get_vrp_result, reduce_vehicles, run_vrp_task, solve_vrp
+from services.tiles import clusters
+from services.tiles.vector import build_stop_tile, get_stop_tile, get_tile_version, invalidate_stop_tiles
+from utils.cache import single_flight
+from utils.cluster import ClusterIndex
+from utils.geometry import (
+    EARTH_RADIUS_MILES, SpatialIndex, decode_polyline, encode_polyline, encode_polyline_deltas, geohash_cover,
+    geohash_encode, geohash_prefix_range, lat_lng_dist, lat_lng_dist_matrix, lat_lng_dist_one_to_many,
+    lat_lng_dist_paired, polyline_deltas, simplify_coordinates, simplify_polyline
+)
+from utils.mvt import DEFAULT_BUFFER, encode_tile, lng_lat_to_tile, tile_bounds
+from utils.ratelimit import TokenBucket
+from utils.storage_backends import TileCacheStorage
+
+import copy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import permutations
+import io
+import json
+import numpy as np
+import struct
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
+import uuid
+
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class StubMapboxHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET with the next queued (status, headers, body, delay)
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            status, headers, body, delay = server.responses.pop(0) if server.responses else (200, {}, {}, 0)
+        if delay:
+            time.sleep(delay)
+        payload = json.dumps(body).encode('utf-8')
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client timed out and hung up
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@override_settings(CACHES=LOCAL_CACHES, MAPBOX_RATE_LIMIT_ENABLED=False, METRICS_ENABLED=False)
+class MapboxClientTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubMapboxHandler)
+        cls.server.daemon_threads = True
+        cls.server.lock = threading.Lock()
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.responses = []
+        self.server.paths = []
+
+    def mapbox_client(self, **kwargs) -> MapboxClient:
+        options = dict(
+            access_token='token', base_url=f"http://127.0.0.1:{self.server.server_port}",
+            connect_timeout=1, read_timeout=1, max_retries=2, backoff_factor=0, backoff_max=5,
+        )
+        options.update(kwargs)
+        client = MapboxClient(**options)
+        self.addCleanup(client.close)
+        return client
+
+    def queue(self, status: int, body=None, headers: dict = None, delay: float = 0):
+        self.server.responses.append((status, headers or {}, body if body is not None else {}, delay))
+
+    def test_success(self):
+        self.queue(200, {'code': 'Ok'})
+        response = self.mapbox_client().directions('-97.1,32.7;-97.2,32.8', overview='full')
+        self.assertEqual(response, {'code': 'Ok'})
+        self.assertEqual(len(self.server.paths), 1)
+        self.assertTrue(self.server.paths[0].startswith('/directions/v5/mapbox/driving/'))
+        self.assertIn('access_token=token', self.server.paths[0])
+
+    def test_retries_server_errors(self):
+        self.queue(503)
+        self.queue(502)
+        self.queue(200, {'code': 'Ok'})
+        self.assertEqual(self.mapbox_client().get_json('directions/v5/test'), {'code': 'Ok'})
+        self.assertEqual(len(self.server.paths), 3)
+
+    def test_retry_budget_exhausted(self):
+        for _ in range(3):
+            self.queue(500)
+        with self.assertRaises(MapboxError) as raised:
+            self.mapbox_client(max_retries=2).get_json('directions/v5/test')
+        self.assertEqual(raised.exception.status_code, 500)
+        self.assertEqual(len(self.server.paths), 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.queue(422, {'code': 'InvalidInput'})
+        with self.assertRaises(MapboxError) as raised:
+            self.mapbox_client().get_json('directions/v5/test')
+        self.assertEqual(raised.exception.status_code, 422)
+        self.assertIn('InvalidInput', raised.exception.response_text)
+        self.assertEqual(len(self.server.paths), 1)
+
+    def test_retry_after_is_honored(self):
+        self.queue(429, headers={'Retry-After': '0.3'})
+        self.queue(200, {'code': 'Ok'})
+        start = time.monotonic()
+        self.mapbox_client().get_json('directions/v5/test')
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(len(self.server.paths), 2)
+
+    def test_retry_after_is_capped(self):
+        self.queue(429, headers={'Retry-After': '3600'})
+        self.queue(200, {'code': 'Ok'})
+        start = time.monotonic()
+        self.mapbox_client(backoff_max=0.2).get_json('directions/v5/test')
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_read_timeout(self):
+        self.queue(200, delay=1)
+        self.queue(200, delay=1)
+        with self.assertRaises(MapboxError) as raised:
+            self.mapbox_client(read_timeout=0.2, max_retries=1).get_json('directions/v5/test')
+        self.assertIsNone(raised.exception.status_code)
+        self.assertEqual(len(self.server.paths), 2)
+
+    def test_timeout_then_success(self):
+        self.queue(200, delay=1)
+        self.queue(200, {'code': 'Ok'})
+        self.assertEqual(self.mapbox_client(read_timeout=0.2).get_json('directions/v5/test'), {'code': 'Ok'})
+
+    def test_exhausted_quota_raises_rate_limited(self):
+        cache.clear()
+        with self.settings(MAPBOX_RATE_LIMIT_ENABLED=True, MAPBOX_RATE_LIMITS_PER_MINUTE={'directions': 2}):
+            client = self.mapbox_client(rate_limit_wait=0)
+        self.queue(200, {'code': 'Ok'})
+        self.queue(200, {'code': 'Ok'})
+        with mock.patch('utils.ratelimit.time', return_value=6000.):
+            client.get_json('directions/v5/test')
+            client.get_json('directions/v5/test')
+            with self.assertRaises(MapboxRateLimited) as raised:
+                client.get_json('directions/v5/test')
+            # Other APIs have their own quota
+            client.get_json('geocoding/v5/test')
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual(len(self.server.paths), 3)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class TokenBucketTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_window_counter_refuses_until_the_next_minute(self):
+        bucket = TokenBucket('test', rate_per_minute=3)
+        with mock.patch('utils.ratelimit.time', return_value=6015.):
+            self.assertEqual([bucket.acquire() for _ in range(3)], [(True, 0.)] * 3)
+            self.assertEqual(bucket.acquire(), (False, 45.))
+        with mock.patch('utils.ratelimit.time', return_value=6059.5):
+            self.assertEqual(bucket.acquire(), (False, .5))
+        with mock.patch('utils.ratelimit.time', return_value=6060.):
+            self.assertEqual(bucket.acquire(2), (True, 0.))
+            self.assertEqual(bucket.acquire(2), (False, 60.))
+
+    def test_wait_gives_up_when_tokens_come_too_late(self):
+        bucket = TokenBucket('test', rate_per_minute=60)
+        with mock.patch.object(bucket, 'acquire', side_effect=[(False, .05), (True, 0.)]) as acquire:
+            self.assertTrue(bucket.wait(1))
+        self.assertEqual(acquire.call_count, 2)
+        with mock.patch.object(bucket, 'acquire', return_value=(False, 30.)), \
+                mock.patch('utils.ratelimit.sleep') as sleep:
+            self.assertFalse(bucket.wait(1))
+        sleep.assert_not_called()
+
+    def test_fails_open_when_the_cache_is_down(self):
+        bucket = TokenBucket('test', rate_per_minute=1)
+        with mock.patch('utils.ratelimit.cache.add', side_effect=ConnectionError):
+            self.assertEqual(bucket.acquire(), (True, 0.))
+
+
+@skipUnless(settings.REDIS_CONN_STR, 'needs REDIS_CONN_STR')
+class RedisTokenBucketTests(SimpleTestCase):
+    """
+    Runs the Lua token bucket against the configured Redis
+    """
+
+    def setUp(self):
+        self.bucket = TokenBucket(f"test:{uuid.uuid4().hex}", rate_per_minute=60, burst=3)
+        self.addCleanup(cache.delete, f"token_bucket:{self.bucket.name}")
+        if not self.bucket._redis_script():
+            self.skipTest('default cache is not Redis')
+
+    def test_drained_bucket_refuses_with_refill_time(self):
+        self.assertEqual([self.bucket.acquire()[0] for _ in range(3)], [True] * 3)
+        allowed, wait = self.bucket.acquire()
+        self.assertFalse(allowed)
+        self.assertTrue(0.9 < wait <= 1., wait)
+        allowed, wait = self.bucket.acquire(2)
+        self.assertFalse(allowed)
+        self.assertTrue(1.9 < wait <= 2., wait)
+        # Refills at one token a second
+        time.sleep(1.1)
+        self.assertTrue(self.bucket.acquire()[0])
+
+
+class DirectionsBatchTests(SimpleTestCase):
+
+    def test_malformed_route_fails_alone(self):
+        good = [{'latitude': 32.7, 'longitude': -97.1}, {'latitude': 32.8, 'longitude': -97.2}]
+        bad = [{'latitude': 'north', 'longitude': -97.1}, {'longitude': -97.2}]
+        with mock.patch('services.mapbox.batch.get_directions', return_value={'code': 'Ok'}) as get_directions:
+            results = get_directions_batch([good, bad, good], max_workers=2)
+        self.assertEqual(get_directions.call_count, 1)
+        self.assertEqual([result.error is None for result in results], [True, False, True])
+        self.assertEqual(results[0].route, {'code': 'Ok'})
+        self.assertEqual(results[1].route, {})
+        # The batch pool bounds concurrency, routes do not start pools of their own
+        self.assertEqual(get_directions.call_args[1]['max_workers'], 1)
+
+
+class StubMatrixClient(object):
+    """
+    Matrix API stand in, durations and distances derived from crow flies
+    distance so any tiling of a matrix must stitch to the same values
+    """
+
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.calls = []
+
+    @staticmethod
+    def cells(origins, destinations):
+        distances = np.round(lat_lng_dist_matrix(origins, destinations) * 1609.344, 1)
+        return distances / 20, distances
+
+    def matrix(self, coordinates: str, profile: str = 'driving', **params):
+        points = [tuple(map(float, point.split(',')))[::-1] for point in coordinates.split(';')]
+        sources = [points[int(index)] for index in params['sources'].split(';')]
+        destinations = [points[int(index)] for index in params['destinations'].split(';')]
+        self.calls.append((sources, destinations))
+        if self.error is not None:
+            raise self.error
+        durations, distances = self.cells(sources, destinations)
+        return {'code': 'Ok', 'durations': durations.tolist(), 'distances': distances.tolist()}
+
+
+@override_settings(CACHES=LOCAL_CACHES, MAPBOX_MATRIX_MAX_COORDINATES=6, MAPBOX_BATCH_MAX_WORKERS=2)
+class MatrixTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        rng = np.random.default_rng(0)
+        self.points = np.round(np.column_stack((rng.uniform(32, 33, 8), rng.uniform(-98, -97, 8))), 5).tolist()
+
+    def get_matrix(self, client, *args, **kwargs):
+        with mock.patch('services.mapbox.matrix.get_client', return_value=client):
+            return get_matrix(*args, **kwargs)
+
+    def test_tiles_are_stitched(self):
+        client = StubMatrixClient()
+        destinations = self.points[:7]
+        result = self.get_matrix(client, self.points, destinations)
+        durations, distances = StubMatrixClient.cells(self.points, destinations)
+        np.testing.assert_allclose(result.durations, durations)
+        np.testing.assert_allclose(result.distances, distances)
+        self.assertFalse(result.estimated.any())
+        # 3 x 3 tiles within the 6 coordinate limit, 8 x 7 needs 3 x 3 of them
+        self.assertEqual(len(client.calls), 9)
+        self.assertTrue(all(len(sources) + len(targets) <= 6 for sources, targets in client.calls))
+
+    def test_cache_is_read_per_tile(self):
+        with mock.patch('services.mapbox.matrix.cache', wraps=cache) as matrix_cache:
+            self.get_matrix(StubMatrixClient(), self.points, self.points[:7])
+        get_many = matrix_cache.get_many
+        # One read per 3 x 3 tile, never one for the whole matrix
+        self.assertEqual(get_many.call_count, 9)
+        self.assertTrue(all(len(call[0][0]) <= 9 for call in get_many.call_args_list))
+
+    def test_cached_cells_are_not_refetched(self):
+        self.get_matrix(StubMatrixClient(), self.points[:4], self.points[:4])
+        client = StubMatrixClient()
+        result = self.get_matrix(client, self.points[:4], self.points[:5])
+        # One call per origin tile, each asking only for the new column
+        self.assertEqual([targets for _, targets in client.calls], [[tuple(self.points[4])]] * 2)
+        np.testing.assert_allclose(result.distances, StubMatrixClient.cells(self.points[:4], self.points[:5])[1])
+
+        client = StubMatrixClient()
+        self.get_matrix(client, self.points[:4], self.points[:5])
+        self.assertEqual(client.calls, [])
+
+    def test_upstream_error_is_estimated(self):
+        client = StubMatrixClient(error=MapboxError('Mapbox responded 503', status_code=503))
+        self.get_matrix(StubMatrixClient(), self.points[:2], self.points[:2])
+        result = self.get_matrix(client, self.points[:4], self.points[:2])
+        durations, distances = estimate_matrix(np.array(self.points[2:4]), np.array(self.points[:2]))
+        self.assertEqual(result.estimated.tolist(), [[False, False]] * 2 + [[True, True]] * 2)
+        np.testing.assert_allclose(result.durations[2:], durations)
+        np.testing.assert_allclose(result.distances[2:], distances)
+        # Estimates are not cached, the next call asks upstream again
+        client = StubMatrixClient()
+        self.assertFalse(self.get_matrix(client, self.points[:4], self.points[:2]).estimated.any())
+        self.assertEqual(
+            sorted(source for sources, _ in client.calls for source in sources), sorted(map(tuple, self.points[2:4]))
+        )
+
+
+class GeocodingTests(SimpleTestCase):
+    FEATURE = {'center': [-99.33, 38.88], 'place_name': 'Hays, Kansas 67601', 'relevance': 1, 'place_type': ['place']}
+
+    def test_cache_outage_falls_back_to_the_table_and_mapbox(self):
+        client = mock.Mock()
+        client.geocode.return_value = {'features': [self.FEATURE]}
+        model = mock.Mock()
+        model.objects.filter.return_value = []
+        with mock.patch.object(geocoding, 'cache') as redis, \
+                mock.patch.object(geocoding, 'get_client', return_value=client), \
+                mock.patch.object(geocoding, '_geocode_model', return_value=model):
+            redis.get_many.side_effect = ConnectionError('redis down')
+            redis.set.side_effect = ConnectionError('redis down')
+            matches = geocoding.geocode_batch(['Hays, KS  67601', 'hays ks 67601'])
+
+        self.assertEqual([(match.latitude, match.longitude) for match in matches], [(38.88, -99.33)] * 2)
+        self.assertEqual(client.geocode.call_count, 1)
+        # Stored matches have to come from the permanent endpoint
+        self.assertEqual(client.geocode.call_args[1]['endpoint'], 'mapbox.places-permanent')
+        model.objects.bulk_create.assert_called_once()
+
+    def test_permanent_endpoint_path(self):
+        client = MapboxClient(access_token='token', base_url='http://mapbox.test')
+        with mock.patch.object(client, 'get_json', return_value={}) as get_json:
+            client.geocode('Hays, KS', endpoint='mapbox.places-permanent', limit=1)
+        get_json.assert_called_once_with('geocoding/v5/mapbox.places-permanent/Hays%2C%20KS.json', params={'limit': 1})
+
+
+class PolylineTests(SimpleTestCase):
+    # Google's reference example, precision 5
+    REFERENCE = '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    REFERENCE_COORDINATES = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+    def test_reference_polyline(self):
+        self.assertEqual(encode_polyline(self.REFERENCE_COORDINATES, precision=5), self.REFERENCE)
+        np.testing.assert_allclose(decode_polyline(self.REFERENCE, precision=5), self.REFERENCE_COORDINATES)
+
+    def test_round_trip_precision_6(self):
+        rng = np.random.default_rng(0)
+        # Large jumps, negative deltas and repeated points
+        coordinates = np.round(np.column_stack((rng.uniform(-89, 89, 500), rng.uniform(-179, 179, 500))), 6)
+        coordinates[10] = coordinates[9]
+        decoded = decode_polyline(encode_polyline(coordinates))
+        np.testing.assert_allclose(decoded, coordinates, atol=1e-9)
+
+    def test_empty(self):
+        self.assertEqual(encode_polyline([]), '')
+        self.assertEqual(decode_polyline('').shape, (0, 2))
+
+    def test_simplify_keeps_endpoints_and_corners(self):
+        # Straight line with a little noise, then a sharp corner
+        line = [(32.0 + i * 1e-4, -97.0 + (1e-7 if i % 2 else 0)) for i in range(50)]
+        corner = [(32.0049, -97.0 + i * 1e-4) for i in range(1, 50)]
+        simplified = simplify_coordinates(line + corner, tolerance_meters=1)
+        np.testing.assert_allclose(simplified[0], line[0])
+        np.testing.assert_allclose(simplified[-1], corner[-1])
+        self.assertLessEqual(len(simplified), 4)
+        self.assertTrue(any(np.allclose(point, line[-1]) for point in simplified))
+
+    def test_simplify_zero_tolerance_is_identity(self):
+        polyline = encode_polyline([(32.0, -97.0), (32.1, -97.05), (32.2, -97.1)])
+        self.assertEqual(simplify_polyline(polyline, 0), polyline)
+
+
+class DistanceTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        random = np.column_stack((rng.uniform(-90, 90, 20), rng.uniform(-180, 180, 20)))
+        # Identical, antipodal, pole and antimeridian points
+        special = np.array([(32.0, -97.0), (32.0, -97.0), (-32.0, 83.0), (90.0, 0.0), (-90.0, 45.0),
+                            (0.0, 179.9999), (0.0, -179.9999), (0.0, 0.0), (0.0, 180.0)])
+        self.points = np.vstack((special, random))
+
+    def scalar_matrix(self, points_1, points_2) -> np.ndarray:
+        return np.array([[lat_lng_dist(tuple(a), tuple(b)) for b in points_2] for a in points_1])
+
+    def test_matches_scalar_distance(self):
+        expected = self.scalar_matrix(self.points, self.points)
+        self.assertEqual(expected[0, 1], 0)
+        self.assertAlmostEqual(expected[0, 2], np.pi * EARTH_RADIUS_MILES, places=6)
+        self.assertAlmostEqual(expected[7, 8], expected[0, 2], places=6)
+
+        np.testing.assert_allclose(lat_lng_dist_matrix(self.points, self.points), expected, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(
+            lat_lng_dist_one_to_many(tuple(self.points[2]), self.points), expected[2], rtol=1e-9, atol=1e-9
+        )
+        np.testing.assert_allclose(
+            lat_lng_dist_paired(self.points, self.points[::-1]), np.diag(expected[:, ::-1]), rtol=1e-9, atol=1e-9
+        )
+
+    def test_chunks_and_dtype(self):
+        expected = self.scalar_matrix(self.points, self.points[:7])
+        for chunk_elements in (1, 7, 20, 10 ** 6):
+            result = lat_lng_dist_matrix(self.points, self.points[:7], chunk_elements=chunk_elements)
+            np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-9)
+
+        result = lat_lng_dist_matrix(self.points, self.points[:7], dtype=np.float32, chunk_elements=10)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, expected, rtol=1e-6, atol=1e-3)
+        for result in (lat_lng_dist_one_to_many(tuple(self.points[0]), self.points, dtype=np.float32),
+                       lat_lng_dist_paired(self.points, self.points, dtype=np.float32)):
+            self.assertEqual(result.dtype, np.float32)
+
+        self.assertEqual(lat_lng_dist_matrix(self.points[:0], self.points).shape, (0, len(self.points)))
+        with self.assertRaises(ValueError):
+            lat_lng_dist_paired(self.points, self.points[:3])
+
+
+class GeohashTests(SimpleTestCase):
+    def test_encode(self):
+        # Reference value from the geohash spec
+        self.assertEqual(geohash_encode(42.6, -5.6, 5), 'ezs42')
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+
+    def test_cover_holds_every_point_of_the_bbox(self):
+        rng = np.random.default_rng(0)
+        for bbox in ((-97.5, 32.5, -97.0, 33.0), (-0.5, -0.5, 0.5, 0.5), (170, 60, 180, 90), (-180, -90, 180, 90)):
+            prefixes = geohash_cover(bbox, max_cells=16)
+            self.assertLessEqual(len(prefixes), 16)
+            for lng, lat in zip(rng.uniform(bbox[0], bbox[2], 500), rng.uniform(bbox[1], bbox[3], 500)):
+                geohash = geohash_encode(lat, lng)
+                ranges = [geohash_prefix_range(prefix) for prefix in prefixes]
+                self.assertTrue(any(low <= geohash and (high is None or geohash < high) for low, high in ranges))
+
+    def test_prefix_range(self):
+        self.assertEqual(geohash_prefix_range('9vf'), ('9vf', '9vg'))
+        self.assertEqual(geohash_prefix_range('9vz'), ('9vz', '9w'))
+        self.assertEqual(geohash_prefix_range('zz'), ('zz', None))
+
+
+class SpatialIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.lat_lngs = np.column_stack((rng.uniform(25, 50, 2000), rng.uniform(-125, -70, 2000)))
+        self.queries = np.column_stack((rng.uniform(25, 50, 20), rng.uniform(-125, -70, 20)))
+
+    def brute_force(self, lat_lngs: dict, lat: float, lng: float):
+        ids = list(lat_lngs)
+        dist = lat_lng_dist_one_to_many((lat, lng), [lat_lngs[key] for key in ids])
+        return [ids[index] for index in np.argsort(dist, kind='stable')], np.sort(dist)
+
+    def assertMatchesBruteForce(self, index: SpatialIndex, lat_lngs: dict):
+        self.assertEqual(len(index), len(lat_lngs))
+        for lat, lng in self.queries:
+            ids, dist = self.brute_force(lat_lngs, lat, lng)
+            found_ids, found_dist = index.query(lat, lng, k=5)
+            self.assertEqual(found_ids.tolist(), ids[:5])
+            np.testing.assert_allclose(found_dist, dist[:5], rtol=1e-6)
+            found_ids, found_dist = index.query_radius(lat, lng, 150)
+            self.assertEqual(sorted(found_ids.tolist()), sorted(ids[:int((dist <= 150).sum())]))
+
+    def test_queries_match_brute_force(self):
+        index = SpatialIndex(self.lat_lngs, leaf_size=8)
+        self.assertMatchesBruteForce(index, dict(enumerate(map(tuple, self.lat_lngs))))
+
+    def test_no_neighbours(self):
+        index = SpatialIndex(self.lat_lngs, ids=[f"stop-{key}" for key in range(len(self.lat_lngs))])
+        for k in (0, -1):
+            ids, dist = index.query(32.0, -97.0, k=k)
+            self.assertEqual((ids.tolist(), dist.tolist()), ([], []))
+        ids, dist = SpatialIndex().query(32.0, -97.0, k=3)
+        self.assertEqual((ids.tolist(), dist.tolist()), ([], []))
+
+    def test_insert_move_and_delete(self):
+        index = SpatialIndex(self.lat_lngs[:1000], leaf_size=8)
+        lat_lngs = dict(enumerate(map(tuple, self.lat_lngs[:1000])))
+        # Moves, new points, and a batch large enough to force a rebuild
+        index.insert(self.lat_lngs[1000:1010], range(10))
+        lat_lngs.update(zip(range(10), map(tuple, self.lat_lngs[1000:1010])))
+        self.assertMatchesBruteForce(index, lat_lngs)
+        index.insert(self.lat_lngs[1010:], range(1010, 2000))
+        lat_lngs.update(zip(range(1010, 2000), map(tuple, self.lat_lngs[1010:])))
+        self.assertMatchesBruteForce(index, lat_lngs)
+
+        deleted = [key for key in range(0, 2000, 3) if lat_lngs.pop(key, None) is not None]
+        self.assertEqual(index.delete(list(range(0, 2000, 3))), len(deleted))
+        self.assertNotIn(0, index)
+        self.assertMatchesBruteForce(index, lat_lngs)
+
+    def test_repeated_ids_keep_the_last_point(self):
+        index = SpatialIndex([(32.0, -97.0), (40.0, -100.0), (33.0, -96.0)], ids=['a', 'b', 'a'])
+        index.insert([(45.0, -120.0), (32.5, -97.5), (45.5, -120.5)], ids=['c', 'b', 'c'])
+        self.assertEqual(len(index), 3)
+        lat_lngs = {'a': (33.0, -96.0), 'b': (32.5, -97.5), 'c': (45.5, -120.5)}
+        for lat, lng in [(32.0, -97.0), (45.0, -120.0), (40.0, -100.0)]:
+            ids, dist = self.brute_force(lat_lngs, lat, lng)
+            self.assertEqual(index.query(lat, lng, k=5)[0].tolist(), ids)
+        # Deleting the id leaves nothing behind
+        index.delete(['c'])
+        self.assertEqual(index.query_radius(45.0, -120.0, 100)[0].tolist(), [])
+
+    def test_save_and_load(self):
+        index = SpatialIndex(self.lat_lngs, ids=[f"stop-{key}" for key in range(len(self.lat_lngs))])
+        index.insert([(32.0, -97.0)], ['new'])
+        file = io.BytesIO()
+        index.save(file)
+        file.seek(0)
+        loaded = SpatialIndex.load(file)
+        self.assertEqual(len(loaded), len(index))
+        for lat, lng in self.queries:
+            self.assertEqual(loaded.query(lat, lng, k=3)[0].tolist(), index.query(lat, lng, k=3)[0].tolist())
+        self.assertEqual(loaded.query(32.0, -97.0)[0].tolist(), ['new'])
+
+
+def directions_response(stops) -> dict:
+    """
+    Directions response shaped like Mapbox's, a straight geometry with a few
+    vertices per leg and integer leg totals so sums compare exactly
+    """
+    lat_lngs = np.round([(stop['latitude'], stop['longitude']) for stop in stops], 6)
+    coordinates = [lat_lngs[0]]
+    legs = []
+    for start, end in zip(lat_lngs[:-1], lat_lngs[1:]):
+        coordinates.extend(start + (end - start) * step for step in (.25, .5, .75, 1.))
+        distance = int(lat_lng_dist(tuple(start), tuple(end)) * 1609)
+        legs.append({'distance': distance, 'duration': distance // 20, 'weight': distance // 15, 'summary': ''})
+    return {
+        'code': 'Ok',
+        'uuid': 'stub',
+        'routes': [{
+            'geometry': encode_polyline(np.round(coordinates, 6)), 'legs': legs, 'weight_name': 'auto',
+            'distance': sum(leg['distance'] for leg in legs), 'duration': sum(leg['duration'] for leg in legs),
+            'weight': sum(leg['weight'] for leg in legs),
+        }],
+        'waypoints': [{'name': '', 'location': [lng, lat]} for lat, lng in lat_lngs.tolist()],
+    }
+
+
+@override_settings(CACHES=LOCAL_CACHES, METRICS_ENABLED=False)
+class RouteCacheTests(SimpleTestCase):
+    KEY = 'mapbox_route:test'
+
+    def setUp(self):
+        cache.clear()
+        self.route = directions_response([
+            {'latitude': 32.0, 'longitude': -97.0}, {'latitude': 32.1, 'longitude': -97.1}
+        ])
+
+    def test_single_flight_runs_once_across_threads(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(single_flight('key', compute, lambda: (False, None))))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 5)
+
+    def test_single_flight_waits_for_leader_in_another_process(self):
+        cache.add('lock:key', 'other-process', 30)
+        threading.Timer(0.1, lambda: cache.set('key', 'value')).start()
+        compute = mock.Mock(return_value='computed')
+        lookup = lambda: (cache.get('key') is not None, cache.get('key'))  # noqa: E731
+        self.assertEqual(single_flight('key', compute, lookup, wait=2, poll_interval=0.01), 'value')
+        compute.assert_not_called()
+
+    def test_single_flight_computes_when_lock_check_fails(self):
+        redis = mock.Mock()
+        redis.add.return_value = False
+        redis.get.side_effect = ConnectionError
+        compute = mock.Mock(return_value='computed')
+        with mock.patch('utils.cache.cache', redis):
+            self.assertEqual(single_flight('key', compute, lambda: (False, None), wait=2), 'computed')
+        compute.assert_called_once_with()
+
+    def test_local_lru_evicts_least_recently_used(self):
+        lru = LocalLRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), (True, 1))
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), (False, None))
+        self.assertEqual(lru.get('a'), (True, 1))
+        # Overwriting a key makes it the most recently used
+        lru.set('c', 4)
+        lru.set('d', 5)
+        self.assertEqual([lru.get(key) for key in 'acd'], [(False, None), (True, 4), (True, 5)])
+        self.assertEqual(len(lru), 2)
+
+    def test_local_lru_expires_entries(self):
+        lru = LocalLRUCache(ttl=60)
+        with mock.patch('time.monotonic', return_value=1000):
+            lru.set('default', 1)
+            lru.set('short', 2, ttl=10)
+            # Longer TTLs are capped at the local TTL
+            lru.set('long', 3, ttl=600)
+        with mock.patch('time.monotonic', return_value=1011):
+            self.assertEqual([lru.get(key) for key in ('default', 'short', 'long')], [(True, 1), (False, None), (True, 3)])
+        with mock.patch('time.monotonic', return_value=1061):
+            self.assertEqual([lru.get(key) for key in ('default', 'long')], [(False, None), (False, None)])
+        self.assertEqual(len(lru), 0)
+
+    def test_negative_entries_expire_after_negative_ttl(self):
+        route_cache = RouteCache(negative_ttl=60, local_cache=LocalLRUCache(ttl=600))
+        with mock.patch('time.monotonic', return_value=1000), mock.patch('time.time', return_value=1000):
+            route_cache.set_negative(self.KEY)
+            self.assertEqual(route_cache.get(self.KEY), (True, {}))
+            # Negative entries never leave a stale copy behind
+            self.assertIsNone(route_cache.get_stale(self.KEY))
+        with mock.patch('time.monotonic', return_value=1059), mock.patch('time.time', return_value=1059):
+            route_cache.local.clear()
+            self.assertEqual(route_cache.get(self.KEY), (True, {}))
+            self.assertEqual(route_cache.get_many([self.KEY]), {self.KEY: {}})
+        with mock.patch('time.monotonic', return_value=1061), mock.patch('time.time', return_value=1061):
+            route_cache.local.clear()
+            self.assertEqual(route_cache.get(self.KEY), (False, None))
+        self.assertEqual(
+            route_cache.stats(),
+            {'local_hit': 0, 'remote_hit': 0, 'negative_hit': 3, 'stale_hit': 0, 'miss': 1, 'deferred': 0, 'error': 0}
+        )
+
+    def test_resolve(self):
+        route_cache = RouteCache(local_cache=LocalLRUCache())
+        self.assertEqual(route_cache.resolve(self.KEY, None), {})
+        self.assertEqual(route_cache.get(self.KEY), (False, None))
+
+        self.assertEqual(route_cache.resolve(self.KEY, {}), {})
+        self.assertEqual(route_cache.get(self.KEY), (True, {}))
+
+        self.assertEqual(route_cache.resolve(self.KEY, self.route), self.route)
+        self.assertEqual(route_cache.get(self.KEY), (True, self.route))
+        self.assertEqual(route_cache.get_stale(self.KEY).to_response(), self.route)
+
+    def test_stale_copy_served_across_processes(self):
+        # Two caches with their own LRU stand in for two worker processes
+        first, second = RouteCache(local_cache=LocalLRUCache()), RouteCache(local_cache=LocalLRUCache())
+        first.set(self.KEY, self.route)
+        first.local.clear()
+        cache.delete(self.KEY)
+
+        self.assertEqual(first.get_or_fetch(self.KEY, lambda: {}), self.route)
+        self.assertEqual(first.stats()['stale_hit'], 1)
+        fetch = mock.Mock(return_value={})
+        self.assertEqual(second.get_or_fetch(self.KEY, fetch), self.route)
+        fetch.assert_not_called()
+        self.assertEqual(second.stats()['remote_hit'], 1)
+
+
+@override_settings(CACHES=LOCAL_CACHES, METRICS_ENABLED=False)
+class RouteCodecTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        ROUTE_CACHE.local.clear()
+        rng = np.random.default_rng(1)
+        self.stops = [
+            {'latitude': float(lat), 'longitude': float(lng)}
+            for lat, lng in zip(rng.uniform(32, 33, 6), rng.uniform(-98, -97, 6))
+        ]
+
+    def assertRoundTrip(self, response) -> RouteView:
+        data = encode_route(response)
+        self.assertIsNotNone(data)
+        # Types included, integer totals must not come back as floats
+        self.assertEqual(json.dumps(decode_route(data), sort_keys=True), json.dumps(response, sort_keys=True))
+        return RouteView(data)
+
+    def test_multi_leg_round_trip(self):
+        response = directions_response(self.stops)
+        response['routes'][0]['legs'][1]['duration'] = 61.5
+        response['waypoints'][2]['distance'] = 3
+        view = self.assertRoundTrip(response)
+        self.assertEqual(len(view.legs), len(self.stops) - 1)
+        np.testing.assert_array_equal(view.coordinates(), decode_polyline(response['routes'][0]['geometry']))
+        self.assertLess(len(pack_route(response)), 0.6 * len(json.dumps(response)))
+
+    def test_dense_geometry_is_compact(self):
+        # A couple of thousand vertices a few meters apart, like a real road
+        rng = np.random.default_rng(2)
+        lat_lngs = (rng.normal(0, 5e-5, (2000, 2)) + (1e-4, 2e-4)).cumsum(axis=0) + (32.5, -97.5)
+        response = directions_response(self.stops)
+        response['routes'][0]['geometry'] = encode_polyline(np.round(lat_lngs, 6))
+        view = self.assertRoundTrip(response)
+        self.assertEqual(view.n_coords, 2000)
+        self.assertLess(len(view.buffer), 0.75 * len(json.dumps(response)))
+
+    def test_empty_geometry_round_trip(self):
+        response = directions_response(self.stops[:2])
+        response['routes'][0]['geometry'] = ''
+        view = self.assertRoundTrip(response)
+        self.assertEqual(view.coordinates().shape, (0, 2))
+
+    def test_large_deltas_round_trip(self):
+        response = directions_response([
+            {'latitude': -45.0, 'longitude': -170.0}, {'latitude': 60.0, 'longitude': 170.0}
+        ])
+        view = self.assertRoundTrip(response)
+        np.testing.assert_array_equal(view.polyline_deltas(), polyline_deltas(response['routes'][0]['geometry']))
+        values = [0, 1, -1, 63, -64, 64, 2 ** 31 - 1, -2 ** 31]
+        self.assertEqual(decode_varints(encode_varints(values)).tolist(), values)
+
+    def test_unencodable_responses_stay_dicts(self):
+        response = directions_response(self.stops[:3])
+        alternatives = dict(response, routes=response['routes'] * 2)
+        geojson = copy.deepcopy(response)
+        geojson['routes'][0]['geometry'] = {'type': 'LineString', 'coordinates': [[-97.0, 32.0], [-97.1, 32.1]]}
+        null_distance = copy.deepcopy(response)
+        null_distance['routes'][0]['distance'] = None
+        # Same deltas with a zero chunk padding the first value, re-encoding drops it
+        padded = copy.deepcopy(response)
+        geometry = response['routes'][0]['geometry']
+        end = next(index for index, char in enumerate(geometry) if ord(char) < 95)
+        padded['routes'][0]['geometry'] = geometry[:end] + chr(ord(geometry[end]) + 32) + '?' + geometry[end + 1:]
+        np.testing.assert_array_equal(polyline_deltas(padded['routes'][0]['geometry']), polyline_deltas(geometry))
+        for value in (alternatives, geojson, null_distance, padded, {}):
+            self.assertIsNone(encode_route(value) if value else None)
+            self.assertIs(pack_route(value), value)
+            self.assertIs(unpack_route(pack_route(value)), value)
+
+    def test_hits_reuse_the_decoded_response(self):
+        response = directions_response(self.stops)
+        route_cache = RouteCache(local_cache=LocalLRUCache())
+        route_cache.set('route', response)
+        route_cache.local.clear()
+
+        with mock.patch('services.mapbox.codec.encode_polyline_deltas', wraps=encode_polyline_deltas) as encode:
+            # Tables only, nothing is decoded
+            found, view = route_cache.get('route', decode=False)
+            self.assertTrue(found)
+            self.assertIsInstance(view, RouteView)
+            self.assertEqual((view.distance, view.duration),
+                             (response['routes'][0]['distance'], response['routes'][0]['duration']))
+            np.testing.assert_array_equal(view.polyline_deltas(), polyline_deltas(response['routes'][0]['geometry']))
+            encode.assert_not_called()
+
+            first = route_cache.get('route')[1]
+            self.assertEqual(json.dumps(first, sort_keys=True), json.dumps(response, sort_keys=True))
+            for _ in range(3):
+                self.assertIs(route_cache.get('route')[1], first)
+        encode.assert_called_once()
+        self.assertEqual(route_cache.stats()['local_hit'], 4)
+
+    def test_cached_legs_are_stitched_from_the_view(self):
+        fetch = mock.Mock(side_effect=directions_response)
+        expected = get_leg_directions(self.stops, fetch, max_waypoints=25)
+        ROUTE_CACHE.local.clear()
+
+        to_response = RouteView.to_response
+        with mock.patch.object(RouteView, 'to_response', autospec=True, side_effect=to_response) as view_response:
+            response = get_leg_directions(self.stops, fetch, max_waypoints=25)
+        fetch.assert_called_once_with(self.stops)
+        self.assertEqual(json.dumps(response, sort_keys=True), json.dumps(expected, sort_keys=True))
+        # No leg geometry is re-encoded on a hit
+        self.assertEqual(view_response.call_count, len(self.stops) - 1)
+        self.assertTrue(all(call[1] == {'geometry': False} for call in view_response.call_args_list))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class RouteLegTests(SimpleTestCase):
+    OPTIONS = {'profile': 'driving', 'exclude': 'toll', 'overview': 'full'}
+
+    def setUp(self):
+        cache.clear()
+        ROUTE_CACHE.local.clear()
+        rng = np.random.default_rng(0)
+        self.stops = [
+            {'latitude': float(lat), 'longitude': float(lng)}
+            for lat, lng in zip(rng.uniform(32, 33, 12), rng.uniform(-98, -97, 12))
+        ]
+        # A route that passes the same stop twice
+        self.stops[7] = dict(self.stops[3])
+
+    def assertSameDirections(self, response, expected):
+        response, expected = copy.deepcopy(response), copy.deepcopy(expected)
+        route, expected_route = response['routes'][0], expected['routes'][0]
+        np.testing.assert_allclose(
+            decode_polyline(route.pop('geometry')), decode_polyline(expected_route.pop('geometry')), atol=1e-9
+        )
+        self.assertEqual(response, expected)
+
+    def test_split_route_path(self):
+        for count, max_waypoints in ((12, 25), (12, 4), (13, 4), (2, 2), (12, 2)):
+            segments = split_route_path(self.stops[:count], max_waypoints)
+            self.assertTrue(all(2 <= len(segment) <= max_waypoints for segment in segments))
+            for previous, segment in zip(segments, segments[1:]):
+                self.assertIs(previous[-1], segment[0])
+            self.assertEqual([stop for segment in segments for stop in segment[1:]], self.stops[1:count])
+        with self.assertRaises(ValueError):
+            split_route_path(self.stops, 1)
+
+    def test_split_and_stitch_round_trip(self):
+        response = directions_response(self.stops)
+        legs = split_legs(response)
+        self.assertEqual(len(legs), len(self.stops) - 1)
+        for leg, start, end in zip(legs, self.stops, self.stops[1:]):
+            self.assertSameDirections(leg, directions_response([start, end]))
+        self.assertSameDirections(stitch_directions(split_legs(response)), response)
+
+        # Any grouping of overlapping segments stitches back to the same route
+        segments = [directions_response(segment) for segment in split_route_path(self.stops, 5)]
+        self.assertSameDirections(stitch_directions(segments), response)
+
+    def test_revisited_stop_cuts_on_each_pass(self):
+        # Out to the depot, passing it 3 m off, on to the drop and back to the depot exactly
+        passes = [
+            [(32.0, -97.0), (32.0, -96.995), (32.00003, -96.99)],
+            [(32.00003, -96.99), (32.0, -96.985), (32.0, -96.98)],
+            [(32.0, -96.98), (32.0, -96.99)],
+            [(32.0, -96.99), (32.005, -96.99), (32.01, -96.99)],
+        ]
+        stops = [(32.0, -97.0), (32.0, -96.99), (32.0, -96.98), (32.0, -96.99), (32.01, -96.99)]
+        legs = [{'distance': index + 1, 'duration': index + 1, 'weight': index + 1} for index in range(4)]
+        response = {
+            'code': 'Ok',
+            'routes': [{
+                'geometry': encode_polyline([passes[0][0]] + [point for leg in passes for point in leg[1:]]),
+                'legs': legs, 'distance': 10, 'duration': 10, 'weight': 10,
+            }],
+            'waypoints': [{'name': '', 'location': [lng, lat]} for lat, lng in stops],
+        }
+        for leg, expected in zip(split_legs(response), passes):
+            np.testing.assert_allclose(decode_polyline(leg['routes'][0]['geometry']), expected)
+
+    def test_leg_mismatch_is_rejected(self):
+        response = directions_response(self.stops[:4])
+        response['waypoints'].pop()
+        with self.assertRaises(ValueError):
+            split_legs(response)
+
+    def test_only_the_changed_legs_are_fetched(self):
+        fetch = mock.Mock(side_effect=directions_response)
+        response = get_leg_directions(self.stops, fetch, max_waypoints=5, **self.OPTIONS)
+        self.assertSameDirections(response, directions_response(self.stops))
+        self.assertEqual([len(call[0][0]) for call in fetch.call_args_list], [5, 5, 4])
+
+        # Cached, nothing is fetched
+        fetch.reset_mock()
+        get_leg_directions(self.stops, fetch, max_waypoints=5, **self.OPTIONS)
+        fetch.assert_not_called()
+
+        # Moving one stop refetches the two legs touching it in one call
+        stops = list(self.stops)
+        stops[5] = {'latitude': 32.5, 'longitude': -97.5}
+        response = get_leg_directions(stops, fetch, max_waypoints=5, **self.OPTIONS)
+        self.assertSameDirections(response, directions_response(stops))
+        fetch.assert_called_once_with(stops[4:7])
+
+    def test_one_worker_fetches_in_the_calling_thread(self):
+        threads = []
+
+        def fetch(stops):
+            threads.append(threading.current_thread())
+            return directions_response(stops)
+
+        with mock.patch('services.mapbox.legs.ThreadPoolExecutor') as executor:
+            get_leg_directions(self.stops, fetch, max_waypoints=5, max_workers=1, **self.OPTIONS)
+        executor.assert_not_called()
+        self.assertEqual(threads, [threading.current_thread()] * 3)
+
+    def test_failed_leg_fails_the_route(self):
+        def fetch(stops):
+            return {} if self.stops[6] in stops else directions_response(stops)
+
+        self.assertEqual(get_leg_directions(self.stops, fetch, max_waypoints=5, **self.OPTIONS), {})
+        # The runs that were fetched are cached, the failed one is negatively cached
+        fetch = mock.Mock(side_effect=directions_response)
+        for stops in (self.stops[:5], self.stops[8:]):
+            response = get_leg_directions(stops, fetch, max_waypoints=5, **self.OPTIONS)
+            self.assertSameDirections(response, directions_response(stops))
+        self.assertEqual(get_leg_directions(self.stops, fetch, max_waypoints=5, **self.OPTIONS), {})
+        fetch.assert_not_called()
+
+
+class RoadGraphTests(SimpleTestCase):
+
+    def graph(self) -> RoadGraph:
+        # 0 -> 1 over a short slow road and a long fast one, 1 -> 2 over one road
+        return RoadGraph(
+            node_lat=[32.0, 32.0, 32.0], node_lng=[-97.0, -96.99, -96.98],
+            edge_source=[0, 0, 1], edge_target=[1, 1, 2],
+            edge_distance=[1000, 1100, 950], edge_duration=[200, 100, 95],
+        )
+
+    def test_weight_matches_the_optimised_column(self):
+        stops = [{'latitude': 32.0, 'longitude': -97.0}, {'latitude': 32.0, 'longitude': -96.98}]
+        for method in ('astar', 'bidirectional'):
+            by_distance = self.graph().route(stops, weight='distance', method=method)['routes'][0]
+            self.assertEqual(
+                (by_distance['distance'], by_distance['duration'], by_distance['weight']), (1950, 295, 1950)
+            )
+            by_duration = self.graph().route(stops, weight='duration', method=method)['routes'][0]
+            self.assertEqual(
+                (by_duration['distance'], by_duration['duration'], by_duration['weight']), (2050, 195, 195)
+            )
+
+    def test_zero_duration_edges_keep_astar_optimal(self):
+        # Free links away from the target, a speed bound from the other roads
+        # would estimate more than the 0 they cost
+        graph = RoadGraph(
+            node_lat=[32.0, 32.0, 32.0], node_lng=[-97.0, -97.05, -96.99],
+            edge_source=[0, 0, 1], edge_target=[2, 1, 2],
+            edge_distance=[940, 4700, 5660], edge_duration=[10, 0, 0],
+        )
+        self.assertEqual(graph.heuristic_scale['duration'], 0)
+        for search in (graph.astar, graph.bidirectional_dijkstra):
+            self.assertEqual(search(0, 2), ([0, 1, 2], 0.0))
+
+    def test_astar_only_estimates_the_nodes_it_reaches(self):
+        # 50 x 50 grid of two way roads, a route between neighbouring nodes
+        lat, lng = np.meshgrid(32 + np.arange(50) * .001, -97 + np.arange(50) * .001, indexing='ij')
+        index = np.arange(2500).reshape(50, 50)
+        pairs = np.concatenate((
+            np.column_stack((index[:, :-1].ravel(), index[:, 1:].ravel())),
+            np.column_stack((index[:-1].ravel(), index[1:].ravel())),
+        ))
+        source, target = np.concatenate((pairs, pairs[:, ::-1])).T
+        meters = lat_lng_dist_paired(
+            np.column_stack((lat.ravel()[source], lng.ravel()[source])),
+            np.column_stack((lat.ravel()[target], lng.ravel()[target]))
+        ) * 1609.344
+        graph = RoadGraph(lat.ravel(), lng.ravel(), source, target, meters * 1.2)
+        with mock.patch('services.routing.graph.lat_lng_dist', wraps=lat_lng_dist) as estimate:
+            path, cost = graph.astar(index[25, 25], index[25, 27])
+        self.assertEqual(path, [index[25, 25], index[25, 26], index[25, 27]])
+        self.assertLess(estimate.call_count, 50)
+
+
+def path_miles(route_path) -> float:
+    return sum(
+        lat_lng_dist((a['latitude'], a['longitude']), (b['latitude'], b['longitude']))
+        for a, b in zip(route_path[:-1], route_path[1:])
+    )
+
+
+class StopOrderTests(SimpleTestCase):
+
+    def stops(self, n: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        return [
+            {'id': index, 'latitude': float(lat), 'longitude': float(lng)}
+            for index, (lat, lng) in enumerate(zip(rng.uniform(32.5, 33, n), rng.uniform(-97.5, -96.5, n)))
+        ]
+
+    def test_stops_on_a_line_are_sorted(self):
+        stops = [{'id': index, 'latitude': 32.0, 'longitude': -97.0 + index * .01} for index in range(12)]
+        shuffled = [stops[0]] + [stops[index] for index in (7, 2, 11, 4, 9, 1, 5, 10, 3, 8, 6)]
+        self.assertEqual([stop['id'] for stop in optimize_stop_order(shuffled)], list(range(12)))
+
+    def test_permutation_and_fixed_endpoints(self):
+        stops = self.stops(40)
+        for fix_start, fix_end in ((True, False), (True, True), (False, False)):
+            optimized = optimize_stop_order(stops, fix_start=fix_start, fix_end=fix_end)
+            self.assertEqual(sorted(stop['id'] for stop in optimized), list(range(40)))
+            if fix_start:
+                self.assertEqual(optimized[0]['id'], 0)
+            if fix_end:
+                self.assertEqual(optimized[-1]['id'], 39)
+            self.assertLess(path_miles(optimized), path_miles(stops))
+
+    def test_close_to_optimal_on_small_routes(self):
+        for seed in range(5):
+            stops = self.stops(8, seed)
+            best = min(path_miles([stops[0], *order]) for order in permutations(stops[1:]))
+            self.assertLessEqual(path_miles(optimize_stop_order(stops)), best * 1.05)
+
+    def test_tiny_routes_are_optimal(self):
+        for n in (3, 5, 7):
+            stops = self.stops(n, seed=n)
+            best = min(path_miles([stops[0], *order]) for order in permutations(stops[1:]))
+            optimized = optimize_stop_order(stops)
+            self.assertEqual(optimized[0], stops[0])
+            self.assertAlmostEqual(path_miles(optimized), best)
+
+    def test_three_stops_with_a_free_end_are_reordered(self):
+        stops = [
+            {'id': 0, 'latitude': 32.0, 'longitude': -97.0},
+            {'id': 1, 'latitude': 32.0, 'longitude': -96.8},
+            {'id': 2, 'latitude': 32.0, 'longitude': -96.9},
+        ]
+        self.assertEqual([stop['id'] for stop in optimize_stop_order(stops)], [0, 2, 1])
+        self.assertEqual(optimize_stop_order(stops, fix_end=True), stops)
+        self.assertEqual(optimize_stop_order(stops[:2]), stops[:2])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class VRPTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        rng = np.random.default_rng(5)
+        self.depot = {'latitude': 32.8, 'longitude': -97.0, 'ready': 0, 'due': 12 * 3600}
+        ready = rng.uniform(0, 6 * 3600, 40)
+        self.stops = [
+            {
+                'latitude': float(lat), 'longitude': float(lng), 'demand': int(demand),
+                'ready': float(start), 'due': float(start + 3 * 3600), 'service': 300,
+            }
+            for lat, lng, demand, start in zip(
+                rng.uniform(32.6, 33.0, 40), rng.uniform(-97.2, -96.8, 40), rng.integers(1, 5, 40), ready
+            )
+        ]
+
+    def assertValidPlan(self, problem, solution):
+        nodes = [[index + 1 for index in route] for route in solution.routes]
+        for route in nodes:
+            self.assertLessEqual(problem.demands[route].sum(), problem.capacity)
+            self.assertTrue(problem.route_feasible(route), route)
+        served = sorted(index for route in solution.routes for index in route)
+        self.assertEqual(sorted(served + solution.unassigned), list(range(problem.num_stops)))
+        self.assertAlmostEqual(solution.distance, sum(problem.route_cost(route) for route in nodes))
+
+    def test_routes_respect_capacity_and_time_windows(self):
+        problem = build_vrp_problem(self.depot, self.stops, capacity=10)
+        self.assertTrue(problem.has_time_windows)
+        solution = solve_vrp(problem, restarts=3, max_workers=1)
+        self.assertValidPlan(problem, solution)
+        self.assertEqual(solution.unassigned, [])
+        self.assertTrue(solution.feasible)
+        self.assertGreater(len(solution.routes), 1)
+
+    def test_stops_no_vehicle_can_serve_are_unassigned(self):
+        stops = list(self.stops)
+        # More than a truck carries, and due before anyone can drive there
+        stops[3] = dict(stops[3], demand=11)
+        stops[7] = dict(stops[7], ready=0, due=60)
+        problem = build_vrp_problem(self.depot, stops, capacity=10)
+        solution = solve_vrp(problem, restarts=2, max_workers=1)
+        self.assertValidPlan(problem, solution)
+        self.assertEqual(solution.unassigned, [3, 7])
+
+    def test_vehicle_limit(self):
+        stops = [{key: stop[key] for key in ('latitude', 'longitude')} for stop in self.stops[:12]]
+        problem = build_vrp_problem(self.depot, stops, capacity=3, num_vehicles=2)
+        solution = solve_vrp(problem, restarts=2, max_workers=1)
+        self.assertValidPlan(problem, solution)
+        self.assertFalse(solution.feasible)
+        self.assertEqual(len(solution.routes), 4)
+
+        problem = build_vrp_problem(self.depot, stops, capacity=6, num_vehicles=2)
+        routes = reduce_vehicles(problem, [[node] for node in range(1, 13)])
+        self.assertEqual(len(routes), 2)
+        self.assertTrue(all(problem.route_feasible(route) for route in routes))
+        solution = solve_vrp(problem, restarts=2, max_workers=1)
+        self.assertValidPlan(problem, solution)
+        self.assertTrue(solution.feasible)
+        self.assertLessEqual(len(solution.routes), 2)
+
+    def test_unroutable_matrix_cells_are_never_driven(self):
+        # No time windows, nothing but the arcs themselves rules a cell out
+        depot = {key: self.depot[key] for key in ('latitude', 'longitude')}
+        stops = [{key: stop[key] for key in ('latitude', 'longitude')} for stop in self.stops[:12]]
+        points = np.array([(node['latitude'], node['longitude']) for node in [depot] + stops])
+        durations, distances = estimate_matrix(points, points)
+
+        def build():
+            result = MatrixResult(durations.copy(), distances.copy(), np.zeros(distances.shape, dtype=bool))
+            with mock.patch('services.mapbox.matrix.get_matrix', return_value=result):
+                return build_vrp_problem(depot, stops, matrix='mapbox')
+
+        route = [index + 1 for index in solve_vrp(build(), restarts=1, max_workers=1).routes[0]]
+        # Cut an arc the plan drives and every arc between the depot and the last stop
+        for matrix in (durations, distances):
+            matrix[route[0], route[1]] = np.nan
+            matrix[0, 12] = matrix[12, 0] = np.nan
+        problem = build()
+        solution = solve_vrp(problem, restarts=2, max_workers=1)
+        self.assertValidPlan(problem, solution)
+        self.assertTrue(np.isfinite(solution.distance))
+        self.assertEqual(solution.unassigned, [11])
+        for plan in solution.routes:
+            nodes = [0] + [index + 1 for index in plan] + [0]
+            self.assertNotIn((route[0], route[1]), list(zip(nodes[:-1], nodes[1:])))
+
+    def test_worker_pool_matches_serial(self):
+        problem = build_vrp_problem(self.depot, self.stops, capacity=10)
+        serial = solve_vrp(problem, restarts=4, max_workers=1, seed=3)
+        pooled = solve_vrp(problem, restarts=4, max_workers=2, seed=3)
+        self.assertEqual(pooled.routes, serial.routes)
+        self.assertAlmostEqual(pooled.distance, serial.distance)
+
+    def test_task_records_state(self):
+        params = {'depot': self.depot, 'stops': self.stops, 'capacity': 10, 'restarts': 2, 'max_workers': 1}
+        run_vrp_task(dict(params, job_id='solved'))
+        result = get_vrp_result('solved')
+        self.assertEqual(result['status'], 'done')
+        self.assertEqual(sorted(index for route in result['routes'] for index in route), list(range(40)))
+
+        with self.assertRaises(ValueError):
+            run_vrp_task(dict(params, job_id='broken', stops=[dict(self.stops[0], latitude='north')]))
+        self.assertEqual(get_vrp_result('broken'), {'status': 'failed'})
+        self.assertIsNone(get_vrp_result('unknown'))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class RoutePrefetchTests(SimpleTestCase):
+    STOPS = [{'latitude': 32.0, 'longitude': -97.0 + index * .01} for index in (0, 3, 1, 4, 2)]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_failed_publish_does_not_suppress_the_route(self):
+        with mock.patch('services.mapbox.tasks.publish_task', side_effect=ConnectionError) as publish_task:
+            self.assertFalse(tasks.enqueue_route_prefetch(self.STOPS))
+        with mock.patch('services.mapbox.tasks.publish_task', return_value=True) as publish_task:
+            self.assertTrue(tasks.enqueue_route_prefetch(self.STOPS))
+            # Deduplicated while queued
+            self.assertFalse(tasks.enqueue_route_prefetch(self.STOPS))
+        self.assertEqual(publish_task.call_count, 1)
+
+    def test_publish_fails_fast_when_the_broker_is_down(self):
+        with self.settings(RABBITMQ_PUBLISH_TIMEOUT=0.5), \
+                mock.patch('utils.queue.pika.BlockingConnection', side_effect=ConnectionError) as connect:
+            self.assertFalse(tasks.enqueue_route_prefetch(self.STOPS))
+        # One attempt, no retries or retry delay, bounded by the publish timeout
+        connect.assert_called_once()
+        params = connect.call_args[0][0]
+        self.assertEqual((params.connection_attempts, params.socket_timeout, params.stack_timeout), (1, 0.5, 0.5))
+
+    def test_worker_can_defer_its_own_route_again(self):
+        def get_directions(route_path, **options):
+            # Over quota inside the worker, `_fetch_directions` queues it again
+            self.assertTrue(tasks.enqueue_route_prefetch(route_path, **options))
+
+        with mock.patch('services.mapbox.tasks.publish_task', return_value=True) as publish_task, \
+                mock.patch('services.mapbox.tasks.get_directions', side_effect=get_directions):
+            tasks.enqueue_route_prefetch(self.STOPS)
+            params = publish_task.call_args[1]['params']
+            tasks.prefetch_route(params)
+        self.assertEqual(publish_task.call_count, 2)
+        self.assertEqual(publish_task.call_args[1]['params'], params)
+
+    def test_rate_limits_come_from_settings(self):
+        limits = {'directions': 120, 'directions-matrix': 30, 'geocoding': 0}
+        with self.settings(MAPBOX_RATE_LIMIT_ENABLED=True, MAPBOX_RATE_LIMITS_PER_MINUTE=limits):
+            client = MapboxClient(access_token='token')
+        self.assertEqual({api: bucket.rate_per_minute for api, bucket in client.rate_limits.items()},
+                         {'directions': 120, 'directions-matrix': 30})
+
+    def test_prefetch_follows_the_viewed_stop_order(self):
+        for optimize, expected in ((False, [0, 3, 1, 4, 2]), (True, [0, 1, 2, 3, 4])):
+            cache.clear()
+            with self.settings(ROUTING_OPTIMIZE_STOP_ORDER=optimize), \
+                    mock.patch('services.mapbox.tasks.publish_task', return_value=True) as publish_task:
+                tasks.enqueue_stops_prefetch(self.STOPS)
+            route_path = publish_task.call_args[1]['params']['route_path']
+            self.assertEqual([round((stop['longitude'] + 97) * 100) for stop in route_path], expected)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class MapFeaturesStreamTests(SimpleTestCase):
+    ROUTE_PATHS = [
+        [{'latitude': 32.0, 'longitude': -97.0 + index * .01 + route * .1} for index in range(3)]
+        for route in range(3)
+    ]
+
+    def get_features(self, route_paths, get_directions) -> dict:
+        request = RequestFactory().get('/api/map/features/')
+        with mock.patch.object(MapFeaturesGeoJSONView, 'get_route_paths', return_value=enumerate(route_paths)), \
+                mock.patch('services.mapbox.batch.get_directions', side_effect=get_directions):
+            response = MapFeaturesGeoJSONView.as_view()(request)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(b''.join(response.streaming_content))
+
+    def test_failing_route_is_skipped(self):
+        line = {'routes': [{'geometry': encode_polyline([(32.0, -97.0), (32.0, -96.98)]), 'distance': 1}]}
+
+        def get_directions(route_path, **options):
+            if route_path is self.ROUTE_PATHS[1]:
+                raise MapboxError('Mapbox request failed')
+            return line
+
+        features = self.get_features(self.ROUTE_PATHS, get_directions)['features']
+        routes = [feature['properties']['route'] for feature in features if feature['properties']['kind'] == 'route']
+        self.assertEqual(routes, [0, 2])
+        self.assertEqual(sum(feature['properties']['kind'] == 'stop' for feature in features), 9)
+
+    def route_paths(self, *args):
+        return enumerate(self.ROUTE_PATHS)
+
+    def test_missing_route_changes_the_etag(self):
+        line = {'routes': [{'geometry': encode_polyline([(32.0, -97.0), (32.0, -96.98)]), 'distance': 1}]}
+        view = MapFeaturesGeoJSONView.as_view()
+        with mock.patch.object(MapFeaturesGeoJSONView, 'get_route_paths', side_effect=self.route_paths), \
+                mock.patch('services.mapbox.batch.get_directions', return_value={}):
+            response = view(RequestFactory().get('/api/map/features/'))
+            b''.join(response.streaming_content)
+        etag = response['ETag']
+        with mock.patch.object(MapFeaturesGeoJSONView, 'get_route_paths', side_effect=self.route_paths), \
+                mock.patch('services.mapbox.batch.get_directions', return_value=line):
+            # The degraded body is not revalidated, the fresh one is
+            response = view(RequestFactory().get('/api/map/features/', HTTP_IF_NONE_MATCH=etag))
+            self.assertEqual(response.status_code, 200)
+            b''.join(response.streaming_content)
+            response = view(RequestFactory().get('/api/map/features/', HTTP_IF_NONE_MATCH=response['ETag']))
+            self.assertEqual(response.status_code, 304)
+
+    def test_gzip_honors_q_values_and_keeps_vary(self):
+        for header, gzip in (('gzip, deflate', True), ('gzip;q=0', False), ('x-gzip-foo', False),
+                             ('br, *;q=0.5', True), ('*;q=1, gzip;q=0', False), ('', False)):
+            self.assertEqual(accepts_encoding(header, 'gzip'), gzip, header)
+
+        def streaming_response(*args, **kwargs):
+            # Vary set before the view adds its own, e.g. by an auth layer
+            response = StreamingHttpResponse(*args, **kwargs)
+            response['Vary'] = 'Cookie'
+            return response
+
+        request = RequestFactory().get('/api/map/features/', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        with mock.patch.object(MapFeaturesGeoJSONView, 'get_route_paths', return_value=[]), \
+                mock.patch('apps.customer.views.map_api.StreamingHttpResponse', side_effect=streaming_response):
+            response = MapFeaturesGeoJSONView.as_view()(request)
+            self.assertEqual(json.loads(b''.join(response.streaming_content))['features'], [])
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Cookie, Accept-Encoding')
+
+    def test_failing_route_paths_still_close_the_collection(self):
+        def route_paths():
+            yield self.ROUTE_PATHS[0]
+            raise ConnectionError('database went away')
+
+        collection = self.get_features(route_paths(), lambda route_path, **options: {})
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        self.assertEqual(len(collection['features']), 3)
+
+
+def create_customer(name: str = 'acme') -> Customer:
+    return Customer.objects.create(name=name, name_hash=name, customer_primary_email=f"{name}@example.com")
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class RouteStopModelTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer()
+        self.route = Route.objects.create(customer=self.customer, name='route')
+
+    def test_bulk_import_in_batches(self):
+        rng = np.random.default_rng(0)
+        stops = [
+            {'latitude': float(lat), 'longitude': float(lng), 'display': f"stop {index}"}
+            for index, (lat, lng) in enumerate(zip(rng.uniform(-60, 60, 25), rng.uniform(-179, 179, 25)))
+        ]
+        with mock.patch.object(RouteStopQuerySet, 'bulk_create', autospec=True,
+                               side_effect=RouteStopQuerySet.bulk_create) as bulk_create:
+            self.assertEqual(RouteStop.objects.bulk_import(self.route, stops, batch_size=10), 25)
+        self.assertEqual([len(call[0][1]) for call in bulk_create.call_args_list], [10, 10, 5])
+
+        saved = list(RouteStop.objects.filter(route=self.route).order_by('sequence'))
+        self.assertEqual([stop.sequence for stop in saved], list(range(25)))
+        self.assertEqual([stop.display for stop in saved], [stop['display'] for stop in stops])
+        for stop in saved:
+            self.assertEqual(stop.geohash, geohash_encode(stop.latitude, stop.longitude))
+            self.assertEqual(stop.customer_id, self.customer.pk)
+
+    def test_bulk_import_geocodes_missing_coordinates(self):
+        match = geocoding.GeocodeMatch('Hays, KS', 38.88, -99.33, 'Hays, Kansas', 1., 'place')
+        stops = [{'latitude': 32.0, 'longitude': -97.0}, {'display': 'Hays, KS'}]
+        with mock.patch('apps.customer.models.geocode_batch', return_value=[match]) as geocode_batch:
+            RouteStop.objects.bulk_import(self.route, stops)
+        geocode_batch.assert_called_once_with(['Hays, KS'])
+        self.assertEqual(
+            list(RouteStop.objects.filter(route=self.route).values_list('latitude', 'longitude', 'geohash')),
+            [(32.0, -97.0, geohash_encode(32.0, -97.0)), (38.88, -99.33, geohash_encode(38.88, -99.33))]
+        )
+
+        with mock.patch('apps.customer.models.geocode_batch', return_value=[None]), \
+                self.assertRaises(ValueError):
+            RouteStop.objects.bulk_import(self.route, [{'display': 'Nowhere'}])
+
+    def test_save_keeps_the_geohash_current(self):
+        stop = RouteStop.objects.create(customer=self.customer, route=self.route, latitude=32.0, longitude=-97.0)
+        self.assertEqual(stop.geohash, geohash_encode(32.0, -97.0))
+        stop.latitude, stop.longitude = 40.0, -105.0
+        stop.save()
+        self.assertEqual(RouteStop.objects.get(pk=stop.pk).geohash, geohash_encode(40.0, -105.0))
+
+    def test_stop_edits_queue_one_prefetch_per_burst(self):
+        def create_stops(*latitudes):
+            # Run the signal handlers' on_commit callbacks right away
+            with mock.patch('apps.customer.models.transaction.on_commit', side_effect=lambda callback: callback()):
+                for latitude in latitudes:
+                    RouteStop.objects.create(
+                        customer=self.customer, route=self.route, latitude=latitude, longitude=-97.0,
+                        sequence=round((latitude - 32) * 10)
+                    )
+
+        with mock.patch('services.mapbox.tasks.publish_task', return_value=True) as publish_task:
+            create_stops(32.0, 32.1, 32.2)
+        publish_task.assert_called_once()
+        params = publish_task.call_args[1]['params']
+        self.assertEqual(params, {'route_id': self.route.pk})
+
+        # The worker routes the stops as they are when it runs
+        with self.settings(ROUTING_OPTIMIZE_STOP_ORDER=False), \
+                mock.patch('services.mapbox.tasks.get_directions', return_value={}) as get_directions:
+            tasks.prefetch_route_stops(params)
+        self.assertEqual([stop['latitude'] for stop in get_directions.call_args[0][0]], [32.0, 32.1, 32.2])
+        # Off the queue, the next edit queues the route again
+        with mock.patch('services.mapbox.tasks.publish_task', return_value=True) as publish_task:
+            create_stops(32.3)
+        publish_task.assert_called_once()
+
+    def test_cluster_index_drops_changes_it_missed(self):
+        clusters._indexes.clear()
+        self.addCleanup(clusters._indexes.clear)
+
+        def load_stops(cells):
+            return list(RouteStop.objects.filter(customer=self.customer).values('id', 'latitude', 'longitude'))
+
+        def cluster_ids():
+            index = clusters.get_cluster_index(self.customer.pk, load_stops)
+            return sorted(item['id'] for item in index.get_clusters((-180, -85, 180, 85), 20))
+
+        # Run the signal handlers' on_commit callbacks right away
+        with mock.patch('apps.customer.models.enqueue_route_stops_prefetch'), \
+                mock.patch('apps.customer.models.transaction.on_commit', side_effect=lambda callback: callback()):
+            first = RouteStop.objects.create(
+                customer=self.customer, route=self.route, latitude=32.0, longitude=-97.0
+            )
+            self.assertEqual(cluster_ids(), [first.pk])
+            # A create right after an index build is added in place
+            second = RouteStop.objects.create(
+                customer=self.customer, route=self.route, latitude=32.5, longitude=-97.5
+            )
+            self.assertEqual(cluster_ids(), [first.pk, second.pk])
+
+            # Moves and deletes are not applied in place, a create after them
+            # must not mark the index current
+            first.latitude = 40.0
+            first.save()
+            third = RouteStop.objects.create(
+                customer=self.customer, route=self.route, latitude=33.0, longitude=-98.0
+            )
+            # Rebuilt on the next use instead of keeping the old position
+            self.assertEqual(len(clusters.get_cluster_index(self.customer.pk, lambda cells: [])), 0)
+
+            second.delete()
+            RouteStop.objects.create(
+                customer=self.customer, route=self.route, latitude=34.0, longitude=-99.0
+            )
+            ids = cluster_ids()
+            self.assertNotIn(second.pk, ids)
+            self.assertEqual(ids, sorted(RouteStop.objects.filter(customer=self.customer).values_list('id', flat=True)))
+            self.assertIn(third.pk, ids)
+
+    def test_route_paths_are_grouped_and_ordered(self):
+        second = Route.objects.create(customer=self.customer, name='second')
+        # Interleaved and out of sequence order
+        for route, sequence in ((second, 1), (self.route, 2), (self.route, 0), (second, 0), (self.route, 1)):
+            RouteStop.objects.create(
+                customer=self.customer, route=route, sequence=sequence, display=f"{route.name} {sequence}",
+                latitude=32.0 + sequence, longitude=-97.0
+            )
+        paths = list(RouteStop.objects.filter(customer=self.customer).iter_route_paths())
+        self.assertEqual([route_id for route_id, _ in paths], [self.route.pk, second.pk])
+        self.assertEqual([[stop['display'] for stop in path] for _, path in paths],
+                         [['route 0', 'route 1', 'route 2'], ['second 0', 'second 1']])
+        self.assertEqual(set(paths[0][1][0]), set(RouteStopQuerySet.ROUTE_PATH_FIELDS))
+        self.assertEqual(self.route.get_route_path(), paths[0][1])
+
+        route, stops = get_route_with_stops(self.route.pk, self.customer)
+        self.assertEqual((route, [stop.sequence for stop in stops]), (self.route, [0, 1, 2]))
+
+    def test_distance_in_sql_matches_lat_lng_dist(self):
+        rng = np.random.default_rng(2)
+        stops = [
+            {'latitude': float(lat), 'longitude': float(lng)}
+            for lat, lng in zip(rng.uniform(-89, 89, 300), rng.uniform(-180, 180, 300))
+        ]
+        # Around the antimeridian and a pole
+        stops += [{'latitude': 10.0, 'longitude': 179.5}, {'latitude': 10.2, 'longitude': -179.6},
+                  {'latitude': 89.5, 'longitude': 0.0}, {'latitude': 89.4, 'longitude': 170.0}]
+        RouteStop.objects.bulk_import(self.route, stops)
+        queryset = RouteStop.objects.filter(route=self.route)
+
+        for lat, lng in ((32.0, -97.0), (10.1, 179.9), (89.9, 45.0)):
+            distances = dict(queryset.annotate_distance(lat, lng).values_list('sequence', 'distance'))
+            expected = {
+                index: lat_lng_dist((lat, lng), (stop['latitude'], stop['longitude']))
+                for index, stop in enumerate(stops)
+            }
+            self.assertEqual(set(distances), set(expected))
+            for index, distance in distances.items():
+                self.assertAlmostEqual(distance, expected[index], places=6)
+
+            for miles in (50, 1500):
+                found = list(queryset.within_radius(lat, lng, miles, order_by_distance=True)
+                             .values_list('sequence', 'distance'))
+                self.assertEqual(sorted(index for index, _ in found),
+                                 sorted(index for index, distance in expected.items() if distance <= miles))
+                self.assertEqual([distance for _, distance in found], sorted(distance for _, distance in found))
+
+    def test_bbox_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        stops = [
+            {'latitude': float(lat), 'longitude': float(lng)}
+            for lat, lng in zip(rng.uniform(-80, 80, 400), rng.uniform(-180, 180, 400))
+        ]
+        RouteStop.objects.bulk_import(self.route, stops)
+        for bbox in ((-98, 30, -90, 40), (-10, -10, 10, 10), (170, -60, -170, 60), (-180, -90, 180, 90)):
+            min_lng, min_lat, max_lng, max_lat = bbox
+            expected = sorted(
+                index for index, stop in enumerate(stops)
+                if min_lat <= stop['latitude'] <= max_lat and (
+                    min_lng <= stop['longitude'] <= max_lng if min_lng <= max_lng
+                    else stop['longitude'] >= min_lng or stop['longitude'] <= max_lng
+                )
+            )
+            found = RouteStop.objects.filter(route=self.route).within_bbox(bbox).values_list('sequence', flat=True)
+            self.assertEqual(sorted(found), expected, bbox)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class MapFeaturesQueryTests(TestCase):
+    BBOX = (-97.5, 32.0, -97.0, 32.5)
+
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer()
+        self.inside = Route.objects.create(customer=self.customer, name='inside')
+        RouteStop.objects.bulk_import(self.inside, [
+            {'latitude': 32.1, 'longitude': -97.4, 'display': 'a'},
+            {'latitude': 33.1, 'longitude': -96.4, 'display': 'b'},
+            {'latitude': 32.2, 'longitude': -97.1, 'display': 'c'},
+        ])
+        self.outside = Route.objects.create(customer=self.customer, name='outside')
+        RouteStop.objects.bulk_import(self.outside, [
+            {'latitude': 35.0, 'longitude': -90.0, 'display': 'd'},
+            {'latitude': 35.1, 'longitude': -90.1, 'display': 'e'},
+        ])
+
+    def get_features(self, query: str) -> list:
+        request = RequestFactory().get(f'/api/map/features/?{query}')
+        request.customer = self.customer
+
+        def get_directions(route_path, **options):
+            self.paths.append([stop['display'] for stop in route_path])
+            return {'routes': [{'geometry': encode_polyline(
+                [(stop['latitude'], stop['longitude']) for stop in route_path]
+            ), 'distance': 1, 'duration': 1}]}
+
+        self.paths = []
+        with mock.patch('services.mapbox.batch.get_directions', side_effect=get_directions):
+            response = MapFeaturesGeoJSONView.as_view()(request)
+            return json.loads(b''.join(response.streaming_content))['features']
+
+    def test_stops_are_filtered_in_the_query(self):
+        bbox = ','.join(map(str, self.BBOX))
+        view = MapFeaturesGeoJSONView()
+        view.request = mock.Mock(customer=self.customer)
+        # Without route lines the outside route is never read
+        self.assertEqual(
+            [(route_id, [stop['display'] for stop in path]) for route_id, path in
+             view.get_route_paths(self.BBOX, include_routes=False)],
+            [(self.inside.pk, ['a', 'c'])]
+        )
+        features = self.get_features(f'bbox={bbox}&routes=0')
+        self.assertEqual([feature['id'] for feature in features],
+                         [f"stop-{self.inside.pk}-0", f"stop-{self.inside.pk}-2"])
+        self.assertEqual(self.paths, [])
+
+    def test_route_lines_use_every_stop(self):
+        features = self.get_features(f"bbox={','.join(map(str, self.BBOX))}")
+        # The route without a stop in view is never read nor routed
+        self.assertEqual(self.paths, [['a', 'b', 'c']])
+        self.assertEqual(
+            [(feature['properties']['kind'], feature['properties'].get('display')) for feature in features],
+            [('stop', 'a'), ('stop', 'c'), ('route', None)]
+        )
+        self.assertEqual(len(self.get_features('')), 7)
+        self.assertEqual(sorted(self.paths), [['a', 'b', 'c'], ['d', 'e']])
+
+    def test_route_lines_are_fetched_in_batches(self):
+        for index in range(3):
+            route = Route.objects.create(customer=self.customer, name=f"extra {index}")
+            RouteStop.objects.bulk_import(route, [
+                {'latitude': 36.0 + index, 'longitude': -91.0, 'display': f"x{index}"},
+                {'latitude': 36.5 + index, 'longitude': -91.0, 'display': f"y{index}"},
+            ])
+        with mock.patch('apps.customer.views.map_api.ROUTE_LINE_BATCH_SIZE', 2), \
+                mock.patch('apps.customer.views.map_api.get_directions_batch',
+                           side_effect=get_directions_batch) as batch:
+            features = self.get_features('')
+        self.assertEqual([len(call[0][0]) for call in batch.call_args_list], [2, 2, 1])
+        kinds = [feature['properties']['kind'] for feature in features]
+        self.assertEqual(kinds.count('route'), 5)
+        # Stops of the first batch stream before its route lines
+        self.assertEqual(kinds[:6], ['stop'] * 5 + ['route'])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ClusterIndexTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        clusters._indexes.clear()
+        rng = np.random.default_rng(0)
+        self.stops = [
+            {'id': index, 'longitude': float(lng), 'latitude': float(lat)}
+            for index, (lng, lat) in enumerate(zip(rng.uniform(-125, -70, 3000), rng.uniform(25, 50, 3000)))
+        ]
+        self.loaded = []
+
+    def load_stops(self, cells=None):
+        self.loaded.append(cells)
+        if cells is None:
+            return list(self.stops)
+        return [stop for stop in self.stops if geohash_encode(stop['latitude'], stop['longitude'], 3) in cells]
+
+    def assertSameClusters(self, clusters_a, clusters_b):
+        # Centroids are sums over a different point order, equal up to rounding
+        self.assertEqual(
+            [(item.get('cluster_id'), item.get('count'), item.get('id')) for item in clusters_a],
+            [(item.get('cluster_id'), item.get('count'), item.get('id')) for item in clusters_b],
+        )
+        for item_a, item_b in zip(clusters_a, clusters_b):
+            self.assertAlmostEqual(item_a['longitude'], item_b['longitude'], places=9)
+            self.assertAlmostEqual(item_a['latitude'], item_b['latitude'], places=9)
+
+    def test_lazy_cells_match_the_full_index(self):
+        full = ClusterIndex().add(self.stops)
+        views = (
+            ((-98, 32, -96, 33.5), 8), ((-97.5, 32, -96.5, 33), 5),
+            ((-99, 31, -95, 34), 7), ((-97.5, 32.5, -97.3, 32.7), 17),
+        )
+        for bbox, zoom in views:
+            index = clusters.get_cluster_index('customer', self.load_stops, bbox=bbox, zoom=zoom)
+            self.assertIsNotNone(self.loaded[-1])
+            self.assertSameClusters(index.get_clusters(bbox, zoom), full.get_clusters(bbox, zoom))
+
+        # Cells already loaded are not read again
+        calls = len(self.loaded)
+        clusters.get_cluster_index('customer', self.load_stops, bbox=(-97.5, 32.5, -97.3, 32.7), zoom=10)
+        self.assertEqual(len(self.loaded), calls)
+
+        # A world view loads the rest once, keeping one copy of every stop
+        index = clusters.get_cluster_index('customer', self.load_stops, bbox=(-180, -85, 180, 85), zoom=2)
+        self.assertIsNone(self.loaded[-1])
+        self.assertEqual(len(index), len(self.stops))
+        self.assertSameClusters(index.get_clusters((-180, -85, 180, 85), 2), full.get_clusters((-180, -85, 180, 85), 2))
+
+    def test_new_stops_are_added_without_a_rebuild(self):
+        bbox = (-98, 32, -96, 33.5)
+        index = clusters.get_cluster_index('customer', self.load_stops, bbox=bbox, zoom=8)
+        count = len(index)
+        new = [{'id': 'new', 'longitude': -97.0, 'latitude': 32.8}, {'id': 'far', 'longitude': 10.0, 'latitude': 50.0}]
+        self.stops.extend(new)
+        clusters.add_stops_to_cluster_index('customer', new, invalidate_stop_tiles('customer'))
+
+        calls = len(self.loaded)
+        self.assertIs(clusters.get_cluster_index('customer', self.load_stops, bbox=bbox, zoom=8), index)
+        self.assertEqual(len(self.loaded), calls)
+        # Only the stop in a loaded cell, the other comes with its cell
+        self.assertEqual(len(index), count + 1)
+        index = clusters.get_cluster_index('customer', self.load_stops, bbox=(-180, -85, 180, 85), zoom=2)
+        self.assertEqual(len(index), len(self.stops))
+
+    def test_invalid_zoom_and_bbox(self):
+        for query in ('bbox=-98,32,-96,33&zoom=nan', 'bbox=-98,32,-96,33&zoom=inf',
+                      'bbox=-98,nan,-96,33&zoom=8', 'bbox=-98,32,-96,33'):
+            response = MapClusterView.as_view()(RequestFactory().get(f'/api/map/clusters/?{query}'))
+            self.assertEqual(response.status_code, 400, query)
+
+
+@override_settings(CACHES=LOCAL_CACHES, ROUTING_OPTIMIZE_STOP_ORDER=False)
+class RouteDataTests(SimpleTestCase):
+    ROUTE_PATH = [{'latitude': 32.0, 'longitude': -97.0}, {'latitude': 32.0, 'longitude': -96.98}]
+
+    def get(self, mapbox_route, **headers):
+        with mock.patch('apps.customer.views.map_view.get_route_path', return_value=self.ROUTE_PATH), \
+                mock.patch('apps.customer.views.map_view.get_mapbox_response', return_value=mapbox_route):
+            return RouteDataView.as_view()(RequestFactory().get('/api/route/', **headers))
+
+    def test_missing_route_is_not_cached(self):
+        response = self.get({})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(json.loads(response.content)['route'])
+        self.assertFalse(response.has_header('ETag'))
+        self.assertIn('no-store', response['Cache-Control'])
+        self.assertNotIn('max-age', response['Cache-Control'])
+
+    def test_route_is_revalidated(self):
+        line = {'routes': [{'geometry': encode_polyline([(32.0, -97.0), (32.0, -96.98)]), 'distance': 1}]}
+        response = self.get(line)
+        self.assertIn('max-age=60', response['Cache-Control'])
+        self.assertEqual(self.get(line, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_anonymous_sample_map_loads_route(self):
+        line = {'routes': [{'geometry': encode_polyline([(32.0, -97.0), (32.0, -96.98)]), 'distance': 1}]}
+        client = Client()
+        self.assertEqual(client.get('/').status_code, 200)
+        with mock.patch('apps.customer.views.map_view.get_mapbox_response', return_value=line):
+            response = client.get('/map/route/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(len(json.loads(response.content)['route_path']), len(get_route_path_json()))
+        self.assertIsNotNone(json.loads(response.content)['route'])
+
+    def test_etag_covers_stop_fields_and_settings(self):
+        line = {'routes': [{'geometry': encode_polyline([(32.0, -97.0), (32.0, -96.98)]), 'distance': 1}]}
+        etag = self.get(line)['ETag']
+        self.ROUTE_PATH = [dict(stop, display='Depot', marker='blue_donut') for stop in RouteDataTests.ROUTE_PATH]
+        edited = self.get(line, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(edited.status_code, 200)
+        self.assertNotEqual(edited['ETag'], etag)
+        with override_settings(MAPBOX_SIMPLIFY_TOLERANCE=1e-3):
+            self.assertEqual(self.get(line, HTTP_IF_NONE_MATCH=edited['ETag']).status_code, 200)
+        with mock.patch('apps.customer.views.map_view.ROUTE_CACHE_VERSION', -1):
+            self.assertEqual(self.get(line, HTTP_IF_NONE_MATCH=edited['ETag']).status_code, 200)
+
+
+@override_settings(CACHES=LOCAL_CACHES, MAPBOX_TILE_PROXY_ENABLED=True)
+class BasemapTests(SimpleTestCase):
+    PATH = 'v4/mapbox.mapbox-streets-v8/14/4823/6160.vector.pbf'
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = TileCacheStorage(location=directory.name)
+        self.proxy = TileProxy(storage=self.storage, max_bytes=250, default_ttl=60, index=TileLRUIndex('test'))
+        self.client_patch = mock.patch('services.mapbox.basemap.get_client')
+        self.request = self.client_patch.start().return_value.request
+        self.addCleanup(self.client_patch.stop)
+
+    @staticmethod
+    def upstream(content: bytes = b'x' * 100, status_code: int = 200, **headers):
+        headers = dict({'Content-Type': 'application/x-protobuf', 'Cache-Control': 'max-age=600'}, **headers)
+        return mock.Mock(status_code=status_code, content=content, headers=headers)
+
+    def test_only_tile_paths_are_proxied(self):
+        for path in (
+            self.PATH, 'v4/mapbox.satellite/3/1/2@2x.jpg90', 'v4/mapbox.a,mapbox.b/1/0/0.mvt',
+            'styles/v1/mapbox/streets-v11/tiles/512/1/0/0@2x',
+        ):
+            self.assertTrue(TILE_PATH_RE.match(path), path)
+        for path in (
+            'v4/../1/2/3.png', 'v4/mapbox.satellite/../../1/2/3.png', 'styles/v1/../../tiles/1/2/3',
+            'styles/v1/mapbox/streets-v11', 'fonts/v1/mapbox/Open Sans/0-255.pbf', 'v4/mapbox.satellite/1/2/3.png/..',
+            '/v4/mapbox.satellite/1/2/3.png', 'v4/mapbox.satellite/1/2/3.exe', 'geocoding/v5/mapbox.places/x.json',
+        ):
+            with self.assertRaises(ValueError, msg=path):
+                self.proxy.get(path)
+        self.request.assert_not_called()
+
+        # Public like the sample map, an anonymous request is answered, not sent to login
+        self.assertEqual(Client().get('/basemap/fonts/v1/mapbox/0-255.pbf').status_code, 404)
+
+    def test_tiles_are_cached_and_evicted_least_recently_used(self):
+        paths = [f"v4/mapbox.satellite/3/{x}/0.png" for x in range(3)]
+        self.request.side_effect = lambda path, headers: self.upstream(path.encode('utf-8').ljust(100))
+        self.proxy.get(paths[0])
+        self.proxy.get(paths[1])
+        self.assertEqual(self.proxy.get(paths[0]).content, paths[0].encode('utf-8').ljust(100))
+        self.assertEqual(self.request.call_count, 2)
+
+        # Over 250 bytes, the tile read longest ago goes
+        self.proxy.get(paths[2])
+        names = [self.proxy.storage_name(path) for path in paths]
+        self.assertEqual([self.storage.exists(name) for name in names], [True, False, True])
+        self.assertFalse(self.storage.exists(f"{names[1]}.json"))
+        self.proxy.get(paths[1])
+        self.assertEqual(self.request.call_count, 4)
+
+    def test_stale_tile_served_when_upstream_fails(self):
+        self.request.return_value = self.upstream(ETag='"v1"')
+        self.proxy.get(self.PATH)
+
+        # Expire it, a failed revalidation still serves the copy
+        name = self.proxy.storage_name(self.PATH)
+        meta = self.proxy._read_meta(name)
+        self.storage.save(f"{name}.json", ContentFile(json.dumps(dict(meta, expires=time.time() - 1)).encode('utf-8')))
+        self.request.side_effect = MapboxError('Mapbox responded 503', status_code=503)
+        tile = self.proxy.get(self.PATH)
+        self.assertEqual((tile.content, tile.max_age), (b'x' * 100, STALE_MAX_AGE))
+        self.assertEqual(self.request.call_args[1]['headers']['If-None-Match'], '"v1"')
+
+        # Revalidated, the copy is fresh again
+        self.request.side_effect = None
+        self.request.return_value = self.upstream(b'', status_code=304)
+        tile = self.proxy.get(self.PATH)
+        self.assertEqual((tile.content, tile.max_age), (b'x' * 100, 600))
+
+        # Nothing cached to fall back on
+        self.request.side_effect = MapboxError('Mapbox responded 503', status_code=503)
+        with self.assertRaises(MapboxError):
+            self.proxy.get('v4/mapbox.satellite/3/1/1.png')
+
+
+def read_protobuf(data: bytes) -> dict:
+    """
+    {field: [values]} of one protobuf message, nested messages stay bytes
+    """
+    fields, position = {}, 0
+
+    def varint():
+        nonlocal position
+        value = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    while position < len(data):
+        key = varint()
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value = varint()
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 2:
+            length = varint()
+            value = data[position:position + length]
+            position += length
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type}")
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def read_varints(data: bytes) -> list:
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+class VectorTileTests(SimpleTestCase):
+
+    def test_tile_bounds_and_projection(self):
+        self.assertEqual(tile_bounds(0, 0, 0)[0::2], (-180, 180))
+        np.testing.assert_allclose(tile_bounds(0, 0, 0)[1::2], (-85.0511287798, 85.0511287798))
+        min_lng, min_lat, max_lng, max_lat = tile_bounds(10, 236, 413)
+        pixels = lng_lat_to_tile([min_lng, max_lng], [max_lat, min_lat], 10, 236, 413)
+        np.testing.assert_array_equal(pixels, [[0, 0], [4096, 4096]])
+
+    def test_encode_tile(self):
+        tile = encode_tile({'stops': [
+            {'id': 7, 'type': 'Point', 'coordinates': [[10, 20]], 'properties': {'display': 'A', 'rank': -3}},
+            {'id': 8, 'type': 'Point', 'coordinates': [[15, 18]], 'properties': {'display': 'A', 'marker': None}},
+            {'type': 'LineString', 'coordinates': [[0, 0], [0, 0], [5, 5], [3, 9]],
+             'properties': {'weight': 1.5, 'open': True}},
+            # One distinct vertex is not a line, it is dropped
+            {'type': 'LineString', 'coordinates': [[4, 4], [4, 4]], 'properties': {}},
+        ], 'empty': []})
+
+        layers = read_protobuf(tile)[3]
+        self.assertEqual(len(layers), 1)
+        layer = read_protobuf(layers[0])
+        self.assertEqual(layer[15], [2])
+        self.assertEqual(layer[1], [b'stops'])
+        self.assertEqual(layer[5], [4096])
+        keys = [key.decode('utf-8') for key in layer[3]]
+        self.assertEqual(keys, ['display', 'rank', 'weight', 'open'])
+        values = [read_protobuf(value) for value in layer[4]]
+        self.assertEqual(values[0], {1: [b'A']})
+        self.assertEqual(unzigzag(values[1][6][0]), -3)
+        self.assertEqual(struct.unpack('<d', values[2][3][0])[0], 1.5)
+        self.assertEqual(values[3], {7: [1]})
+
+        features = [read_protobuf(feature) for feature in layer[2]]
+        self.assertEqual(len(features), 3)
+        first, second, line = features
+        self.assertEqual((first[1], first[3]), ([7], [1]))
+        # Repeated values share one entry in the values table
+        self.assertEqual(read_varints(first[2][0]), [0, 0, 1, 1])
+        self.assertEqual(read_varints(second[2][0]), [0, 0])
+        # MoveTo(1) then zigzag encoded x, y
+        self.assertEqual(read_varints(first[4][0]), [9, 20, 40])
+        self.assertNotIn(1, line)
+        self.assertEqual(line[3], [2])
+        # MoveTo(1) 0,0 then LineTo(2) +5,+5 and -2,+4, the repeated vertex is dropped
+        commands = read_varints(line[4][0])
+        self.assertEqual(commands[:3], [9, 0, 0])
+        self.assertEqual(commands[3], 2 | (2 << 3))
+        self.assertEqual([unzigzag(value) for value in commands[4:]], [5, 5, -2, 4])
+
+    def test_empty_tile(self):
+        self.assertEqual(encode_tile({'stops': []}), b'')
+
+    def test_cache_outage_builds_tiles_uncached(self):
+        broken = mock.Mock(**{f"{name}.side_effect": ConnectionError for name in ('get', 'set', 'add')})
+        stops = [{'id': 1, 'longitude': -96.9, 'latitude': 32.8}]
+        get_stops = mock.Mock(return_value=stops)
+        request = RequestFactory().get('/tiles/10/236/413.mvt')
+        with mock.patch('services.tiles.vector.cache', broken), \
+                mock.patch.object(StopVectorTileView, 'get_stops', return_value=stops):
+            self.assertIsNone(get_tile_version('customer'))
+            invalidate_stop_tiles('customer')
+            for _ in range(2):
+                self.assertEqual(get_stop_tile('customer', 10, 236, 413, get_stops), build_stop_tile(stops, 10, 236, 413))
+            response = StopVectorTileView.as_view()(request, z=10, x=236, y=413)
+        self.assertEqual(get_stops.call_count, 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, build_stop_tile(stops, 10, 236, 413))
+        self.assertNotIn('ETag', response)
+
+    def test_buffered_bounds_hold_every_stop_the_tile_draws(self):
+        rng = np.random.default_rng(0)
+        for z, x, y in ((10, 236, 413), (3, 0, 0), (3, 7, 7), (16, 15114, 26380)):
+            min_lng, min_lat, max_lng, max_lat = tile_bounds(z, x, y)
+            width, height = max_lng - min_lng, max_lat - min_lat
+            stops = [
+                {'id': index, 'longitude': float(lng), 'latitude': float(lat)} for index, (lng, lat) in enumerate(zip(
+                    np.clip(rng.uniform(min_lng - width * .1, max_lng + width * .1, 2000), -180, 180),
+                    np.clip(rng.uniform(min_lat - height * .1, max_lat + height * .1, 2000), -85, 85),
+                ))
+            ]
+            layer = read_protobuf(read_protobuf(build_stop_tile(stops, z, x, y))[3][0])
+            drawn = {read_protobuf(feature)[1][0] for feature in layer[2]}
+            bbox = tile_bounds(z, x, y, buffer=DEFAULT_BUFFER + 1)
+            inside = {
+                stop['id'] for stop in stops
+                if bbox[0] <= stop['longitude'] <= bbox[2] and bbox[1] <= stop['latitude'] <= bbox[3]
+            }
+            self.assertTrue(drawn)
+            self.assertLessEqual(drawn, inside)
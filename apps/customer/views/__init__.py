@@ -2,7 +2,8 @@ from .admin import (
     AdminLanding
 )
 
-from .map_view import SampleMapView
+from .map_api import BasemapTileView, MapClusterView, MapFeaturesGeoJSONView, StopVectorTileView
+from .map_view import RouteDataView, SampleMapView
 
 from .user import (
     login_user,
@@ -0,0 +1,410 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views import View
+
+from apps.customer.models import RouteStop, RouteStopQuerySet
+from services.mapbox import MapboxError, get_directions_batch
+from services.mapbox.basemap import get_tile_proxy
+from services.mapbox.cache import ROUTE_CACHE_VERSION
+from services.tiles import get_cluster_index, get_stop_tile, get_tile_version
+from utils.geometry import decode_polyline
+from utils.mixins import ConditionalGetMixin, make_etag
+from utils.mvt import DEFAULT_BUFFER, tile_bounds
+
+from .map_view import get_route_path_json
+
+import json
+import logging
+import math
+import zlib
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+logger = logging.getLogger('api')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+ROUTE_LINE_BATCH_SIZE = 16 # Route lines fetched together through `get_directions_batch`
+STOP_FIELDS = ('display', 'marker')
+MAX_TILE_ZOOM = 22
+
+
+def parse_bbox(value: str) -> Tuple[float, float, float, float]:
+    """
+    `min_lng,min_lat,max_lng,max_lat` -> tuple of floats, raises ValueError
+    """
+    bbox = tuple(float(part) for part in value.split(','))
+    if len(bbox) != 4 or not all(map(math.isfinite, bbox)) or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError(f"Invalid bbox `{value}`")
+    return bbox
+
+
+def accepts_encoding(header: str, encoding: str) -> bool:
+    """
+    Whether an `Accept-Encoding` header allows `encoding`, honoring q-values:
+    "gzip;q=0" refuses it and "*" stands in for encodings not listed
+    """
+    qualities = {}
+    for part in header.split(','):
+        name, *params = part.split(';')
+        quality = 1.
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        qualities[name.strip().lower()] = quality
+    quality = qualities.get(encoding, qualities.get('*', 0.))
+    return quality > 0
+
+
+def _in_bbox(lng: float, lat: float, bbox: Tuple) -> bool:
+    return bbox[0] <= lng <= bbox[2] and bbox[1] <= lat <= bbox[3]
+
+
+def _route_failures_key(customer_id) -> str:
+    return f"map_features:route_failures:{customer_id}"
+
+
+def get_route_failures(customer_id) -> int:
+    """
+    Counter bumped whenever a route line is missing from a features stream,
+    part of the ETag so a degraded body is never revalidated as current
+    """
+    try:
+        return cache.get(_route_failures_key(customer_id), 0)
+    except Exception:
+        logger.warning("Route failure counter read failed", exc_info=True)
+        return 0
+
+
+def record_route_failure(customer_id):
+    key = _route_failures_key(customer_id)
+    try:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+    except Exception:
+        logger.warning("Route failure counter write failed", exc_info=True)
+
+
+def get_customer_id(request):
+    customer = getattr(request, 'customer', None)
+    return customer.pk if customer is not None else 'public'
+
+
+def get_customer_stops(request, bbox: Tuple = None) -> Iterable[Dict]:
+    """
+    Stops of the request customer streamed from the database, only those in
+    `bbox` when given, the sample route for requests without a customer
+    """
+    customer = getattr(request, 'customer', None)
+    if customer is None:
+        return get_route_path_json()
+    stops = RouteStop.objects.filter(customer=customer)
+    if bbox is not None:
+        stops = stops.within_bbox(bbox)
+    return stops.route_path().iterator()
+
+
+def _gzip_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31 -> gzip container
+    for chunk in chunks:
+        # Sync flush per chunk so compression never holds back the first byte
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+class MapFeaturesGeoJSONView(ConditionalGetMixin, View):
+    """
+    Map Features API -> Streams a GeoJSON FeatureCollection of stops and route
+    lines, one feature at a time so memory stays flat for large fleets
+
+    Query Parameters
+    -----------
+        bbox str
+            `min_lng,min_lat,max_lng,max_lat`, only stops inside it and the
+            lines of routes with a stop inside it
+        fields str
+            Comma separated stop properties to include, defaults to all
+        routes bool
+            Include route LineStrings, default `1`
+    """
+    cache_control = {'private': True, 'max_age': 60}
+
+    @staticmethod
+    def accepts_gzip(request) -> bool:
+        return accepts_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), 'gzip')
+
+    def get_etag(self, request, *args, **kwargs) -> str:
+        # Stop edits bump the customer tile version, which covers the routes
+        # too. Headers go out before the routes are fetched, so a stream
+        # missing a route bumps the failure counter instead
+        customer_id = get_customer_id(request)
+        version = get_tile_version(customer_id)
+        if version is None:
+            # Stop data version unknown, never answer 304
+            return None
+        return make_etag(
+            'features', customer_id, version, get_route_failures(customer_id),
+            ROUTE_CACHE_VERSION, request.GET.urlencode(), self.accepts_gzip(request)
+        )
+
+    def get_route_paths(self, bbox: Tuple = None, include_routes: bool = True) -> Iterable[Tuple[int, List[Dict]]]:
+        """
+        (route id, route path) pairs with each stop's `sequence`, stops outside
+        `bbox` are flagged `in_bbox: False` or, without route lines, not read.
+        Routes without a stop inside `bbox` are left out
+        """
+        customer = getattr(self.request, 'customer', None)
+        if customer is None:
+            route_path = [
+                dict(stop, sequence=index, in_bbox=bbox is None or _in_bbox(stop['longitude'], stop['latitude'], bbox))
+                for index, stop in enumerate(get_route_path_json())
+            ]
+            return [(0, route_path)] if any(stop['in_bbox'] for stop in route_path) else []
+        stops = RouteStop.objects.filter(customer=customer)
+        extra_fields = ('sequence',)
+        if bbox is not None and include_routes:
+            # Route lines need every stop of a route, only routes with a stop
+            # in view are read and the database flags the stops to draw
+            in_view = RouteStop.objects.filter(customer=customer).within_bbox(bbox).values('route_id')
+            stops = stops.filter(route_id__in=in_view).annotate_in_bbox(bbox)
+            extra_fields += ('in_bbox',)
+        elif bbox is not None:
+            stops = stops.within_bbox(bbox)
+        return stops.iter_route_paths(extra_fields=extra_fields)
+
+    def iter_stop_features(self, route_id: int, route_path: List[Dict],
+                           fields: Tuple = STOP_FIELDS) -> Iterator[Dict]:
+        for stop_index, stop in enumerate(route_path):
+            if not stop.get('in_bbox', True):
+                continue
+            lng, lat = float(stop['longitude']), float(stop['latitude'])
+            sequence = stop.get('sequence', stop_index)
+            properties = {field: stop.get(field) for field in fields}
+            properties.update({'kind': 'stop', 'route': route_id, 'sequence': sequence})
+            yield {
+                'type': 'Feature',
+                'id': f"stop-{route_id}-{sequence}",
+                'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+                'properties': properties,
+            }
+
+    def iter_route_lines(self, routes: List[Tuple[int, List[Dict]]], bbox: Tuple = None) -> Iterator[Dict]:
+        """
+        Route LineStrings for (route id, route path) pairs, fetched
+        concurrently. Returns whether every route had a line
+        """
+        complete = True
+        results = get_directions_batch([route_path for _, route_path in routes])
+        for (route_id, route_path), result in zip(routes, results):
+            try:
+                if result.error is not None or not result.route.get('routes'):
+                    raise ValueError(result.error or f"No route returned for {len(route_path)} stops")
+                feature = self.route_line_feature(route_id, result.route['routes'][0], bbox)
+            except Exception:
+                logger.error(f"Skipping route {route_id} in the features stream", exc_info=True)
+                complete = False
+                continue
+            if feature is not None:
+                yield feature
+        return complete
+
+    @staticmethod
+    def route_line_feature(route_id: int, route: Dict, bbox: Tuple = None) -> Dict:
+        if not route.get('geometry'):
+            return None
+        coordinates = decode_polyline(route['geometry'])
+        if bbox is not None and (
+            coordinates[:, 1].max() < bbox[0] or coordinates[:, 1].min() > bbox[2] or
+            coordinates[:, 0].max() < bbox[1] or coordinates[:, 0].min() > bbox[3]
+        ):
+            return None
+        return {
+            'type': 'Feature',
+            'id': f"route-{route_id}",
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': coordinates[:, ::-1].tolist(),
+            },
+            'properties': {
+                'kind': 'route', 'route': route_id,
+                'distance': route.get('distance'), 'duration': route.get('duration'),
+            },
+        }
+
+    def iter_features(self, bbox: Tuple = None, fields: Tuple = STOP_FIELDS,
+                      include_routes: bool = True) -> Iterator[Dict]:
+        # Stops stream as their route is read, route lines follow in batches
+        # fetched concurrently. The 200 is already sent once features flow, a
+        # failing route is logged and skipped so the collection still closes
+        # as valid JSON
+        complete = True
+        pending = []
+        for route_id, route_path in self.get_route_paths(bbox, include_routes):
+            try:
+                yield from self.iter_stop_features(route_id, route_path, fields)
+            except Exception:
+                logger.error(f"Skipping route {route_id} in the features stream", exc_info=True)
+                complete = False
+                continue
+            if include_routes and len(route_path) > 1:
+                pending.append((route_id, route_path))
+            if len(pending) >= ROUTE_LINE_BATCH_SIZE:
+                complete &= yield from self.iter_route_lines(pending, bbox)
+                pending = []
+        if pending:
+            complete &= yield from self.iter_route_lines(pending, bbox)
+        if not complete:
+            record_route_failure(get_customer_id(self.request))
+
+    def stream(self, features: Iterator[Dict]) -> Iterator[bytes]:
+        # Header goes out immediately, then small features are buffered into
+        # larger chunks since one write per feature is dominated by overhead
+        yield b'{"type":"FeatureCollection","features":['
+        buffer = []
+        size = 0
+        separator = ''
+        try:
+            for feature in features:
+                text = separator + json.dumps(feature, separators=(',', ':'))
+                separator = ','
+                buffer.append(text)
+                size += len(text)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield ''.join(buffer).encode('utf-8')
+                    buffer, size = [], 0
+        except Exception:
+            # Loading the route paths failed, end with the features sent so far
+            logger.error("Features stream failed, closing the collection early", exc_info=True)
+            record_route_failure(get_customer_id(self.request))
+        buffer.append(']}')
+        yield ''.join(buffer).encode('utf-8')
+
+    def get(self, request, *args, **kwargs):
+        try:
+            bbox = parse_bbox(request.GET['bbox']) if request.GET.get('bbox') else None
+        except ValueError as e:
+            return JsonResponse({'message': str(e), 'code': 'invalid_bbox'}, status=400)
+
+        fields = STOP_FIELDS
+        if request.GET.get('fields'):
+            fields = tuple(field for field in request.GET['fields'].split(',') if field in STOP_FIELDS)
+        include_routes = request.GET.get('routes', '1') not in ('0', 'false')
+
+        content = self.stream(self.iter_features(bbox=bbox, fields=fields, include_routes=include_routes))
+        gzip = self.accepts_gzip(request)
+        if gzip:
+            content = _gzip_stream(content)
+
+        response = StreamingHttpResponse(content, content_type='application/geo+json')
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+
+class StopVectorTileView(ConditionalGetMixin, View):
+    """
+    Stop Vector Tiles -> `/tiles/{z}/{x}/{y}.mvt` encoded server side and
+    cached per customer, the map only loads what is visible
+    """
+    content_type = 'application/vnd.mapbox-vector-tile'
+    cache_control = {'private': True, 'max_age': 300}
+
+    def get_etag(self, request, z: int, x: int, y: int, *args, **kwargs) -> str:
+        customer_id = get_customer_id(request)
+        version = get_tile_version(customer_id)
+        return make_etag('tile', customer_id, version, z, x, y) if version is not None else None
+
+    def get_stops(self, z: int, x: int, y: int) -> List[Dict]:
+        # Only the stops the tile can draw, its bounds plus the edge buffer and
+        # a pixel for rounding
+        return list(get_customer_stops(self.request, tile_bounds(z, x, y, buffer=DEFAULT_BUFFER + 1)))
+
+    def get(self, request, z: int, x: int, y: int, *args, **kwargs):
+        if z > MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            raise Http404("Tile out of range")
+
+        tile = get_stop_tile(get_customer_id(request), z, x, y, lambda: self.get_stops(z, x, y))
+        if not tile:
+            # Empty tile, map clients treat 204 as nothing to draw
+            return HttpResponse(status=204)
+        return HttpResponse(tile, content_type=self.content_type)
+
+
+class MapClusterView(ConditionalGetMixin, View):
+    """
+    Marker Clusters API -> Clusters with counts and centroids for a bbox and
+    zoom, single stops are returned as is
+
+    Query Parameters
+    -----------
+        bbox str
+            `min_lng,min_lat,max_lng,max_lat`, required
+        zoom float
+            Map zoom, required
+    """
+    cache_control = {'private': True, 'max_age': 60}
+
+    def get_etag(self, request, *args, **kwargs) -> str:
+        customer_id = get_customer_id(request)
+        version = get_tile_version(customer_id)
+        return make_etag('clusters', customer_id, version, request.GET.urlencode()) if version is not None else None
+
+    def load_stops(self, cells: List[str] = None) -> List[Dict]:
+        # Called by the index for the geohash cells it has not loaded yet
+        customer = getattr(self.request, 'customer', None)
+        if customer is None:
+            return get_route_path_json()
+        stops = RouteStop.objects.filter(customer=customer)
+        if cells is not None:
+            stops = stops.within_geohash_cells(cells)
+        return list(stops.values('id', *RouteStopQuerySet.ROUTE_PATH_FIELDS))
+
+    def get(self, request, *args, **kwargs):
+        try:
+            bbox = parse_bbox(request.GET.get('bbox', ''))
+            zoom = float(request.GET['zoom'])
+            if not math.isfinite(zoom):
+                raise ValueError(f"Invalid zoom `{request.GET['zoom']}`")
+        except (KeyError, ValueError) as e:
+            return JsonResponse(
+                {'message': f"bbox and zoom are required: {str(e)}", 'code': 'invalid_request'}, status=400
+            )
+        index = get_cluster_index(get_customer_id(request), self.load_stops, bbox=bbox, zoom=zoom)
+        return JsonResponse({'zoom': zoom, 'results': index.get_clusters(bbox, zoom)})
+
+
+class BasemapTileView(View):
+    """
+    Base Map Tile Proxy -> `/basemap/{mapbox tile path}` served from the shared
+    tile cache, Mapbox is only asked on a miss or once a tile expires
+
+    Disabled (404) unless `settings.MAPBOX_TILE_PROXY_ENABLED`
+    """
+
+    def get(self, request, path: str, *args, **kwargs):
+        if not settings.MAPBOX_TILE_PROXY_ENABLED:
+            raise Http404("Tile proxy disabled")
+        try:
+            tile = get_tile_proxy().get(path)
+        except ValueError:
+            raise Http404("Not a tile")
+        except MapboxError as e:
+            logger.warning(f"Base map tile `{path}` failed: {str(e)}")
+            status = 404 if e.status_code == 404 else 502
+            return HttpResponse(status=status)
+
+        if tile.etag and tile.etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(tile.content, content_type=tile.content_type)
+        if tile.etag:
+            response['ETag'] = tile.etag
+        # Same for every user, the access token never reaches the browser
+        patch_cache_control(response, public=True, max_age=tile.max_age)
+        return response
+
@@ -1,13 +1,30 @@
 from django.conf import settings
+from django.http import Http404, JsonResponse
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control
 from django.views import View
 
+from apps.customer.models import Route, RouteStopQuerySet, get_route_with_stops
+from services.mapbox import get_directions
+from services.mapbox.cache import ROUTE_CACHE_VERSION
+from services.routing import optimize_stop_order
+from utils.geometry import decode_polyline
+from utils.mixins import ConditionalGetMixin, make_etag
+
+import json
 import logging
-import requests
 from typing import Dict, List
 
 logger = logging.getLogger('service')
 
+MAP_TEMPLATE_VERSION = 3 # Bump with template changes so cached pages are not revalidated as current
+
+# Settings that change the stop order or the route geometry `RouteDataView` returns
+ROUTE_DATA_SETTINGS = (
+    'ROUTING_OPTIMIZE_STOP_ORDER', 'ROUTING_ENGINE', 'ROUTING_GRAPH_PATH', 'MAPBOX_SIMPLIFY_TOLERANCE',
+    'MAPBOX_MAX_WAYPOINTS',
+)
+
 
 def get_route_path_json() -> List[Dict]:
     return [
@@ -43,34 +60,98 @@ def get_route_path_json() -> List[Dict]:
         },
     ]
 
-def get_mapbox_response(route_path: Dict) -> Dict:
-    long_lat_str = ';'.join([f"{stop['longitude']},{stop['latitude']}" for stop in route_path])
+def get_route_path(customer=None, route_id=None) -> List[Dict]:
+    """
+    Stops of a customer route in sequence, the sample route when no route is
+    requested, raises Http404 for unknown routes
+    """
+    if customer is None or route_id is None:
+        return get_route_path_json()
+    try:
+        _, stops = get_route_with_stops(route_id, customer)
+    except (Route.DoesNotExist, ValueError):
+        raise Http404("Route not found")
+    return [
+        {field: getattr(stop, field) for field in RouteStopQuerySet.ROUTE_PATH_FIELDS} for stop in stops
+    ]
+
 
-    url = f"https://api.mapbox.com/directions/v5/mapbox/driving/{long_lat_str}?&access_token={settings.MAPBOX_API_KEY}&alternatives=false&exclude=toll&geometries=polyline6&language=en&overview=simplified"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
-    logger.error(
-        f"Failed to fetch Mapbox routing: {str(response.reason)} {str(response.text)}"
-    )
-    return {}
+def get_mapbox_response(route_path: List[Dict]) -> Dict:
+    return get_directions(route_path=route_path)
 
 
-class SampleMapView(View):
+class SampleMapView(ConditionalGetMixin, View):
     """
-    Sample Map View -> Given route render Map with Driving Route Shown, Markers at Each Point    
+    Sample Map View -> Map shell rendered without waiting on routing, the page
+    loads stops and the driving route from `RouteDataView` in parallel
     """
     template_name = 'customer/sample_map.html'
+    cache_control = {'private': True, 'max_age': 300}
+
+    def get_etag(self, request, *args, **kwargs) -> str:
+        # The shell does not depend on the route, only on who is viewing it
+        customer = getattr(request, 'customer', None)
+        return make_etag(
+            MAP_TEMPLATE_VERSION, customer.pk if customer is not None else 'public', settings.MAPBOX_API_KEY,
+            settings.MAPBOX_TILE_PROXY_ENABLED
+        )
 
     def get(self, *args, **kwargs):
-        context = {"MAPBOX_API_KEY": settings.MAPBOX_API_KEY}
+        context = {
+            "MAPBOX_API_KEY": settings.MAPBOX_API_KEY,
+            "MAPBOX_TILE_PROXY_ENABLED": settings.MAPBOX_TILE_PROXY_ENABLED,
+        }
+        return render(self.request, self.template_name, context=context)
 
-        # Dummy function, business logic fetches the route
-        route_path = get_route_path_json()
-        context['route_path'] = route_path
 
-        # Get Map Box Route
-        mapbox_route = get_mapbox_response(route_path=route_path)
-        print(mapbox_route.keys())
+class RouteDataView(ConditionalGetMixin, View):
+    """
+    Route Data API -> Stops and driving route for the map page as JSON
 
-        return render(self.request, self.template_name, context=context)
+    Django 2.2 has no async views, this stays a regular view, the page no
+    longer blocks on it since it is fetched after the shell renders
+
+    Query Parameters
+    -----------
+        route int
+            Route id, defaults to the sample route
+    """
+    cache_control = {'private': True, 'max_age': 60}
+
+    def get_route_path(self) -> List[Dict]:
+        if not hasattr(self, '_route_path'):
+            self._route_path = get_route_path(
+                customer=getattr(self.request, 'customer', None), route_id=self.request.GET.get('route')
+            )
+        return self._route_path
+
+    def get_etag(self, request, *args, **kwargs) -> str:
+        # Every stop field and the routing settings decide the response, a match skips Mapbox
+        customer = getattr(request, 'customer', None)
+        return make_etag(
+            'route_data', customer.pk if customer is not None else 'public', ROUTE_CACHE_VERSION,
+            json.dumps(self.get_route_path(), sort_keys=True, default=str),
+            *(getattr(settings, name) for name in ROUTE_DATA_SETTINGS)
+        )
+
+    def get(self, *args, **kwargs):
+        route_path = self.get_route_path()
+        if settings.ROUTING_OPTIMIZE_STOP_ORDER:
+            # Keep the origin first, resequence the remaining stops
+            route_path = optimize_stop_order(route_path, fix_start=True)
+
+        route = None
+        mapbox_route = get_mapbox_response(route_path=route_path) or {}
+        for directions in mapbox_route.get('routes', [])[:1]:
+            route = {
+                'coordinates': decode_polyline(directions['geometry'])[:, ::-1].tolist()
+                if directions.get('geometry') else [],
+                'distance': directions.get('distance'),
+                'duration': directions.get('duration'),
+            }
+        response = JsonResponse({'route_path': route_path, 'route': route})
+        if route is None and len(route_path) > 1:
+            # Stops only, neither the browser nor a revalidation may keep it
+            logger.warning(f"No route for {len(route_path)} stops, returning stops only")
+            patch_cache_control(response, no_store=True)
+        return response
@@ -5,5 +5,6 @@ from rest_framework_jwt.views import obtain_jwt_token
 
 urlpatterns = [
     path('api/v1/token-auth/', obtain_jwt_token),
+    path('api/v1/customer/', include('apps.customer.api_urls')),
 
 ]
\ No newline at end of file
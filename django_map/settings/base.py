@@ -43,7 +43,7 @@ AUTH_USER_MODEL = "customer.User"
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 LOGIN_URL = '/login/'
-LOGIN_EXEMPT_URLS = ['/static/',] # Requires list of strings
+LOGIN_EXEMPT_URLS = ['/static/', 'metrics$', 'map/route/$', 'basemap/',] # Requires list of strings, the public sample map loads its route and tiles anonymously
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -141,6 +141,9 @@ if USE_REMOTE_FILE_SYSTEM:
     AWS_PRIVATE_MEDIA_LOCATION = f'{AWS_LOCATION}/media/private'
     PRIVATE_FILE_STORAGE = 'utils.storage_backends.PrivateMediaStorage'
 
+    # Base Map Tile Cache
+    AWS_TILE_CACHE_LOCATION = f'{AWS_LOCATION}/tile-cache'
+
 else:
     # Local File Storage
     # Static files (CSS, JavaScript, Images)
@@ -154,6 +157,9 @@ else:
     MEDIA_ROOT = os.path.join(PACKAGE_DIR, 'media')
     MEDIA_URL = '/media/'
 
+    # Base Map Tile Cache
+    TILE_CACHE_ROOT = config('TILE_CACHE_ROOT', cast=str, default=os.path.join(PACKAGE_DIR, 'tile-cache'))
+
 
 # Cache
 REDIS_CONN_STR = config('REDIS_CONN_STR', cast=str, default='')
@@ -176,6 +182,8 @@ RABBITMQ_PORT = config('RABBITMQ_PORT', cast=int, default=5672)
 RABBITMQ_VHOST = config('RABBITMQ_VHOST', cast=str, default='webhookk')
 RABBITMQ_USER = config('RABBITMQ_USER', cast=str, default='guest')
 RABBITMQ_PASS = config('RABBITMQ_PASS', cast=str, default='guest')
+RABBITMQ_ROUTING_QUEUE = config('RABBITMQ_ROUTING_QUEUE', cast=str, default='routing')
+RABBITMQ_PUBLISH_TIMEOUT = config('RABBITMQ_PUBLISH_TIMEOUT', cast=float, default=1) # Seconds a best effort publish from a web request may block
 RABBITMQ_QUEUES = []
 
 # Logging
@@ -247,6 +255,40 @@ LOGGING_LOGGERS = {
 
 # Mapbox Intregration
 MAPBOX_API_KEY = config('MAPBOX_API_KEY', cast=str, default="")
+MAPBOX_API_URL = config('MAPBOX_API_URL', cast=str, default="https://api.mapbox.com")
+MAPBOX_CONNECT_TIMEOUT = config('MAPBOX_CONNECT_TIMEOUT', cast=float, default=3.05)
+MAPBOX_READ_TIMEOUT = config('MAPBOX_READ_TIMEOUT', cast=float, default=10)
+MAPBOX_MAX_RETRIES = config('MAPBOX_MAX_RETRIES', cast=int, default=2)
+MAPBOX_BACKOFF_FACTOR = config('MAPBOX_BACKOFF_FACTOR', cast=float, default=0.5)
+MAPBOX_BACKOFF_MAX = config('MAPBOX_BACKOFF_MAX', cast=float, default=5)
+MAPBOX_POOL_MAXSIZE = config('MAPBOX_POOL_MAXSIZE', cast=int, default=10)
+MAPBOX_BATCH_MAX_WORKERS = config('MAPBOX_BATCH_MAX_WORKERS', cast=int, default=8)
+MAPBOX_MAX_WAYPOINTS = config('MAPBOX_MAX_WAYPOINTS', cast=int, default=25) # Directions API limit per request
+MAPBOX_SIMPLIFY_TOLERANCE = config('MAPBOX_SIMPLIFY_TOLERANCE', cast=float, default=0) # Meters, 0 keeps Mapbox geometry as is
+MAPBOX_MATRIX_MAX_COORDINATES = config('MAPBOX_MATRIX_MAX_COORDINATES', cast=int, default=25) # Matrix API limit per request
+MAPBOX_RATE_LIMIT_ENABLED = config('MAPBOX_RATE_LIMIT_ENABLED', cast=bool, default=True) # Cluster wide token bucket per Mapbox API
+MAPBOX_RATE_LIMIT_WAIT = config('MAPBOX_RATE_LIMIT_WAIT', cast=float, default=1) # Seconds a web request waits for quota
+MAPBOX_RATE_LIMIT_WORKER_WAIT = config('MAPBOX_RATE_LIMIT_WORKER_WAIT', cast=float, default=30) # Seconds the route worker waits for quota
+MAPBOX_RATE_LIMITS_PER_MINUTE = { # Requests per minute per Mapbox API to match the account quotas, 0 is unlimited
+    'directions': config('MAPBOX_DIRECTIONS_RATE_LIMIT', cast=int, default=300),
+    'directions-matrix': config('MAPBOX_MATRIX_RATE_LIMIT', cast=int, default=60),
+    'geocoding': config('MAPBOX_GEOCODING_RATE_LIMIT', cast=int, default=600),
+}
+MAPBOX_GEOCODE_ENDPOINT = config('MAPBOX_GEOCODE_ENDPOINT', cast=str, default='mapbox.places-permanent') # Mapbox only allows storing permanent geocodes
+MAPBOX_GEOCODE_MIN_CONFIDENCE = config('MAPBOX_GEOCODE_MIN_CONFIDENCE', cast=float, default=0.8) # Lower relevance matches are re-geocoded
+MAPBOX_TILE_PROXY_ENABLED = config('MAPBOX_TILE_PROXY_ENABLED', cast=bool, default=False) # Serve base map tiles through /basemap/
+MAPBOX_TILE_CACHE_MAX_BYTES = config('MAPBOX_TILE_CACHE_MAX_BYTES', cast=int, default=1024 ** 3) # LRU eviction above this size
+MAPBOX_TILE_CACHE_DEFAULT_TTL = config('MAPBOX_TILE_CACHE_DEFAULT_TTL', cast=int, default=43200) # Seconds when Mapbox sends no cache headers
+
+# Local Routing (offline road graph, `.npz` or GeoJSON)
+ROUTING_ENGINE = config('ROUTING_ENGINE', cast=str, default='mapbox') # `mapbox` or `local`
+ROUTING_GRAPH_PATH = config('ROUTING_GRAPH_PATH', cast=str, default='')
+ROUTING_OPTIMIZE_STOP_ORDER = config('ROUTING_OPTIMIZE_STOP_ORDER', cast=bool, default=False) # Resequence stops before fetching routes
+
+# Metrics (Prometheus text format at /metrics)
+METRICS_ENABLED = config('METRICS_ENABLED', cast=bool, default=True)
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', cast=float, default=10) # Seconds between flushes to Redis
+METRICS_AUTH_TOKEN = config('METRICS_AUTH_TOKEN', cast=str, default="") # Bearer token for the scrape endpoint, empty disables it
 
 # Customer Integration
 CURRENT_CUSTOMER_INTEGRATION = "STRIPE"
@@ -4,15 +4,23 @@ from django.contrib import admin
 from django.urls import path
 
 from apps.appadmin import views as admin_views
-from apps.customer.views import SampleMapView
+from apps.customer.views import (
+    BasemapTileView, MapClusterView, MapFeaturesGeoJSONView, RouteDataView, SampleMapView, StopVectorTileView
+)
 from .api_urls import urlpatterns as api_urlpatterns
 
 urlpatterns = [
     path('', SampleMapView.as_view(), name='sample_map_view'),
+    path('map/route/', RouteDataView.as_view(), name='map_route_data'),
+    path('map/features.geojson', MapFeaturesGeoJSONView.as_view(), name='map_features_geojson'),
+    path('map/clusters/', MapClusterView.as_view(), name='map_clusters'),
+    path('tiles/<int:z>/<int:x>/<int:y>.mvt', StopVectorTileView.as_view(), name='stop_vector_tile'),
+    path('basemap/<path:path>', BasemapTileView.as_view(), name='basemap_tile'),
     # TemplateView -- input favico
     path('admin/', admin.site.urls),
     path('login/', admin_views.login_user, name='login_user'),
     path('logout/', admin_views.logout_user, name='logout'),
+    path('metrics', admin_views.metrics, name='metrics'),
 ]
 
 urlpatterns += api_urlpatterns
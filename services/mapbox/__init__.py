@@ -0,0 +1,6 @@
+from .batch import RouteResult, get_directions_batch
+from .cache import ROUTE_CACHE, RouteCache, route_cache_key
+from .client import MapboxClient, MapboxError, MapboxRateLimited, get_client
+from .directions import get_directions
+from .geocoding import GeocodeMatch, geocode, geocode_batch
+from .matrix import MatrixResult, get_matrix
@@ -0,0 +1,287 @@
+"""
+Base Map Tile Proxy -> Mapbox tiles served from a shared cache on storage
+
+Tiles are stored through `utils.storage_backends.TileCacheStorage` (local
+disk or object storage) with a JSON sidecar holding the upstream validators
+and expiry. Upstream `Cache-Control` / `Expires` decide freshness, expired
+tiles are revalidated with `If-None-Match` / `If-Modified-Since`, and a stale
+copy is served when Mapbox fails. Total bytes are bounded with LRU eviction,
+tracked in Redis (in process without it), and concurrent misses for one tile
+make a single upstream request.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.utils.http import http_date, parse_http_date_safe
+
+from utils.cache import single_flight
+
+from .client import MapboxError, get_client
+
+from collections import OrderedDict, namedtuple
+from hashlib import sha1
+import json
+import logging
+import re
+import threading
+import time
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger('service')
+
+# Vector and raster tile endpoints only, styles, sprites and glyphs go direct.
+# Names may contain dots but not be only dots, `..` would leave the endpoint
+TILE_PATH_RE = re.compile(
+    r'^(v4/(?!\.+/)[\w.,-]+/\d+/\d+/\d+(@2x)?'
+    r'\.(vector\.pbf|mvt|png|png32|png64|png128|png256|jpg|jpg70|jpg80|jpg90|webp)'
+    r'|styles/v1/(?!\.+/)[\w.-]+/(?!\.+/)[\w.-]+/tiles/(256/|512/)?\d+/\d+/\d+(@2x)?)$'
+)
+STALE_MAX_AGE = 60 # Seconds browsers may keep a tile served stale after an upstream failure
+
+LRU_TOUCH_SCRIPT = """
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return redis.call('INCRBY', KEYS[3], tonumber(ARGV[2]) - (tonumber(old) or 0))
+"""
+
+LRU_EVICT_SCRIPT = """
+local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+local evicted = {}
+while total > tonumber(ARGV[1]) do
+    local popped = redis.call('ZPOPMIN', KEYS[1])
+    if #popped == 0 then
+        break
+    end
+    local size = tonumber(redis.call('HGET', KEYS[2], popped[1]) or '0')
+    redis.call('HDEL', KEYS[2], popped[1])
+    total = redis.call('DECRBY', KEYS[3], size)
+    table.insert(evicted, popped[1])
+end
+return evicted
+"""
+
+BasemapTile = namedtuple('BasemapTile', ['content', 'content_type', 'max_age', 'etag'])
+
+
+class TileLRUIndex(object):
+    """
+    Recency and size of every cached tile, shared through Redis when the
+    cache is django-redis, in process otherwise
+    """
+
+    def __init__(self, name: str = 'basemap'):
+        self.keys = [cache.make_key(f"{name}:lru"), cache.make_key(f"{name}:sizes"), cache.make_key(f"{name}:bytes")]
+        self._scripts = None
+        self._local = OrderedDict()
+        self._local_bytes = 0
+        self._lock = threading.Lock()
+
+    def _redis_scripts(self):
+        if self._scripts is None:
+            try:
+                from django_redis import get_redis_connection
+                redis = get_redis_connection('default')
+                self._scripts = (
+                    redis, redis.register_script(LRU_TOUCH_SCRIPT), redis.register_script(LRU_EVICT_SCRIPT)
+                )
+            except Exception:
+                # Not a redis cache, keep the index in process
+                self._scripts = False
+        return self._scripts
+
+    def add(self, name: str, size: int) -> int:
+        """
+        Record a stored tile, returns the total bytes cached
+        """
+        scripts = self._redis_scripts()
+        if scripts:
+            return int(scripts[1](keys=self.keys, args=[name, size, time.time()]))
+        with self._lock:
+            self._local_bytes += size - self._local.pop(name, 0)
+            self._local[name] = size
+            return self._local_bytes
+
+    def touch(self, name: str):
+        scripts = self._redis_scripts()
+        if scripts:
+            # XX, only tiles still in the index, an evicted one is not revived
+            scripts[0].zadd(self.keys[0], {name: time.time()}, xx=True)
+            return
+        with self._lock:
+            if name in self._local:
+                self._local.move_to_end(name)
+
+    def evict(self, max_bytes: int) -> List[str]:
+        """
+        Drop least recently used tiles until at most `max_bytes` remain,
+        returns their names for the caller to delete
+        """
+        scripts = self._redis_scripts()
+        if scripts:
+            return [name.decode('utf-8') for name in scripts[2](keys=self.keys, args=[max_bytes])]
+        evicted = []
+        with self._lock:
+            while self._local_bytes > max_bytes and self._local:
+                name, size = self._local.popitem(last=False)
+                self._local_bytes -= size
+                evicted.append(name)
+        return evicted
+
+
+def parse_max_age(headers: Dict, default: int) -> int:
+    """
+    Seconds a shared cache may keep a response, 0 when it must not be stored
+    """
+    directives = {}
+    for part in headers.get('Cache-Control', '').split(','):
+        key, _, value = part.strip().partition('=')
+        if key:
+            directives[key.lower()] = value.strip('"')
+    if 'no-store' in directives or 'private' in directives:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in directives:
+            try:
+                return max(0, int(directives[directive]))
+            except ValueError:
+                pass
+    expires = parse_http_date_safe(headers.get('Expires', '')) if headers.get('Expires') else None
+    if expires is not None:
+        return max(0, int(expires - time.time()))
+    return default
+
+
+class TileProxy(object):
+    """
+    Parameters
+    -----------
+        storage Storage
+            Django storage for tiles and sidecars, defaults to `TileCacheStorage()`
+        max_bytes int
+            Cache size bound, defaults to `settings.MAPBOX_TILE_CACHE_MAX_BYTES`
+        default_ttl int
+            Freshness when upstream sends no cache headers, defaults to
+            `settings.MAPBOX_TILE_CACHE_DEFAULT_TTL`
+    """
+
+    def __init__(self, storage=None, max_bytes: int = None, default_ttl: int = None, index: TileLRUIndex = None):
+        if storage is None:
+            # Imported here, the storage backends read settings at import and
+            # this module loads with the URLconf even when the proxy is off
+            from utils.storage_backends import TileCacheStorage
+            storage = TileCacheStorage()
+        self.storage = storage
+        self.max_bytes = max_bytes if max_bytes is not None else settings.MAPBOX_TILE_CACHE_MAX_BYTES
+        self.default_ttl = default_ttl if default_ttl is not None else settings.MAPBOX_TILE_CACHE_DEFAULT_TTL
+        self.index = index if index is not None else TileLRUIndex()
+
+    @staticmethod
+    def storage_name(path: str) -> str:
+        digest = sha1(path.encode('utf-8')).hexdigest()
+        return f"tiles/{digest[:2]}/{digest}"
+
+    def _read_meta(self, name: str) -> Dict:
+        try:
+            with self.storage.open(f"{name}.json") as sidecar:
+                return json.loads(sidecar.read())
+        except (OSError, ValueError):
+            return None
+
+    def _read(self, name: str, meta: Dict) -> BasemapTile:
+        try:
+            with self.storage.open(name) as tile:
+                content = tile.read()
+        except OSError:
+            return None
+        if len(content) != meta.get('size'):
+            # Tile rewritten between the sidecar and the data read
+            return None
+        return BasemapTile(
+            content, meta['content_type'], max(0, int(meta['expires'] - time.time())), meta.get('etag')
+        )
+
+    def _write(self, name: str, content: bytes, meta: Dict):
+        self.storage.save(name, ContentFile(content))
+        self.storage.save(f"{name}.json", ContentFile(json.dumps(meta).encode('utf-8')))
+        total = self.index.add(name, len(content))
+        if total > self.max_bytes:
+            for evicted in self.index.evict(self.max_bytes):
+                self._delete(evicted)
+
+    def _delete(self, name: str):
+        for storage_name in (f"{name}.json", name):
+            try:
+                self.storage.delete(storage_name)
+            except OSError:
+                logger.warning(f"Failed to delete cached tile `{storage_name}`", exc_info=True)
+
+    def _lookup(self, name: str) -> Tuple[bool, BasemapTile]:
+        meta = self._read_meta(name)
+        if meta is None or meta['expires'] <= time.time():
+            return False, None
+        tile = self._read(name, meta)
+        return tile is not None, tile
+
+    def get(self, path: str) -> BasemapTile:
+        """
+        Tile for an upstream path (e.g. `v4/mapbox.mapbox-streets-v8/14/4823/6160.vector.pbf`)
+
+        Raises ValueError for paths that are not tiles and `MapboxError` when
+        upstream fails and nothing is cached
+        """
+        if not TILE_PATH_RE.match(path):
+            raise ValueError(f"Not a tile path `{path}`")
+        name = self.storage_name(path)
+        found, tile = self._lookup(name)
+        if found:
+            self.index.touch(name)
+            return tile
+        return single_flight(f"basemap:{name}", lambda: self._fetch(path, name), lambda: self._lookup(name))
+
+    def _fetch(self, path: str, name: str) -> BasemapTile:
+        meta = self._read_meta(name)
+        stale = self._read(name, meta) if meta is not None else None
+        headers = {}
+        if stale is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = get_client().request(path, headers=headers)
+        except MapboxError:
+            if stale is None:
+                raise
+            logger.warning(f"Serving stale tile `{path}`", exc_info=True)
+            return stale._replace(max_age=STALE_MAX_AGE)
+
+        max_age = parse_max_age(response.headers, self.default_ttl)
+        if response.status_code == 304 and stale is not None:
+            # Still valid, only the expiry moves
+            meta['expires'] = time.time() + max_age
+            self.storage.save(f"{name}.json", ContentFile(json.dumps(meta).encode('utf-8')))
+            self.index.touch(name)
+            return stale._replace(max_age=max_age)
+
+        content = response.content
+        content_type = response.headers.get('Content-Type', 'application/octet-stream')
+        etag = response.headers.get('ETag')
+        if max_age > 0:
+            self._write(name, content, {
+                'path': path, 'size': len(content), 'content_type': content_type,
+                'expires': time.time() + max_age, 'etag': etag,
+                'last_modified': response.headers.get('Last-Modified') or http_date(),
+            })
+        return BasemapTile(content, content_type, max_age, etag)
+
+
+_proxy = None
+
+
+def get_tile_proxy() -> TileProxy:
+    global _proxy
+    if _proxy is None:
+        _proxy = TileProxy()
+    return _proxy
@@ -0,0 +1,87 @@
+"""
+Batch Routing -> Fetch directions for many route paths concurrently
+"""
+from django.conf import settings
+
+from .cache import route_cache_key
+from .directions import DEFAULT_EXCLUDE, DEFAULT_OVERVIEW, DEFAULT_PROFILE, get_directions
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from typing import Dict, List
+
+logger = logging.getLogger('service')
+
+RouteResult = namedtuple("RouteResult", [
+    'route',  # Mapbox Directions response, empty dict on failure
+    'error',  # None on success, otherwise a short error message
+])
+
+
+def get_directions_batch(route_paths: List[List[Dict]],
+                         profile: str = DEFAULT_PROFILE,
+                         exclude: str = DEFAULT_EXCLUDE,
+                         overview: str = DEFAULT_OVERVIEW,
+                         max_workers: int = None) -> List[RouteResult]:
+    """
+    Directions for many route paths using a bounded thread pool
+
+    Identical route paths (after cache key normalization) are fetched once.
+    A failure on one route is reported in its `RouteResult` and does not fail
+    the batch.
+
+    Parameters
+    -----------
+        route_paths list
+            List of route paths, each an ordered list of stops
+        max_workers int
+            Concurrent upstream requests, defaults to `settings.MAPBOX_BATCH_MAX_WORKERS`
+    Returns
+    -----------
+        results list
+            `RouteResult` per route path, in input order
+    """
+    if max_workers is None:
+        max_workers = settings.MAPBOX_BATCH_MAX_WORKERS
+
+    options = {'profile': profile, 'exclude': exclude, 'overview': overview}
+
+    # Deduplicate, keeping the first route path seen for each key. A route path
+    # that can not be keyed (missing or malformed coordinates) fails alone
+    keys = []
+    unique = {}
+    invalid = {}
+    for index, route_path in enumerate(route_paths):
+        try:
+            key = route_cache_key(route_path, **options)
+        except Exception as e:
+            logger.error(
+                f"Batch route {index} is invalid", exc_info=True, extra={'task': 'DirectionsBatch'}
+            )
+            invalid[index] = RouteResult(route={}, error=str(e) or e.__class__.__name__)
+            key = None
+        else:
+            unique.setdefault(key, route_path)
+        keys.append(key)
+
+    def fetch(key: str) -> RouteResult:
+        try:
+            # This pool is the concurrency bound, each route fetches its legs in turn
+            route = get_directions(unique[key], max_workers=1, **options)
+        except Exception as e:
+            logger.error(
+                f"Batch route `{key}` failed", exc_info=True, extra={'task': 'DirectionsBatch'}
+            )
+            return RouteResult(route={}, error=str(e) or e.__class__.__name__)
+        if not route:
+            return RouteResult(route={}, error='No route returned')
+        return RouteResult(route=route, error=None)
+
+    results = {}
+    if unique:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique)))) as executor:
+            for key, result in zip(unique, executor.map(fetch, unique)):
+                results[key] = result
+
+    return [invalid[index] if key is None else results[key] for index, key in enumerate(keys)]
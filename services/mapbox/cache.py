@@ -0,0 +1,314 @@
+"""
+Route Cache -> Two tier cache for Mapbox routing responses
+
+An in-process LRU sits in front of the shared Django (Redis) cache so repeated
+map views for the same stops are served without a network round trip. The
+shared cache holds responses in the compact binary form of `codec`, hits from
+it stay a `RouteView` over the cached bytes until a caller needs the response.
+The view builds that response once, local hits after that reuse it.
+"""
+from django.core.cache import cache
+
+from utils import metrics
+from utils.cache import MINUTE, DAY, WEEK, single_flight
+
+from .codec import RouteView, encode_route, is_encoded_route
+
+from collections import OrderedDict
+from hashlib import sha1
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple, Union
+
+logger = logging.getLogger('service')
+
+ROUTE_CACHE_PREFIX = 'mapbox_route'
+ROUTE_CACHE_VERSION = 3
+ROUTE_CACHE_TTL = DAY
+ROUTE_CACHE_NEGATIVE_TTL = MINUTE * 5
+ROUTE_CACHE_LOCAL_TTL = MINUTE * 10
+ROUTE_CACHE_LOCAL_MAX_SIZE = 512
+ROUTE_CACHE_STALE_TTL = WEEK # Last good copy, served when Mapbox fails or we are over quota
+ROUTE_FETCH_LOCK_TTL = 30
+ROUTE_FETCH_WAIT = 10
+
+# 5 decimal places ~ 1.1 meters, finer precision only fragments the cache
+COORDINATE_PRECISION = 5
+
+
+def pack_route(value: Union[Dict, RouteView]):
+    """
+    Shared cache form of a response, the binary route codec when it round
+    trips exactly, the response itself otherwise
+    """
+    if isinstance(value, RouteView):
+        return bytes(value.buffer)
+    if not value:
+        return value
+    return encode_route(value) or value
+
+
+def unpack_route(value) -> Union[Dict, RouteView]:
+    """
+    Cached form of a shared cache value, a `RouteView` over encoded routes
+    """
+    return RouteView(value) if is_encoded_route(value) else value
+
+
+def route_response(value: Union[Dict, RouteView]) -> Dict:
+    return value.to_response() if isinstance(value, RouteView) else value
+
+
+def route_cache_key(route_path: List[Dict], **options) -> str:
+    """
+    Canonical cache key for a route request
+
+    Parameters
+    -----------
+        route_path list
+            Ordered stops, each with `latitude` and `longitude`
+        options kwargs
+            Routing options (profile, exclude, overview, ...) that change the response
+    Returns
+    -----------
+        key str
+            Cache key, stable for the same rounded stops and options
+    """
+    stops = [
+        [round(float(stop['longitude']), COORDINATE_PRECISION),
+         round(float(stop['latitude']), COORDINATE_PRECISION)]
+        for stop in route_path
+    ]
+    payload = json.dumps(
+        {'stops': stops, 'options': options}, sort_keys=True, separators=(',', ':')
+    )
+    digest = sha1(payload.encode('utf-8')).hexdigest()
+    return f"{ROUTE_CACHE_PREFIX}:v{ROUTE_CACHE_VERSION}:{digest}"
+
+
+class LocalLRUCache(object):
+    """
+    Thread safe in-process LRU with per entry expiry
+    """
+
+    def __init__(self, max_size: int = ROUTE_CACHE_LOCAL_MAX_SIZE, ttl: int = ROUTE_CACHE_LOCAL_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, object]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key: str, value: object, ttl: int = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RouteCache(object):
+    """
+    Two tier route cache, local LRU first then the shared Django cache
+
+    Failed lookups are cached as an empty dict for a short TTL (negative
+    caching) so an outage does not turn every page view into an upstream call.
+    Every stored response also keeps a long lived stale copy that is served
+    when a refetch fails. Concurrent misses for one key are coalesced so only
+    one caller in the cluster fetches.
+    """
+
+    def __init__(self,
+                 ttl: int = ROUTE_CACHE_TTL,
+                 negative_ttl: int = ROUTE_CACHE_NEGATIVE_TTL,
+                 stale_ttl: int = ROUTE_CACHE_STALE_TTL,
+                 local_cache: LocalLRUCache = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.local = local_cache if local_cache is not None else LocalLRUCache()
+        self._counters = {
+            'local_hit': 0, 'remote_hit': 0, 'negative_hit': 0, 'stale_hit': 0, 'miss': 0,
+            'deferred': 0, 'error': 0
+        }
+        self._counter_lock = threading.Lock()
+
+    def _incr(self, counter: str):
+        with self._counter_lock:
+            self._counters[counter] += 1
+        metrics.incr('route_cache_total', result=counter)
+
+    def stats(self) -> Dict:
+        with self._counter_lock:
+            return dict(self._counters)
+
+    def reset_stats(self):
+        with self._counter_lock:
+            for counter in self._counters:
+                self._counters[counter] = 0
+
+    def _get_remote(self, key: str) -> Tuple[bool, Union[Dict, RouteView]]:
+        try:
+            value = unpack_route(cache.get(key, None))
+        except Exception:
+            # Shared cache outage should degrade to a miss, not an error page
+            logger.warning(f"Route cache read failed for `{key}`", exc_info=True)
+            self._incr('error')
+            return False, None
+        if value is None:
+            return False, None
+        self.local.set(key, value, self.negative_ttl if not value else None)
+        return True, value
+
+    def get(self, key: str, decode: bool = True) -> Tuple[bool, Union[Dict, RouteView]]:
+        """
+        (found, value), `decode=False` leaves encoded routes a `RouteView` for
+        callers that only read its distance, duration or geometry tables
+        """
+        found, value = self.local.get(key)
+        if not found:
+            found, value = self._get_remote(key)
+            if not found:
+                self._incr('miss')
+                return False, None
+            self._incr('negative_hit' if not value else 'remote_hit')
+        else:
+            self._incr('negative_hit' if not value else 'local_hit')
+        return True, route_response(value) if decode else value
+
+    def get_many(self, keys: List[str]) -> Dict[str, Union[Dict, RouteView]]:
+        """
+        {key: value} of the keys found, keys missing locally are read from
+        the shared cache in one round trip. Values are in their cached form,
+        encoded routes stay a `RouteView` (see `route_response`)
+        """
+        found = {}
+        remote_keys = []
+        for key in keys:
+            hit, value = self.local.get(key)
+            if hit:
+                self._incr('negative_hit' if not value else 'local_hit')
+                found[key] = value
+            else:
+                remote_keys.append(key)
+        if not remote_keys:
+            return found
+
+        try:
+            values = {key: unpack_route(value) for key, value in cache.get_many(remote_keys).items()}
+        except Exception:
+            logger.warning(f"Route cache read failed for {len(remote_keys)} keys", exc_info=True)
+            self._incr('error')
+            values = {}
+        for key in remote_keys:
+            value = values.get(key)
+            if value is None:
+                self._incr('miss')
+                continue
+            self.local.set(key, value, self.negative_ttl if not value else None)
+            self._incr('negative_hit' if not value else 'remote_hit')
+            found[key] = value
+        return found
+
+    @staticmethod
+    def _stale_key(key: str) -> str:
+        return f"stale:{key}"
+
+    def get_stale(self, key: str) -> Union[Dict, RouteView]:
+        try:
+            return unpack_route(cache.get(self._stale_key(key))) or None
+        except Exception:
+            logger.warning(f"Route cache stale read failed for `{key}`", exc_info=True)
+            self._incr('error')
+            return None
+
+    def set(self, key: str, value: Union[Dict, RouteView], ttl: int = None, keep_stale: bool = True):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, ttl)
+        try:
+            packed = pack_route(value)
+            cache.set(key, packed, ttl)
+            if value and keep_stale:
+                cache.set(self._stale_key(key), packed, max(ttl, self.stale_ttl))
+        except Exception:
+            logger.warning(f"Route cache write failed for `{key}`", exc_info=True)
+            self._incr('error')
+
+    def set_negative(self, key: str):
+        self.set(key, {}, self.negative_ttl)
+
+    def delete(self, key: str):
+        self.local.delete(key)
+        try:
+            cache.delete(key)
+        except Exception:
+            logger.warning(f"Route cache delete failed for `{key}`", exc_info=True)
+            self._incr('error')
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Dict]) -> Dict:
+        """
+        Return the cached response for `key`, calling `fetch` on a miss
+
+        `fetch` returns the response dict, an empty dict marks a failure and
+        is negatively cached, None marks a deferred fetch (e.g. over quota)
+        that is not cached. Either way the stale copy is served if one exists.
+        """
+        found, value = self.get(key)
+        if found:
+            return value
+        return route_response(single_flight(
+            key, lambda: self._fetch(key, fetch), lambda: self._get_remote(key),
+            lock_ttl=ROUTE_FETCH_LOCK_TTL, wait=ROUTE_FETCH_WAIT
+        ))
+
+    def _fetch(self, key: str, fetch: Callable[[], Dict]) -> Dict:
+        return self.resolve(key, fetch())
+
+    def resolve(self, key: str, value: Dict) -> Dict:
+        """
+        Store a freshly fetched value and return what callers should get, the
+        stale copy when the fetch failed (empty dict) or was deferred (None)
+        """
+        if value:
+            self.set(key, value)
+            return value
+
+        if value is None:
+            self._incr('deferred')
+        stale = self.get_stale(key)
+        if stale:
+            # Serve the last good copy cluster wide until the negative TTL runs
+            # out, without extending the life of the stale copy itself
+            self._incr('stale_hit')
+            self.set(key, stale, self.negative_ttl, keep_stale=False)
+            return route_response(stale)
+        if value is not None:
+            self.set_negative(key)
+        return {}
+
+
+ROUTE_CACHE = RouteCache()
@@ -0,0 +1,219 @@
+"""
+Mapbox HTTP Client -> Pooled keep-alive session with timeouts and bounded retries
+"""
+from django.conf import settings
+
+from utils import metrics
+from utils.ratelimit import TokenBucket
+
+import logging
+import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict
+from urllib.parse import quote
+
+logger = logging.getLogger('service')
+
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+class MapboxError(Exception):
+    def __init__(self, message: str, status_code: int = None, response_text: str = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response_text = response_text
+
+
+class MapboxRateLimited(MapboxError):
+    """
+    Our own quota limiter refused the call, nothing was sent upstream
+    """
+
+
+class MapboxClient(object):
+    """
+    Mapbox API client built on a single pooled `requests.Session`
+
+    Parameters
+    -----------
+        access_token str
+            Mapbox access token, defaults to `settings.MAPBOX_API_KEY`
+        base_url str
+            API root, overridable to point at a local stub server
+        connect_timeout float
+            Seconds to wait for the TCP/TLS connection
+        read_timeout float
+            Seconds to wait between bytes of the response
+        max_retries int
+            Retries after the first attempt on 429/5xx and connection errors
+        backoff_factor float
+            Base seconds for exponential backoff, full jitter is applied
+        backoff_max float
+            Cap on a single backoff (and on an honored `Retry-After`)
+        pool_maxsize int
+            Keep-alive connections held per host
+        rate_limit_wait float
+            Seconds a call may wait for the cluster wide quota before raising
+            `MapboxRateLimited`, defaults to `settings.MAPBOX_RATE_LIMIT_WAIT`
+    """
+
+    def __init__(self,
+                 access_token: str = None,
+                 base_url: str = None,
+                 connect_timeout: float = None,
+                 read_timeout: float = None,
+                 max_retries: int = None,
+                 backoff_factor: float = None,
+                 backoff_max: float = None,
+                 pool_maxsize: int = None,
+                 rate_limit_wait: float = None):
+        self.access_token = access_token if access_token is not None else settings.MAPBOX_API_KEY
+        self.base_url = (base_url or settings.MAPBOX_API_URL).rstrip('/')
+        self.connect_timeout = connect_timeout if connect_timeout is not None else settings.MAPBOX_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout if read_timeout is not None else settings.MAPBOX_READ_TIMEOUT
+        self.max_retries = max_retries if max_retries is not None else settings.MAPBOX_MAX_RETRIES
+        self.backoff_factor = backoff_factor if backoff_factor is not None else settings.MAPBOX_BACKOFF_FACTOR
+        self.backoff_max = backoff_max if backoff_max is not None else settings.MAPBOX_BACKOFF_MAX
+        self.pool_maxsize = pool_maxsize if pool_maxsize is not None else settings.MAPBOX_POOL_MAXSIZE
+        self.rate_limit_wait = rate_limit_wait if rate_limit_wait is not None else settings.MAPBOX_RATE_LIMIT_WAIT
+        self.rate_limits = {
+            api: TokenBucket(f"mapbox:{api}", rate)
+            for api, rate in settings.MAPBOX_RATE_LIMITS_PER_MINUTE.items() if rate > 0
+        } if settings.MAPBOX_RATE_LIMIT_ENABLED else {}
+        self.session = self._build_session()
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        # Retries are handled in `request` so Retry-After and jitter are honored
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+
+    def _retry_after(self, response: requests.Response) -> float:
+        retry_after = response.headers.get('Retry-After')
+        if not retry_after:
+            return None
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0), self.backoff_max)
+
+    @staticmethod
+    def _record(api: str, status, start: float, response: requests.Response = None):
+        # One sample per attempt, so retries show up in the latency and status counts
+        metrics.observe('mapbox_request_seconds', time.monotonic() - start, api=api)
+        metrics.incr('mapbox_requests_total', api=api, status=status)
+        if response is not None:
+            metrics.observe(
+                'mapbox_response_bytes', len(response.content), buckets=metrics.SIZE_BUCKETS, api=api
+            )
+
+    def request(self, path: str, params: Dict = None, headers: Dict = None) -> requests.Response:
+        """
+        GET `path` relative to the API root, retrying 429/5xx and connection
+        errors within the retry budget
+
+        Raises `MapboxError` once the budget is spent or on any other non 200
+        (304 is returned too, it only answers conditional `headers`),
+        `MapboxRateLimited` when the quota has no room within `rate_limit_wait`
+        """
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        api = path.lstrip('/').split('/', 1)[0]
+        bucket = self.rate_limits.get(api)
+        params = dict(params or {})
+        params['access_token'] = self.access_token
+
+        attempt = 0
+        while True:
+            if bucket is not None and not bucket.wait(self.rate_limit_wait):
+                metrics.incr('mapbox_requests_total', api=api, status='rate_limited')
+                raise MapboxRateLimited(f"Mapbox quota `{bucket.name}` exhausted", status_code=429)
+            start = time.monotonic()
+            try:
+                response = self.session.get(
+                    url, params=params, headers=headers, timeout=(self.connect_timeout, self.read_timeout)
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(api, 'timeout' if isinstance(e, requests.Timeout) else 'connection_error', start)
+                if attempt >= self.max_retries:
+                    raise MapboxError(f"Mapbox request failed: {str(e)}") from e
+                delay = self._backoff(attempt)
+                logger.warning(
+                    f"Mapbox connection error, retry {attempt + 1}/{self.max_retries} in {delay:.2f}s",
+                    extra={'task': 'MapboxClient'}
+                )
+            else:
+                self._record(api, response.status_code, start, response)
+                if response.status_code in (200, 304):
+                    return response
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise MapboxError(
+                        f"Mapbox request failed: {response.status_code} {str(response.reason)}",
+                        status_code=response.status_code, response_text=response.text
+                    )
+                retry_after = self._retry_after(response)
+                delay = retry_after if retry_after is not None else self._backoff(attempt)
+                logger.warning(
+                    f"Mapbox responded {response.status_code}, retry {attempt + 1}/{self.max_retries} in {delay:.2f}s",
+                    extra={'task': 'MapboxClient'}
+                )
+            time.sleep(delay)
+            attempt += 1
+
+    def get_json(self, path: str, params: Dict = None) -> Dict:
+        return self.request(path, params=params).json()
+
+    def directions(self, coordinates: str, profile: str = 'driving', **params) -> Dict:
+        """
+        Directions API, `coordinates` is the `lng,lat;lng,lat` path segment
+        """
+        return self.get_json(f"directions/v5/mapbox/{profile}/{coordinates}", params=params)
+
+    def matrix(self, coordinates: str, profile: str = 'driving', **params) -> Dict:
+        """
+        Matrix API, `coordinates` is the `lng,lat;lng,lat` path segment
+        """
+        return self.get_json(f"directions-matrix/v1/mapbox/{profile}/{coordinates}", params=params)
+
+    def geocode(self, query: str, endpoint: str = 'mapbox.places', **params) -> Dict:
+        """
+        Forward Geocoding API, `query` is a free form address. Results that are
+        stored must come from the `mapbox.places-permanent` endpoint
+        """
+        return self.get_json(f"geocoding/v5/{endpoint}/{quote(query, safe='')}.json", params=params)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> MapboxClient:
+    """
+    Process wide client, rebuilt after a fork so workers never share sockets
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = MapboxClient()
+                _client_pid = pid
+    return _client
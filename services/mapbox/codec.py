@@ -0,0 +1,356 @@
+"""
+Route Codec -> Compact binary form of a Directions response for the cache
+
+Layout, little endian, float tables are 8 byte aligned:
+    header      magic, flags, table lengths and the section lengths
+    route       3 float64 (distance, duration, weight)
+    legs        n_legs x 3 float64 (distance, duration, weight)
+    waypoints   n_waypoints x 3 float64 (longitude, latitude, snap distance)
+    ints        1 + n_legs + n_waypoints uint8, bit i set when column i of
+                that row was an integer in the response
+    geometry    n_coords x 2 polyline6 deltas (the first row absolute) as
+                zigzag varints, zlib compressed when that is smaller
+    extras      compact JSON of everything else (code, names, summaries, ...),
+                zlib compressed when that is smaller
+
+Leg `steps` stay in the extras rather than getting tables of their own,
+directions are requested without `steps=true` so every leg carries an empty
+list. The geometry is the bulk of a response, a varint takes one or two bytes
+for the deltas between neighbouring vertices where the polyline text takes
+two to four characters.
+
+NaN marks a number missing from the response. Number tables are
+`np.frombuffer` views over the cached bytes, so reading distances or
+durations on a hit needs neither a copy nor a JSON parse. The geometry is
+decoded on the first `polyline_deltas` of a view, in one vectorized pass,
+`legs.stitch_directions` reads cached legs this way. The response itself is
+only built on the first `to_response` of a view and shared by later calls.
+Responses the layout can not reproduce exactly (alternatives, GeoJSON or
+non canonical polyline geometry, ...) are not encoded.
+"""
+from utils.geometry import encode_polyline_deltas, polyline_deltas
+
+import json
+import math
+import numpy as np
+import struct
+from typing import Dict, List
+import zlib
+
+MAGIC = b'MBR3'
+# magic, flags, n_coords, n_legs, n_waypoints, geometry length, extras length, padded to 8 bytes
+HEADER = struct.Struct('<4sH2xIIIII4x')
+
+FLAG_GEOMETRY = 1
+FLAG_LEGS = 2
+FLAG_WAYPOINTS = 4
+FLAG_EXTRAS_ZLIB = 8
+FLAG_GEOMETRY_ZLIB = 16
+
+NUMBER_FIELDS = ('distance', 'duration', 'weight')
+WAYPOINT_FIELDS = ('location', 'distance')
+
+_FLOAT = np.dtype('<f8')
+# Larger than any polyline6 delta on the globe, at most 5 varint bytes
+MAX_DELTA = 2 ** 31
+# Integers above this do not survive the float64 tables
+MAX_EXACT_INT = 2 ** 53
+
+
+def _number(item: Dict, field: str) -> float:
+    value = item.get(field)
+    if value is None:
+        if field in item:
+            # Explicit null can not be told apart from a missing key
+            raise ValueError(f"`{field}` is null")
+        return math.nan
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"`{field}` is not a number")
+    if isinstance(value, int) and abs(value) > MAX_EXACT_INT:
+        raise OverflowError(f"`{field}` does not fit a float64")
+    return float(value)
+
+
+def _location(waypoint: Dict) -> List[float]:
+    location = waypoint['location']
+    if not isinstance(location, list) or len(location) != 2:
+        raise ValueError("Waypoint location is not [longitude, latitude]")
+    return [_number({'value': value}, 'value') for value in location]
+
+
+def _int_bits(values: List) -> int:
+    return sum(1 << index for index, value in enumerate(values) if type(value) is int)
+
+
+def _typed(value: float, bits: int, index: int):
+    return int(value) if bits >> index & 1 else value
+
+
+def _varint_lengths(values: np.ndarray, bits: int) -> np.ndarray:
+    # Chunks of `bits` needed for each non negative value, at least one
+    return np.maximum(1, np.floor(np.log2(np.maximum(values, 1))).astype(np.int64) // bits + 1)
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    return (values << 1) ^ (values >> 63)
+
+
+def encode_varints(values) -> bytes:
+    """
+    Zigzag LEB128 varints of signed integers, 7 bits per byte with the high
+    bit set on every byte but the last of a value
+    """
+    values = _zigzag(np.asarray(values, dtype=np.int64).ravel())
+    if values.size == 0:
+        return b''
+    shifts = 7 * np.arange(5)
+    chunks = (values[:, None] >> shifts) & 0x7f
+    lengths = _varint_lengths(values, 7)
+    chunks = chunks | ((np.arange(5) < (lengths - 1)[:, None]) * 0x80)
+    return chunks[np.arange(5) < lengths[:, None]].astype(np.uint8).tobytes()
+
+
+def decode_varints(data) -> np.ndarray:
+    """
+    Signed integers from `encode_varints` output, vectorized over the buffer
+    """
+    chunks = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    if chunks.size == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(chunks < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(chunks.size) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((chunks & 0x7f) << (7 * position), starts)
+    return (values >> 1) ^ -(values & 1)
+
+
+def _is_canonical_polyline(polyline: str, deltas: np.ndarray) -> bool:
+    # Re-encoding gives back the same text only when every character is a
+    # polyline chunk and every value uses its shortest encoding, checked
+    # without building the string
+    chunks = np.frombuffer(polyline.encode('ascii'), dtype=np.uint8)
+    if chunks.size and (chunks.min() < 63 or chunks.max() > 126):
+        return False
+    return int(_varint_lengths(_zigzag(deltas.ravel()), 5).sum()) == len(polyline)
+
+
+def _set_numbers(item: Dict, row: List[float], bits: int, fields=NUMBER_FIELDS) -> Dict:
+    for index, (field, value) in enumerate(zip(fields, row)):
+        if not math.isnan(value):
+            item[field] = _typed(value, bits, index)
+    return item
+
+
+class RouteView(object):
+    """
+    Read only view over an encoded route, the tables share memory with `data`
+
+    Parameters
+    -----------
+        data bytes
+            Output of `encode_route`
+    """
+
+    def __init__(self, data: bytes):
+        self.buffer = memoryview(data)
+        magic, self.flags, n_coords, n_legs, n_waypoints, geometry_length, extras_length = HEADER.unpack_from(
+            self.buffer
+        )
+        if magic != MAGIC:
+            raise ValueError("Not an encoded route")
+
+        offset = HEADER.size
+        self.route = np.frombuffer(self.buffer, _FLOAT, len(NUMBER_FIELDS), offset)
+        offset += self.route.nbytes
+        self.legs = np.frombuffer(self.buffer, _FLOAT, n_legs * 3, offset).reshape(n_legs, 3)
+        offset += self.legs.nbytes
+        self.waypoints = np.frombuffer(self.buffer, _FLOAT, n_waypoints * 3, offset).reshape(n_waypoints, 3)
+        offset += self.waypoints.nbytes
+        self.ints = np.frombuffer(self.buffer, np.uint8, 1 + n_legs + n_waypoints, offset)
+        offset += self.ints.nbytes
+        self.n_coords = n_coords
+        self._geometry = self.buffer[offset:offset + geometry_length]
+        offset += geometry_length
+        self._extras = self.buffer[offset:offset + extras_length]
+        self._deltas = None
+        self._responses = {}
+
+    @property
+    def distance(self) -> float:
+        return float(self.route[0])
+
+    @property
+    def duration(self) -> float:
+        return float(self.route[1])
+
+    def coordinates(self, precision: int = 6) -> np.ndarray:
+        """
+        Route geometry as (n, 2) [lat, lng], same as `decode_polyline`
+        """
+        return np.cumsum(self.polyline_deltas(), axis=0) / 10 ** precision
+
+    def polyline_deltas(self) -> np.ndarray:
+        """
+        Route geometry as integer deltas, same as `polyline_deltas` of the
+        encoded polyline. Decoded once per view, callers must not modify it
+        """
+        if self._deltas is None:
+            geometry = self._geometry
+            if self.flags & FLAG_GEOMETRY_ZLIB:
+                geometry = zlib.decompress(geometry)
+            self._deltas = decode_varints(geometry).reshape(self.n_coords, 2)
+        return self._deltas
+
+    def extras(self) -> Dict:
+        extras = self._extras
+        if self.flags & FLAG_EXTRAS_ZLIB:
+            extras = zlib.decompress(extras)
+        return json.loads(bytes(extras).decode('utf-8'))
+
+    @property
+    def has_geometry(self) -> bool:
+        return bool(self.flags & FLAG_GEOMETRY)
+
+    def to_response(self, geometry: bool = True) -> Dict:
+        """
+        The Directions response that was encoded, without the route geometry
+        when `geometry` is False (callers reading `polyline_deltas` instead).
+        Built once per view, every call returns the same dict so callers must
+        not modify it
+        """
+        geometry = geometry and self.has_geometry
+        response = self._responses.get(geometry)
+        if response is None:
+            response = self._responses[geometry] = self._build_response(geometry)
+        return response
+
+    def _build_response(self, geometry: bool) -> Dict:
+        extras = self.extras()
+        ints = self.ints.tolist()
+        n_legs = len(self.legs)
+        route = _set_numbers(extras['route'], self.route.tolist(), ints[0])
+        if geometry:
+            route['geometry'] = encode_polyline_deltas(self.polyline_deltas())
+        if self.flags & FLAG_LEGS:
+            route['legs'] = [
+                _set_numbers(leg, row, bits)
+                for leg, row, bits in zip(extras['legs'], self.legs.tolist(), ints[1:1 + n_legs])
+            ]
+
+        response = extras['response']
+        response['routes'] = [route]
+        if self.flags & FLAG_WAYPOINTS:
+            response['waypoints'] = [
+                _set_numbers(
+                    dict(waypoint, location=[_typed(lng, bits, 0), _typed(lat, bits, 1)]), [distance], bits >> 2,
+                    ('distance',)
+                )
+                for waypoint, (lng, lat, distance), bits in zip(
+                    extras['waypoints'], self.waypoints.tolist(), ints[1 + n_legs:]
+                )
+            ]
+        return response
+
+
+def _pack(response: Dict) -> bytes:
+    route = response['routes'][0]
+    legs = route.get('legs') or []
+    waypoints = response.get('waypoints') or []
+
+    flags = 0
+    deltas = np.empty((0, 2), dtype=np.int64)
+    if 'geometry' in route:
+        if not isinstance(route['geometry'], str):
+            raise TypeError("Geometry is not an encoded polyline")
+        flags |= FLAG_GEOMETRY
+        deltas = polyline_deltas(route['geometry'])
+        if deltas.size and np.abs(deltas).max() >= MAX_DELTA:
+            raise OverflowError("Geometry is not polyline6")
+        if not _is_canonical_polyline(route['geometry'], deltas):
+            raise ValueError("Geometry does not re-encode to the same polyline")
+    geometry = encode_varints(deltas)
+    compressed = zlib.compress(geometry)
+    if len(compressed) < len(geometry):
+        # Straight stretches repeat the same deltas
+        flags |= FLAG_GEOMETRY_ZLIB
+        geometry = compressed
+    if 'legs' in route:
+        flags |= FLAG_LEGS
+    if 'waypoints' in response:
+        flags |= FLAG_WAYPOINTS
+
+    route_table = np.array([_number(route, field) for field in NUMBER_FIELDS], dtype=_FLOAT)
+    leg_table = np.array(
+        [[_number(leg, field) for field in NUMBER_FIELDS] for leg in legs], dtype=_FLOAT
+    ).reshape(-1, 3)
+    waypoint_table = np.array(
+        [[*_location(waypoint), _number(waypoint, 'distance')] for waypoint in waypoints], dtype=_FLOAT
+    ).reshape(-1, 3)
+    ints = np.array(
+        [_int_bits([route.get(field) for field in NUMBER_FIELDS])]
+        + [_int_bits([leg.get(field) for field in NUMBER_FIELDS]) for leg in legs]
+        + [_int_bits([*waypoint['location'], waypoint.get('distance')]) for waypoint in waypoints],
+        dtype=np.uint8
+    )
+
+    extras = json.dumps({
+        'response': {key: value for key, value in response.items() if key not in ('routes', 'waypoints')},
+        'route': {
+            key: value for key, value in route.items()
+            if key not in NUMBER_FIELDS and key not in ('geometry', 'legs')
+        },
+        'legs': [{key: value for key, value in leg.items() if key not in NUMBER_FIELDS} for leg in legs],
+        'waypoints': [
+            {key: value for key, value in waypoint.items() if key not in WAYPOINT_FIELDS}
+            for waypoint in waypoints
+        ],
+    }, separators=(',', ':'), allow_nan=False).encode('utf-8')
+    compressed = zlib.compress(extras)
+    if len(compressed) < len(extras):
+        # Legs repeat the same keys, summaries and admins, they compress well
+        flags |= FLAG_EXTRAS_ZLIB
+        extras = compressed
+
+    header = HEADER.pack(
+        MAGIC, flags, len(deltas), len(leg_table), len(waypoint_table), len(geometry), len(extras)
+    )
+    return b''.join((
+        header, route_table.tobytes(), leg_table.tobytes(), waypoint_table.tobytes(), ints.tobytes(), geometry,
+        extras
+    ))
+
+
+def encode_route(response: Dict) -> bytes:
+    """
+    Binary form of a single route Directions response
+
+    Parameters
+    -----------
+        response dict
+            Directions response with exactly one route
+    Returns
+    -----------
+        data bytes
+            Encoded route, None when the response can not be round tripped
+            exactly and has to be stored as is
+    """
+    routes = response.get('routes') if isinstance(response, dict) else None
+    if not isinstance(routes, list) or len(routes) != 1:
+        return None
+    try:
+        # Anything the layout would change raises while packing, so nothing
+        # is decoded again to compare
+        return _pack(response)
+    except (AttributeError, KeyError, TypeError, ValueError, OverflowError):
+        return None
+
+
+def decode_route(data: bytes) -> Dict:
+    """
+    Directions response from `encode_route` output
+    """
+    return RouteView(data).to_response()
+
+
+def is_encoded_route(value) -> bool:
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:len(MAGIC)]) == MAGIC
@@ -0,0 +1,114 @@
+from django.conf import settings
+
+from services.routing import get_local_route
+from utils import metrics
+from utils.geometry import simplify_polyline
+
+from .client import MapboxError, MapboxRateLimited, get_client
+from .legs import get_leg_directions
+
+import logging
+from typing import Dict, List
+
+logger = logging.getLogger('service')
+
+DEFAULT_PROFILE = 'driving'
+DEFAULT_EXCLUDE = 'toll'
+DEFAULT_OVERVIEW = 'simplified'
+
+
+def simplify_directions(response: Dict, tolerance: float) -> Dict:
+    """
+    Simplify route geometries in place with a tolerance in meters
+    """
+    if tolerance:
+        for route in response.get('routes', []):
+            if route.get('geometry'):
+                route['geometry'] = simplify_polyline(route['geometry'], tolerance)
+    return response
+
+
+def _fetch_directions(route_path: List[Dict], profile: str, exclude: str, overview: str,
+                      tolerance: float = 0) -> Dict:
+    """
+    Directions from Mapbox, empty dict on failure and None when over quota
+    """
+    long_lat_str = ';'.join([f"{stop['longitude']},{stop['latitude']}" for stop in route_path])
+    metrics.observe('mapbox_route_waypoints', len(route_path), buckets=metrics.WAYPOINT_BUCKETS, profile=profile)
+    try:
+        response = get_client().directions(
+            long_lat_str, profile=profile, alternatives='false', exclude=exclude,
+            geometries='polyline6', language='en', overview=overview
+        )
+    except MapboxRateLimited as e:
+        # Over quota, queue it so the route worker fetches it once there is room
+        from .tasks import enqueue_route_prefetch
+        logger.warning(f"Deferred Mapbox routing: {str(e)}")
+        enqueue_route_prefetch(route_path, profile=profile, exclude=exclude, overview=overview)
+        return None
+    except MapboxError as e:
+        logger.error(
+            f"Failed to fetch Mapbox routing: {str(e)} {str(e.response_text or '')}"
+        )
+        return {}
+    # Simplify before caching so every hit carries the smaller payload
+    return simplify_directions(response, tolerance)
+
+
+def get_directions(route_path: List[Dict],
+                   profile: str = DEFAULT_PROFILE,
+                   exclude: str = DEFAULT_EXCLUDE,
+                   overview: str = DEFAULT_OVERVIEW,
+                   tolerance: float = None,
+                   max_workers: int = None) -> Dict:
+    """
+    Mapbox Directions response for an ordered list of stops, served from the
+    route cache when available
+
+    Routes are assembled from independently cached legs (one per consecutive
+    stop pair), so editing a stop only refetches the legs touching it. Missing
+    legs are fetched in runs of up to `settings.MAPBOX_MAX_WAYPOINTS` stops in
+    parallel and stitched back together. When
+    Mapbox fails and `settings.ROUTING_GRAPH_PATH` is set the route comes from
+    the local road graph, `settings.ROUTING_ENGINE = 'local'` skips Mapbox.
+
+    Parameters
+    -----------
+        route_path list
+            Ordered stops, each with `latitude` and `longitude`
+        profile str
+            Mapbox routing profile (driving, driving-traffic, walking, cycling)
+        exclude str
+            Road classes to avoid
+        overview str
+            Geometry detail (full, simplified, false)
+        tolerance float
+            Geometry simplification tolerance in meters, defaults to
+            `settings.MAPBOX_SIMPLIFY_TOLERANCE`, 0 disables
+        max_workers int
+            Parallel leg fetches for this route, defaults to
+            `settings.MAPBOX_BATCH_MAX_WORKERS`. Callers that already run
+            routes in a pool pass 1 so the pools do not multiply
+    Returns
+    -----------
+        response dict
+            Mapbox Directions response, empty dict on failure
+    """
+    if tolerance is None:
+        tolerance = settings.MAPBOX_SIMPLIFY_TOLERANCE
+    if max_workers is None:
+        max_workers = settings.MAPBOX_BATCH_MAX_WORKERS
+    if settings.ROUTING_ENGINE == 'local':
+        return simplify_directions(get_local_route(route_path), tolerance)
+
+    # End to end, cache hits included, next to the per call `mapbox_request_seconds`
+    with metrics.timer('route_directions_seconds', profile=profile):
+        response = get_leg_directions(
+            route_path, lambda stops: _fetch_directions(stops, profile, exclude, overview, tolerance),
+            settings.MAPBOX_MAX_WAYPOINTS, max_workers,
+            profile=profile, exclude=exclude, overview=overview, tolerance=tolerance
+        )
+    if not response and settings.ROUTING_GRAPH_PATH:
+        # Mapbox failed (or the failure is negatively cached), serve the offline route
+        response = simplify_directions(get_local_route(route_path), tolerance)
+    return response
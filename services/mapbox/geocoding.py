@@ -0,0 +1,215 @@
+"""
+Geocoding -> Address to coordinates through Redis and a persistent table
+before Mapbox, so an address is only paid for once
+"""
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.cache import DAY, MONTH
+
+from .client import MapboxError, get_client
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+import logging
+import re
+import unicodedata
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('service')
+
+GEOCODE_CACHE_TTL = MONTH
+GEOCODE_NEGATIVE_TTL = DAY
+GEOCODE_CACHE_VERSION = 1
+GEOCODE_MAX_QUERY_LENGTH = 255 # Mapbox rejects longer queries
+
+GeocodeMatch = namedtuple("GeocodeMatch", [
+    'query',       # Address as given
+    'latitude',    # None when nothing matched
+    'longitude',
+    'place_name',  # Provider formatted address
+    'confidence',  # Provider relevance 0 - 1
+    'accuracy',    # e.g. rooftop, street, place
+])
+
+
+def normalize_address(query: str) -> str:
+    """
+    Key for an address, case, punctuation and spacing differences collapse
+    to the same key: "Hays, KS  67601" -> "hays ks 67601"
+    """
+    text = unicodedata.normalize('NFKC', str(query)).casefold()
+    text = re.sub(r"[^\w#/-]+", ' ', text)
+    return ' '.join(text.split())[:GEOCODE_MAX_QUERY_LENGTH]
+
+
+def geocode_cache_key(key: str) -> str:
+    return f"geocode:v{GEOCODE_CACHE_VERSION}:{sha1(key.encode('utf-8')).hexdigest()}"
+
+
+def _geocode_model():
+    # Looked up lazily, the customer models import this package
+    return apps.get_model('customer', 'GeocodeResult')
+
+
+def _from_row(row) -> GeocodeMatch:
+    return GeocodeMatch(
+        query=row.query, latitude=row.latitude, longitude=row.longitude,
+        place_name=row.place_name, confidence=row.confidence, accuracy=row.accuracy
+    )
+
+
+def _fetch_geocode(query: str) -> Optional[GeocodeMatch]:
+    """
+    Upstream lookup, None on provider errors so nothing is cached
+    """
+    try:
+        # Matches are persisted, which Mapbox only permits from the permanent endpoint
+        response = get_client().geocode(
+            query[:GEOCODE_MAX_QUERY_LENGTH], endpoint=settings.MAPBOX_GEOCODE_ENDPOINT,
+            limit=1, autocomplete='false'
+        )
+    except MapboxError as e:
+        logger.error(
+            f"Mapbox geocoding failed: {str(e)}", extra={'task': 'Geocoding'}
+        )
+        return None
+    features = response.get('features') or []
+    if not features:
+        return GeocodeMatch(query, None, None, None, 0., None)
+    feature = features[0]
+    lng, lat = feature['center']
+    properties = feature.get('properties') or {}
+    return GeocodeMatch(
+        query=query, latitude=float(lat), longitude=float(lng),
+        place_name=feature.get('place_name'),
+        confidence=float(feature.get('relevance', 0)),
+        accuracy=properties.get('accuracy') or (feature.get('place_type') or [None])[0],
+    )
+
+
+def _cache_get_many(keys: List[str]) -> Dict[str, GeocodeMatch]:
+    cache_keys = {geocode_cache_key(key): key for key in keys}
+    try:
+        values = cache.get_many(list(cache_keys))
+    except Exception:
+        # Shared cache outage degrades to the table, not an error
+        logger.warning(f"Geocode cache read failed for {len(cache_keys)} keys", exc_info=True)
+        return {}
+    return {cache_keys[cache_key]: GeocodeMatch(**value) for cache_key, value in values.items()}
+
+
+def _cache_set(key: str, match: GeocodeMatch):
+    ttl = GEOCODE_CACHE_TTL if match.latitude is not None else GEOCODE_NEGATIVE_TTL
+    try:
+        cache.set(geocode_cache_key(key), match._asdict(), ttl)
+    except Exception:
+        logger.warning(f"Geocode cache write failed for `{key}`", exc_info=True)
+
+
+def _store(matches: Dict[str, GeocodeMatch], refresh: bool = False):
+    """
+    Write through to the table and Redis, `refresh` overwrites existing rows
+    """
+    if not matches:
+        return
+    GeocodeResult = _geocode_model()
+    rows = [
+        GeocodeResult(
+            key=key, query=match.query[:500], latitude=match.latitude, longitude=match.longitude,
+            place_name=(match.place_name or '')[:500] or None, confidence=match.confidence,
+            accuracy=match.accuracy
+        )
+        for key, match in matches.items()
+    ]
+    if refresh:
+        for row in rows:
+            GeocodeResult.objects.update_or_create(
+                key=row.key, defaults={
+                    field: getattr(row, field) for field in
+                    ('query', 'latitude', 'longitude', 'place_name', 'confidence', 'accuracy')
+                }
+            )
+    else:
+        # Concurrent workers may have stored the same address already
+        GeocodeResult.objects.bulk_create(rows, ignore_conflicts=True)
+    for key, match in matches.items():
+        _cache_set(key, match)
+
+
+def geocode_batch(queries: List[str],
+                  max_workers: int = None,
+                  refresh: bool = False) -> List[Optional[GeocodeMatch]]:
+    """
+    Geocode many addresses, each distinct address is looked up once
+
+    Parameters
+    -----------
+        queries list
+            Free form addresses
+        max_workers int
+            Concurrent upstream requests, defaults to `settings.MAPBOX_BATCH_MAX_WORKERS`
+        refresh bool
+            Skip Redis and the table and re-geocode upstream
+    Returns
+    -----------
+        matches list
+            `GeocodeMatch` per query in input order, `latitude` is None when
+            nothing matched and the whole entry is None on provider errors
+    """
+    if max_workers is None:
+        max_workers = settings.MAPBOX_BATCH_MAX_WORKERS
+
+    keys = [normalize_address(query) for query in queries]
+    unique = {}
+    for key, query in zip(keys, queries):
+        if key:
+            unique.setdefault(key, query)
+
+    found = {}
+    if not refresh and unique:
+        # Redis tier
+        found.update(_cache_get_many(list(unique)))
+
+        # Table tier, backfilling Redis
+        missing = [key for key in unique if key not in found]
+        if missing:
+            for row in _geocode_model().objects.filter(key__in=missing):
+                found[row.key] = _from_row(row)
+                _cache_set(row.key, found[row.key])
+
+    missing = [key for key in unique if key not in found]
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+            fetched = dict(zip(missing, executor.map(lambda key: _fetch_geocode(unique[key]), missing)))
+        fetched = {key: match for key, match in fetched.items() if match is not None}
+        _store(fetched, refresh=refresh)
+        found.update(fetched)
+
+    return [
+        found[key]._replace(query=query) if key in found else None
+        for key, query in zip(keys, queries)
+    ]
+
+
+def geocode(query: str, refresh: bool = False) -> Optional[GeocodeMatch]:
+    """
+    Geocode one address, see `geocode_batch`
+    """
+    return geocode_batch([query], refresh=refresh)[0]
+
+
+def regeocode_low_confidence(min_confidence: float = None, limit: int = 100) -> int:
+    """
+    Re-geocode stored matches below `min_confidence`, e.g. after the address
+    data improved upstream, returns the number refreshed
+    """
+    if min_confidence is None:
+        min_confidence = settings.MAPBOX_GEOCODE_MIN_CONFIDENCE
+    queries = list(
+        _geocode_model().objects.filter(confidence__lt=min_confidence)
+        .order_by('updated_on').values_list('query', flat=True)[:limit]
+    )
+    return sum(1 for match in geocode_batch(queries, refresh=True) if match is not None)
@@ -0,0 +1,277 @@
+"""
+Route Legs -> Routes as a chain of independently cached legs
+
+Every consecutive stop pair is cached on its own under the same key a two
+stop route would use, keyed by both stops and the routing options. A route is
+reassembled from its legs, so changing, inserting or removing one stop only
+misses the legs touching it and refetches those alone. Missing legs that are
+next to each other are still fetched together, one Directions call per run of
+up to `max_waypoints` stops, and split back into legs before caching.
+"""
+from django.core.cache import cache
+
+from utils.cache import single_flight
+from utils.geometry import decode_polyline, encode_polyline, encode_polyline_deltas, polyline_deltas
+
+from .cache import (
+    ROUTE_CACHE, ROUTE_FETCH_LOCK_TTL, ROUTE_FETCH_WAIT, route_cache_key, route_response, unpack_route
+)
+from .codec import RouteView
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import numpy as np
+from typing import Callable, Dict, List, Tuple, Union
+
+logger = logging.getLogger('service')
+
+# Degrees (~11 m), a vertex this much further than the closest one still counts as passing the stop
+LEG_CUT_TOLERANCE = 1e-4
+
+
+def split_route_path(route_path: List[Dict], max_waypoints: int) -> List[List[Dict]]:
+    """
+    Split stops into segments of at most `max_waypoints`, consecutive segments
+    share their boundary stop so the stitched route is continuous
+    """
+    if max_waypoints < 2:
+        raise ValueError("max_waypoints must be at least 2")
+    if len(route_path) <= max_waypoints:
+        return [route_path]
+    step = max_waypoints - 1
+    return [
+        route_path[start:start + max_waypoints]
+        for start in range(0, len(route_path) - 1, step)
+    ]
+
+
+def _read_segment(segment: Union[Dict, RouteView], geometry: bool) -> Tuple[Dict, np.ndarray]:
+    # Response without its geometry and the geometry as integer deltas, a
+    # cached `RouteView` gives both without a polyline decode and re-encode
+    if isinstance(segment, RouteView):
+        return segment.to_response(geometry=False), segment.polyline_deltas() if geometry else None
+    route = segment['routes'][0]
+    return segment, polyline_deltas(route['geometry']) if geometry else None
+
+
+def stitch_directions(segments: List[Union[Dict, RouteView]]) -> Dict:
+    """
+    Join Directions responses of consecutive overlapping segments into a
+    single response with the same shape, segments may be cached `RouteView`s
+    """
+    if len(segments) == 1:
+        return route_response(segments[0])
+
+    has_geometry = (
+        segments[0].has_geometry if isinstance(segments[0], RouteView) else 'geometry' in segments[0]['routes'][0]
+    )
+    segments, deltas = zip(*(_read_segment(segment, has_geometry) for segment in segments))
+    first_route = segments[0]['routes'][0]
+    route = {
+        key: value for key, value in first_route.items()
+        if key not in ('geometry', 'legs', 'distance', 'duration', 'weight')
+    }
+    route['legs'] = []
+    route['distance'] = 0
+    route['duration'] = 0
+    route['weight'] = 0
+
+    points = []
+    waypoints = []
+    for index, segment in enumerate(segments):
+        segment_route = segment['routes'][0]
+        route['legs'].extend(segment_route.get('legs', []))
+        route['distance'] += segment_route.get('distance', 0)
+        route['duration'] += segment_route.get('duration', 0)
+        route['weight'] += segment_route.get('weight', 0)
+
+        segment_waypoints = segment.get('waypoints', [])
+        segment_points = np.cumsum(deltas[index], axis=0) if has_geometry else None
+        if index > 0:
+            # Boundary stop is already the last point of the previous segment
+            segment_waypoints = segment_waypoints[1:]
+            if has_geometry:
+                segment_points = segment_points[1:]
+        waypoints.extend(segment_waypoints)
+        if has_geometry:
+            points.append(segment_points)
+
+    if has_geometry:
+        route['geometry'] = encode_polyline_deltas(np.diff(np.concatenate(points), axis=0, prepend=0))
+
+    response = {
+        key: value for key, value in segments[0].items() if key not in ('routes', 'waypoints')
+    }
+    response['routes'] = [route]
+    response['waypoints'] = waypoints
+    return response
+
+
+def _leg_cuts(coordinates: np.ndarray, waypoints: List[Dict]) -> List[int]:
+    # Geometry vertex closest to each intermediate waypoint on the first pass
+    # within `LEG_CUT_TOLERANCE` of the closest approach, searched forwards from
+    # the previous cut so a route passing a stop twice cuts on the first pass
+    # even when the second one runs slightly closer
+    cuts = [0]
+    for waypoint in waypoints[1:-1]:
+        lng, lat = waypoint['location']
+        rest = coordinates[cuts[-1]:]
+        dist = np.sqrt((rest[:, 0] - lat) ** 2 + ((rest[:, 1] - lng) * math.cos(math.radians(lat))) ** 2)
+        cut = int(np.flatnonzero(dist <= dist.min() + LEG_CUT_TOLERANCE)[0])
+        # Closest vertex of that pass
+        while cut + 1 < len(dist) and dist[cut + 1] < dist[cut]:
+            cut += 1
+        cuts.append(cuts[-1] + cut)
+    cuts.append(len(coordinates) - 1)
+    return cuts
+
+
+def split_legs(response: Dict) -> List[Dict]:
+    """
+    Split a Directions response into one two stop response per leg, the
+    inverse of `stitch_directions`
+
+    Parameters
+    -----------
+        response dict
+            Directions response with `routes[0].legs` and one waypoint per stop
+    Returns
+    -----------
+        legs list
+            Directions responses with the same shape, one per consecutive stop pair
+    """
+    route = response['routes'][0]
+    legs = route.get('legs', [])
+    waypoints = response.get('waypoints', [])
+    if not legs or len(waypoints) != len(legs) + 1:
+        raise ValueError(f"{len(legs)} legs do not match {len(waypoints)} waypoints")
+
+    coordinates = decode_polyline(route['geometry']) if route.get('geometry') else None
+    cuts = _leg_cuts(coordinates, waypoints) if coordinates is not None and len(legs) > 1 else None
+    header = {key: value for key, value in response.items() if key not in ('routes', 'waypoints')}
+    base = {
+        key: value for key, value in route.items()
+        if key not in ('geometry', 'legs', 'distance', 'duration', 'weight')
+    }
+
+    results = []
+    for index, leg in enumerate(legs):
+        leg_route = dict(
+            base, legs=[leg], distance=leg.get('distance', 0), duration=leg.get('duration', 0),
+            weight=leg.get('weight', 0)
+        )
+        if coordinates is not None:
+            leg_route['geometry'] = (
+                encode_polyline(coordinates[cuts[index]:cuts[index + 1] + 1]) if cuts else route['geometry']
+            )
+        results.append(dict(header, routes=[leg_route], waypoints=waypoints[index:index + 2]))
+    return results
+
+
+def leg_cache_keys(route_path: List[Dict], **options) -> List[str]:
+    return [route_cache_key(route_path[index:index + 2], **options) for index in range(len(route_path) - 1)]
+
+
+def _missing_runs(missing: List[int]) -> List[Tuple[int, int]]:
+    # Consecutive leg indexes -> (first, last) runs
+    runs = []
+    for index in missing:
+        if runs and runs[-1][1] == index - 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs.append((index, index))
+    return runs
+
+
+def _fetch_legs(stops: List[Dict], keys: List[str], fetch: Callable[[List[Dict]], Dict],
+                flight_key: str) -> List[Dict]:
+    def compute() -> List[Dict]:
+        response = fetch(stops)
+        legs = None
+        if response and response.get('routes'):
+            try:
+                legs = split_legs(response)
+            except (KeyError, ValueError) as e:
+                logger.error(f"Failed to split Mapbox routing into legs: {str(e)}")
+        if legs is None or len(legs) != len(keys):
+            # Failed or deferred, every leg falls back to its own stale copy
+            legs = [response if response is None else {}] * len(keys)
+        return [ROUTE_CACHE.resolve(key, leg) for key, leg in zip(keys, legs)]
+
+    def lookup() -> Tuple[bool, List[Dict]]:
+        try:
+            values = cache.get_many(keys)
+        except Exception:
+            return False, None
+        if any(values.get(key) is None for key in keys):
+            return False, None
+        return True, [unpack_route(values[key]) for key in keys]
+
+    return single_flight(flight_key, compute, lookup, lock_ttl=ROUTE_FETCH_LOCK_TTL, wait=ROUTE_FETCH_WAIT)
+
+
+def get_leg_directions(route_path: List[Dict],
+                       fetch: Callable[[List[Dict]], Dict],
+                       max_waypoints: int,
+                       max_workers: int = 1,
+                       **options) -> Dict:
+    """
+    Directions for a route assembled from cached legs, fetching only the
+    missing ones
+
+    Parameters
+    -----------
+        route_path list
+            Ordered stops, each with `latitude` and `longitude`
+        fetch callable
+            Stops -> Directions response, empty dict on failure and None when deferred
+        max_waypoints int
+            Stops allowed per `fetch` call
+        max_workers int
+            Parallel `fetch` calls when several runs of legs are missing, 1
+            fetches them in the calling thread
+        options kwargs
+            Routing options that are part of the cache keys
+    Returns
+    -----------
+        response dict
+            Stitched Directions response, empty dict when any leg is missing
+    """
+    if len(route_path) < 2:
+        key = route_cache_key(route_path, **options)
+        return ROUTE_CACHE.get_or_fetch(key, lambda: fetch(route_path))
+
+    keys = leg_cache_keys(route_path, **options)
+    cached = ROUTE_CACHE.get_many(keys)
+    legs = [cached.get(key) for key in keys]
+
+    # Runs of missing legs -> (first leg index, stops) chunks within the waypoint limit
+    chunks = []
+    for first, last in _missing_runs([index for index, leg in enumerate(legs) if leg is None]):
+        segments = split_route_path(route_path[first:last + 2], max_waypoints)
+        chunks.extend(zip(range(first, last + 1, max_waypoints - 1), segments))
+
+    if chunks:
+        def fetch_chunk(chunk: Tuple[int, List[Dict]]) -> List[Dict]:
+            offset, stops = chunk
+            flight_key = f"legs:{route_cache_key(stops, **options)}"
+            return _fetch_legs(stops, keys[offset:offset + len(stops) - 1], fetch, flight_key)
+
+        max_workers = min(max_workers, len(chunks))
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                fetched = list(executor.map(fetch_chunk, chunks))
+        else:
+            fetched = map(fetch_chunk, chunks)
+        for (offset, stops), chunk_legs in zip(chunks, fetched):
+            legs[offset:offset + len(chunk_legs)] = chunk_legs
+
+    # Cached `RouteView`s always hold one route
+    missing = sum(1 for leg in legs if not (isinstance(leg, RouteView) or leg and leg.get('routes')))
+    if missing:
+        logger.error(
+            f"Failed to fetch Mapbox routing for {len(route_path)} stops, {missing}/{len(legs)} legs missing"
+        )
+        return {}
+    return stitch_directions(legs)
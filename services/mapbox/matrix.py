@@ -0,0 +1,176 @@
+"""
+Matrix Service -> Origin/destination duration and distance matrices
+
+Large matrices are tiled into requests within the Matrix API coordinate limit
+and the tiles are read from the cache and fetched concurrently. Each cell is
+cached on its own by the quantized origin/destination pair so overlapping
+matrices reuse earlier work.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.cache import DAY
+from utils.geometry import METERS_PER_MILE, lat_lng_dist_matrix
+
+from .cache import COORDINATE_PRECISION
+from .client import MapboxError, get_client
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import numpy as np
+from typing import List, Tuple
+
+logger = logging.getLogger('service')
+
+MATRIX_CACHE_PREFIX = 'mapbox_matrix'
+MATRIX_CACHE_VERSION = 1
+MATRIX_CACHE_TTL = DAY * 7
+
+# Fallback estimate when the upstream is unavailable
+ESTIMATE_CIRCUITY_FACTOR = 1.3 # Road distance / crow flies distance
+ESTIMATE_SPEED_METERS_PER_SECOND = 22.35 # ~50 mph
+
+MatrixResult = namedtuple("MatrixResult", [
+    'durations',  # np.ndarray (n, m) seconds, nan when unroutable
+    'distances',  # np.ndarray (n, m) meters, nan when unroutable
+    'estimated',  # np.ndarray (n, m) bool, True where the cell is a crow flies estimate
+])
+
+
+def _quantize(points: List[Tuple[float, float]]) -> np.ndarray:
+    return np.round(np.asarray(points, dtype=np.float64).reshape(-1, 2), COORDINATE_PRECISION)
+
+
+def _cell_key(profile: str, origin: Tuple[float, float], destination: Tuple[float, float]) -> str:
+    return (
+        f"{MATRIX_CACHE_PREFIX}:v{MATRIX_CACHE_VERSION}:{profile}:"
+        f"{origin[0]:.{COORDINATE_PRECISION}f},{origin[1]:.{COORDINATE_PRECISION}f}:"
+        f"{destination[0]:.{COORDINATE_PRECISION}f},{destination[1]:.{COORDINATE_PRECISION}f}"
+    )
+
+
+def estimate_matrix(origins: np.ndarray, destinations: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Crow flies based duration (seconds) and distance (meters) estimates
+    """
+    distances = lat_lng_dist_matrix(origins, destinations) * METERS_PER_MILE * ESTIMATE_CIRCUITY_FACTOR
+    return distances / ESTIMATE_SPEED_METERS_PER_SECOND, distances
+
+
+def _fetch_tile(origins: np.ndarray, destinations: np.ndarray, profile: str) -> Tuple[np.ndarray, np.ndarray]:
+    coordinates = np.vstack((origins, destinations))
+    long_lat_str = ';'.join([f"{lng},{lat}" for lat, lng in coordinates])
+    response = get_client().matrix(
+        long_lat_str, profile=profile,
+        sources=';'.join(str(i) for i in range(len(origins))),
+        destinations=';'.join(str(len(origins) + i) for i in range(len(destinations))),
+        annotations='duration,distance'
+    )
+    # Unroutable pairs come back as null
+    durations = np.array(response['durations'], dtype=np.float64)
+    distances = np.array(response['distances'], dtype=np.float64)
+    return durations, distances
+
+
+def _tile_ranges(size: int, step: int) -> List[range]:
+    return [range(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def get_matrix(origins: List[Tuple[float, float]],
+               destinations: List[Tuple[float, float]] = None,
+               profile: str = 'driving',
+               max_workers: int = None) -> MatrixResult:
+    """
+    Duration and distance matrix from every origin to every destination
+
+    Parameters
+    -----------
+        origins list
+            [(<float: lat>, <float: lng>), ...]
+        destinations list
+            [(<float: lat>, <float: lng>), ...], defaults to `origins`
+        profile str
+            Mapbox routing profile
+        max_workers int
+            Concurrent tile requests, defaults to `settings.MAPBOX_BATCH_MAX_WORKERS`
+    Returns
+    -----------
+        result MatrixResult
+            NumPy duration/distance arrays plus a mask of estimated cells
+    """
+    if max_workers is None:
+        max_workers = settings.MAPBOX_BATCH_MAX_WORKERS
+    origins = _quantize(origins)
+    destinations = origins if destinations is None else _quantize(destinations)
+    shape = (len(origins), len(destinations))
+
+    durations = np.full(shape, np.nan)
+    distances = np.full(shape, np.nan)
+    estimated = np.zeros(shape, dtype=bool)
+    if not origins.size or not destinations.size:
+        return MatrixResult(durations=durations, distances=distances, estimated=estimated)
+
+    # Tiles within the coordinate limit, each reads its own cells from the
+    # cache so a large matrix never holds every key at once
+    tile_origins = settings.MAPBOX_MATRIX_MAX_COORDINATES // 2
+    tile_destinations = settings.MAPBOX_MATRIX_MAX_COORDINATES - tile_origins
+    tiles = [
+        (np.array(origin_range), np.array(destination_range))
+        for origin_range in _tile_ranges(shape[0], tile_origins)
+        for destination_range in _tile_ranges(shape[1], tile_destinations)
+    ]
+
+    def fill_tile(tile):
+        # Tiles cover disjoint blocks, so workers write the result arrays directly
+        rows, cols = tile
+        keys = [[_cell_key(profile, origins[row], destinations[col]) for col in cols] for row in rows]
+        try:
+            cached = cache.get_many([key for row in keys for key in row])
+        except Exception:
+            logger.warning("Matrix cache read failed", exc_info=True, extra={'task': 'MatrixService'})
+            cached = {}
+        missing = np.ones((len(rows), len(cols)), dtype=bool)
+        for i, row in enumerate(keys):
+            for j, key in enumerate(row):
+                cell = cached.get(key)
+                if cell is not None:
+                    durations[rows[i], cols[j]], distances[rows[i], cols[j]] = cell
+                    missing[i, j] = False
+        if not missing.any():
+            return
+
+        # Only request rows and columns that still have a missing cell
+        fetch_rows, fetch_cols = missing.any(axis=1), missing.any(axis=0)
+        index = np.ix_(rows[fetch_rows], cols[fetch_cols])
+        try:
+            result = _fetch_tile(origins[rows[fetch_rows]], destinations[cols[fetch_cols]], profile)
+        except (MapboxError, KeyError, ValueError):
+            logger.warning(
+                f"Matrix tile {fetch_rows.sum()}x{fetch_cols.sum()} failed, falling back to estimates",
+                exc_info=True, extra={'task': 'MatrixService'}
+            )
+            # Estimate the missing cells, cached ones keep their values
+            unknown = missing[np.ix_(fetch_rows, fetch_cols)]
+            estimates = estimate_matrix(origins[rows[fetch_rows]], destinations[cols[fetch_cols]])
+            for values, estimate in zip((durations, distances), estimates):
+                values[index] = np.where(unknown, estimate, values[index])
+            estimated[index] = unknown
+            return
+
+        durations[index], distances[index] = result
+        fetched = {
+            keys[i][j]: (result[0][a, b], result[1][a, b])
+            for a, i in enumerate(np.flatnonzero(fetch_rows))
+            for b, j in enumerate(np.flatnonzero(fetch_cols))
+        }
+        try:
+            cache.set_many(fetched, MATRIX_CACHE_TTL)
+        except Exception:
+            logger.warning("Matrix cache write failed", exc_info=True, extra={'task': 'MatrixService'})
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tiles)))) as executor:
+        # Consume the iterator so worker exceptions are raised here
+        list(executor.map(fill_tile, tiles))
+
+    return MatrixResult(durations=durations, distances=distances, estimated=estimated)
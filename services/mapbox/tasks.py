@@ -0,0 +1,158 @@
+"""
+Route Pre-warming -> Background tasks that compute and cache routes ahead of
+the page view
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from services.routing import optimize_stop_order
+from services.routing.vrp import VRP_TASK, run_vrp_task
+from utils.cache import MINUTE
+from utils.queue import publish_task
+
+from .cache import route_cache_key
+from .directions import DEFAULT_EXCLUDE, DEFAULT_OVERVIEW, DEFAULT_PROFILE, get_directions
+
+import logging
+from typing import Dict, List
+
+logger = logging.getLogger('task')
+
+ROUTE_PREFETCH_TASK = 'route.prefetch'
+ROUTE_PREFETCH_DEDUPE_TTL = MINUTE * 5
+ROUTE_STOPS_PREFETCH_TASK = 'route.stops_prefetch'
+
+
+def _dedupe_key(route_path: List[Dict], **options) -> str:
+    return f"route_prefetch:{route_cache_key(route_path, **options)}"
+
+
+def _stops_dedupe_key(route_id) -> str:
+    return f"route_stops_prefetch:{route_id}"
+
+
+def _clear_dedupe_key(dedupe_key: str):
+    try:
+        cache.delete(dedupe_key)
+    except Exception:
+        logger.warning('Failed to clear route prefetch dedupe key', exc_info=True)
+
+
+def enqueue_route_prefetch(route_path: List[Dict],
+                           profile: str = DEFAULT_PROFILE,
+                           exclude: str = DEFAULT_EXCLUDE,
+                           overview: str = DEFAULT_OVERVIEW) -> bool:
+    """
+    Queue a `route.prefetch` task, identical requests within
+    `ROUTE_PREFETCH_DEDUPE_TTL` are only queued once
+
+    Never raises, a queue outage only costs the warm cache. Callers are often
+    web requests (a rate limited route, a stop edit), so the publish makes a
+    single attempt bounded by `settings.RABBITMQ_PUBLISH_TIMEOUT`
+    """
+    stops = [
+        {'latitude': float(stop['latitude']), 'longitude': float(stop['longitude'])}
+        for stop in route_path
+    ]
+    options = {'profile': profile, 'exclude': exclude, 'overview': overview}
+    dedupe_key = _dedupe_key(stops, **options)
+    queued = False
+    try:
+        if not cache.add(dedupe_key, 1, ROUTE_PREFETCH_DEDUPE_TTL):
+            return False
+        queued = publish_task(
+            task=ROUTE_PREFETCH_TASK,
+            params={'route_path': stops, **options},
+            queue=settings.RABBITMQ_ROUTING_QUEUE,
+            fail_fast=True
+        )
+    except Exception:
+        logger.error(
+            'Failed to queue route prefetch', exc_info=True, extra={'task': ROUTE_PREFETCH_TASK}
+        )
+    if not queued:
+        # Nothing is queued, let the next request try again
+        _clear_dedupe_key(dedupe_key)
+    return queued
+
+
+def enqueue_stops_prefetch(route_path: List[Dict]) -> bool:
+    """
+    Queue a prefetch for stops in the order the map views request them,
+    resequenced first when `settings.ROUTING_OPTIMIZE_STOP_ORDER` is on
+    """
+    if settings.ROUTING_OPTIMIZE_STOP_ORDER:
+        route_path = optimize_stop_order(route_path, fix_start=True)
+    return enqueue_route_prefetch(route_path)
+
+
+def enqueue_route_stops_prefetch(route_id) -> bool:
+    """
+    Queue a `route.stops_prefetch` task for a route whose stops changed, the
+    worker loads the stops when it runs. A burst of stop edits queues one
+    task, later edits find it still queued and skip the publish
+
+    Never raises, same as `enqueue_route_prefetch`
+    """
+    dedupe_key = _stops_dedupe_key(route_id)
+    queued = False
+    try:
+        if not cache.add(dedupe_key, 1, ROUTE_PREFETCH_DEDUPE_TTL):
+            return False
+        queued = publish_task(
+            task=ROUTE_STOPS_PREFETCH_TASK,
+            params={'route_id': route_id},
+            queue=settings.RABBITMQ_ROUTING_QUEUE,
+            fail_fast=True
+        )
+    except Exception:
+        logger.error(
+            'Failed to queue route stops prefetch', exc_info=True, extra={'task': ROUTE_STOPS_PREFETCH_TASK}
+        )
+    if not queued:
+        _clear_dedupe_key(dedupe_key)
+    return queued
+
+
+def prefetch_route(params: Dict):
+    route_path = params['route_path']
+    options = {
+        'profile': params.get('profile', DEFAULT_PROFILE),
+        'exclude': params.get('exclude', DEFAULT_EXCLUDE),
+        'overview': params.get('overview', DEFAULT_OVERVIEW),
+    }
+    # The task is off the queue, clear its dedupe key so a fetch deferred
+    # again for quota re-queues it instead of being dropped as a duplicate
+    _clear_dedupe_key(_dedupe_key(route_path, **options))
+    response = get_directions(route_path, **options)
+    logger.info(
+        f"Prefetched route with {len(route_path)} stops: {'ok' if response else 'failed'}",
+        extra={'task': ROUTE_PREFETCH_TASK}
+    )
+
+
+def prefetch_route_stops(params: Dict):
+    # Models queue this task, import them only once it runs
+    from apps.customer.models import RouteStop
+
+    route_id = params['route_id']
+    # Clear the key before loading, an edit committed from here on queues the
+    # route again and every edit before it is in the stops read below
+    _clear_dedupe_key(_stops_dedupe_key(route_id))
+    route_path = list(RouteStop.objects.filter(route_id=route_id).order_by('sequence').route_path())
+    if len(route_path) < 2:
+        return
+    if settings.ROUTING_OPTIMIZE_STOP_ORDER:
+        route_path = optimize_stop_order(route_path, fix_start=True)
+    response = get_directions(route_path)
+    logger.info(
+        f"Prefetched route {route_id} with {len(route_path)} stops: {'ok' if response else 'failed'}",
+        extra={'task': ROUTE_STOPS_PREFETCH_TASK}
+    )
+
+
+TASK_HANDLERS = {
+    ROUTE_PREFETCH_TASK: prefetch_route,
+    ROUTE_STOPS_PREFETCH_TASK: prefetch_route_stops,
+    VRP_TASK: run_vrp_task,
+}
@@ -0,0 +1,3 @@
+from .engine import get_local_route, get_road_graph
+from .graph import NoRouteError, RoadGraph
+from .optimizer import optimize_stop_order
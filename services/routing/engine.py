@@ -0,0 +1,49 @@
+from django.conf import settings
+
+from .graph import NoRouteError, RoadGraph
+
+import logging
+import threading
+from typing import Dict, List
+
+logger = logging.getLogger('service')
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_road_graph() -> RoadGraph:
+    """
+    Process wide road graph loaded from `settings.ROUTING_GRAPH_PATH`, None
+    when no graph is configured
+    """
+    global _graph
+    if _graph is None and settings.ROUTING_GRAPH_PATH:
+        with _graph_lock:
+            if _graph is None:
+                _graph = RoadGraph.load(settings.ROUTING_GRAPH_PATH)
+                logger.info(
+                    f"Loaded road graph `{settings.ROUTING_GRAPH_PATH}` with "
+                    f"{_graph.num_nodes} nodes and {_graph.num_edges} edges",
+                    extra={'task': 'LocalRouting'}
+                )
+    return _graph
+
+
+def get_local_route(route_path: List[Dict]) -> Dict:
+    """
+    Route from the local road graph in Mapbox Directions shape, empty dict when
+    no graph is configured or there is no route
+    """
+    try:
+        graph = get_road_graph()
+    except (OSError, ValueError, KeyError):
+        logger.error("Failed to load road graph", exc_info=True, extra={'task': 'LocalRouting'})
+        return {}
+    if graph is None or len(route_path) < 2:
+        return {}
+    try:
+        return graph.route(route_path)
+    except NoRouteError as e:
+        logger.warning(f"Local routing failed: {str(e)}", extra={'task': 'LocalRouting'})
+        return {}
@@ -0,0 +1,362 @@
+"""
+Local Routing Engine -> Shortest paths over an offline road graph
+
+The graph is held in compact CSR arrays (int32 node index) and answers
+queries with A* (crow flies heuristic) or bidirectional Dijkstra. Responses
+mirror the Mapbox Directions shape so callers can use either source.
+"""
+from utils.geometry import METERS_PER_MILE, SpatialIndex, encode_polyline, lat_lng_dist, lat_lng_dist_paired
+
+import heapq
+import json
+import logging
+import numpy as np
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger('service')
+
+# Rounding used to merge GeoJSON vertices into graph nodes (~0.1 m)
+NODE_PRECISION = 6
+DEFAULT_SPEED_METERS_PER_SECOND = 13.4 # ~30 mph when a road has no speed
+
+
+class NoRouteError(Exception):
+    pass
+
+
+def _build_csr(num_nodes: int, source: np.ndarray, target: np.ndarray, *weights: np.ndarray):
+    order = np.argsort(source, kind='stable')
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source, minlength=num_nodes), out=indptr[1:])
+    return (indptr, target[order].astype(np.int32)) + tuple(weight[order] for weight in weights)
+
+
+class RoadGraph(object):
+    """
+    Directed road graph in CSR form
+
+    Parameters
+    -----------
+        node_lat, node_lng np.ndarray (n,)
+            Node coordinates
+        edge_source, edge_target np.ndarray (e,) int32
+            Directed edges by node index
+        edge_distance np.ndarray (e,)
+            Edge length in meters
+        edge_duration np.ndarray (e,)
+            Edge travel time in seconds, defaults to a constant speed
+    """
+
+    def __init__(self, node_lat, node_lng, edge_source, edge_target, edge_distance, edge_duration=None):
+        self.node_lat = np.ascontiguousarray(node_lat, dtype=np.float64)
+        self.node_lng = np.ascontiguousarray(node_lng, dtype=np.float64)
+        edge_source = np.asarray(edge_source, dtype=np.int32)
+        edge_target = np.asarray(edge_target, dtype=np.int32)
+        edge_distance = np.asarray(edge_distance, dtype=np.float64)
+        if edge_duration is None:
+            edge_duration = edge_distance / DEFAULT_SPEED_METERS_PER_SECOND
+        edge_duration = np.asarray(edge_duration, dtype=np.float64)
+
+        # Forward and reverse adjacency, reverse is used by bidirectional search
+        self.indptr, self.indices, self.distance, self.duration = _build_csr(
+            self.num_nodes, edge_source, edge_target, edge_distance, edge_duration
+        )
+        self.rev_indptr, self.rev_indices, self.rev_distance, self.rev_duration = _build_csr(
+            self.num_nodes, edge_target, edge_source, edge_distance, edge_duration
+        )
+        # Lowest weight per crow flies meter over all edges, the A* estimate
+        # scales the crow flies distance by it. A zero duration edge (e.g. a
+        # ferry with no time) makes the duration estimate 0, any other speed
+        # bound would overestimate across it
+        edge_meters = lat_lng_dist_paired(
+            np.column_stack((self.node_lat[edge_source], self.node_lng[edge_source])),
+            np.column_stack((self.node_lat[edge_target], self.node_lng[edge_target]))
+        ) * METERS_PER_MILE
+        moving = edge_meters > 0
+        self.heuristic_scale = {
+            weight: float((values[moving] / edge_meters[moving]).min()) if moving.any() else 0.0
+            for weight, values in (('distance', edge_distance), ('duration', edge_duration))
+        }
+        self._node_index = None
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_lat)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.indices)
+
+    # Loading / Saving
+    @classmethod
+    def load(cls, path: str) -> 'RoadGraph':
+        """
+        Load a graph from `.npz` (see `save`) or a GeoJSON file of LineStrings
+        """
+        if path.endswith('.npz'):
+            return cls.load_npz(path)
+        if path.endswith('.json') or path.endswith('.geojson'):
+            return cls.load_geojson(path)
+        raise ValueError(f"Unsupported road graph format `{path}`")
+
+    @classmethod
+    def load_npz(cls, path: str) -> 'RoadGraph':
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                node_lat=data['node_lat'], node_lng=data['node_lng'],
+                edge_source=data['edge_source'], edge_target=data['edge_target'],
+                edge_distance=data['edge_distance'],
+                edge_duration=data['edge_duration'] if 'edge_duration' in data else None,
+            )
+
+    @classmethod
+    def load_geojson(cls, path: str) -> 'RoadGraph':
+        """
+        Each LineString feature is a road, vertices shared between roads become
+        graph nodes. Optional properties: `oneway` (bool) and `speed` (km/h).
+        """
+        with open(path) as f:
+            collection = json.load(f)
+
+        node_index = {}
+        node_lat, node_lng = [], []
+        edge_source, edge_target, edge_speed = [], [], []
+
+        def get_node(lng: float, lat: float) -> int:
+            key = (round(lat, NODE_PRECISION), round(lng, NODE_PRECISION))
+            index = node_index.get(key)
+            if index is None:
+                index = node_index[key] = len(node_lat)
+                node_lat.append(key[0])
+                node_lng.append(key[1])
+            return index
+
+        for feature in collection.get('features', []):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'LineString':
+                lines = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiLineString':
+                lines = geometry['coordinates']
+            else:
+                continue
+            properties = feature.get('properties') or {}
+            oneway = bool(properties.get('oneway', False))
+            speed = properties.get('speed')
+            speed = float(speed) / 3.6 if speed else DEFAULT_SPEED_METERS_PER_SECOND
+
+            for line in lines:
+                nodes = [get_node(coordinate[0], coordinate[1]) for coordinate in line]
+                for a, b in zip(nodes[:-1], nodes[1:]):
+                    if a == b:
+                        continue
+                    edges = [(a, b)] if oneway else [(a, b), (b, a)]
+                    for source, target in edges:
+                        edge_source.append(source)
+                        edge_target.append(target)
+                        edge_speed.append(speed)
+
+        # Edge lengths in one vectorized pass
+        edge_source = np.array(edge_source, dtype=np.int32)
+        edge_target = np.array(edge_target, dtype=np.int32)
+        coordinates = np.column_stack((node_lat, node_lng)).reshape(-1, 2)
+        edge_distance = lat_lng_dist_paired(coordinates[edge_source], coordinates[edge_target]) * METERS_PER_MILE
+        edge_duration = edge_distance / np.array(edge_speed, dtype=np.float64)
+
+        return cls(
+            node_lat=node_lat, node_lng=node_lng,
+            edge_source=edge_source, edge_target=edge_target,
+            edge_distance=edge_distance, edge_duration=edge_duration,
+        )
+
+    def save(self, path: str):
+        edge_source = np.repeat(
+            np.arange(self.num_nodes, dtype=np.int32), np.diff(self.indptr)
+        )
+        np.savez_compressed(
+            path, node_lat=self.node_lat, node_lng=self.node_lng,
+            edge_source=edge_source, edge_target=self.indices,
+            edge_distance=self.distance, edge_duration=self.duration,
+        )
+
+    # Queries
+    def nearest_node(self, lat: float, lng: float) -> Tuple[int, float]:
+        """
+        Closest node to a point and its distance in meters
+        """
+        if self._node_index is None:
+            self._node_index = SpatialIndex(np.column_stack((self.node_lat, self.node_lng)))
+        ids, miles = self._node_index.query(lat, lng, k=1)
+        if not len(ids):
+            raise NoRouteError("Road graph has no nodes")
+        return int(ids[0]), float(miles[0]) * METERS_PER_MILE
+
+    def _weights(self, weight: str, reverse: bool = False):
+        if weight not in ('distance', 'duration'):
+            raise ValueError(f"Unknown weight `{weight}`")
+        if reverse:
+            return self.rev_indptr, self.rev_indices, getattr(self, f"rev_{weight}")
+        return self.indptr, self.indices, getattr(self, weight)
+
+    def _heuristic(self, target: int, weight: str) -> Callable[[int], float]:
+        """
+        Crow flies lower bound to the target, computed for a node the first
+        time the search reaches it rather than for the whole graph up front
+        """
+        # Road edges are measured by the same formula, shave rounding so the
+        # bound never overestimates
+        scale = self.heuristic_scale[weight] * METERS_PER_MILE * (1 - 1e-9)
+        if not scale:
+            return lambda node: 0.0
+        lats, lngs = memoryview(self.node_lat), memoryview(self.node_lng)
+        goal = (lats[target], lngs[target])
+        estimates = {}
+
+        def heuristic(node: int) -> float:
+            estimate = estimates.get(node)
+            if estimate is None:
+                estimate = estimates[node] = lat_lng_dist((lats[node], lngs[node]), goal) * scale
+            return estimate
+
+        return heuristic
+
+    def astar(self, source: int, target: int, weight: str = 'duration') -> Tuple[List[int], float]:
+        indptr, indices, weights = (memoryview(array) for array in self._weights(weight))
+        heuristic = self._heuristic(target, weight)
+        best = {source: 0.0}
+        previous = {source: -1}
+        closed = set()
+        heap = [(heuristic(source), 0.0, source)]
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node == target:
+                return self._unwind(previous, target), cost
+            if node in closed:
+                continue
+            closed.add(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[edge]
+                new_cost = cost + weights[edge]
+                if new_cost < best.get(neighbor, float('inf')):
+                    best[neighbor] = new_cost
+                    previous[neighbor] = node
+                    heapq.heappush(heap, (new_cost + heuristic(neighbor), new_cost, neighbor))
+        raise NoRouteError(f"No route between nodes {source} and {target}")
+
+    def bidirectional_dijkstra(self, source: int, target: int, weight: str = 'duration') -> Tuple[List[int], float]:
+        if source == target:
+            return [source], 0.0
+        graphs = [
+            tuple(memoryview(array) for array in self._weights(weight)),
+            tuple(memoryview(array) for array in self._weights(weight, reverse=True)),
+        ]
+        best = [{source: 0.0}, {target: 0.0}]
+        previous = [{source: -1}, {target: -1}]
+        closed = [set(), set()]
+        heaps = [[(0.0, source)], [(0.0, target)]]
+        shortest, meeting = float('inf'), None
+
+        while heaps[0] and heaps[1]:
+            # Stop once the frontiers together cannot beat the best meeting point
+            if heaps[0][0][0] + heaps[1][0][0] >= shortest:
+                break
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            cost, node = heapq.heappop(heaps[side])
+            if node in closed[side]:
+                continue
+            closed[side].add(node)
+            indptr, indices, weights = graphs[side]
+            other = best[1 - side]
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[edge]
+                new_cost = cost + weights[edge]
+                if new_cost < best[side].get(neighbor, float('inf')):
+                    best[side][neighbor] = new_cost
+                    previous[side][neighbor] = node
+                    heapq.heappush(heaps[side], (new_cost, neighbor))
+                if neighbor in other and new_cost + other[neighbor] < shortest:
+                    shortest = new_cost + other[neighbor]
+                    meeting = neighbor
+
+        if meeting is None:
+            raise NoRouteError(f"No route between nodes {source} and {target}")
+        forward = self._unwind(previous[0], meeting)
+        backward = self._unwind(previous[1], meeting)
+        return forward + backward[::-1][1:], shortest
+
+    @staticmethod
+    def _unwind(previous: Dict, node: int) -> List[int]:
+        path = []
+        while node != -1:
+            path.append(node)
+            node = previous[node]
+        return path[::-1]
+
+    def shortest_path(self, source: int, target: int, weight: str = 'duration',
+                      method: str = 'astar') -> Tuple[List[int], float]:
+        """
+        Node path and total weight between two node indexes
+
+        Raises `NoRouteError` when the target is unreachable
+        """
+        if method == 'astar':
+            return self.astar(source, target, weight=weight)
+        if method == 'bidirectional':
+            return self.bidirectional_dijkstra(source, target, weight=weight)
+        raise ValueError(f"Unknown shortest path method `{method}`")
+
+    def _path_totals(self, path: List[int], weight: str = 'duration') -> Tuple[float, float, float]:
+        """
+        Distance, duration and cost in `weight` along a node path
+        """
+        costs = self._weights(weight)[2]
+        distance = duration = cost = 0.0
+        for a, b in zip(path[:-1], path[1:]):
+            edges = np.arange(self.indptr[a], self.indptr[a + 1])
+            edges = edges[self.indices[edges] == b]
+            # Parallel edges, the search took the cheapest one in `weight`
+            edge = edges[np.argmin(costs[edges])]
+            distance += float(self.distance[edge])
+            duration += float(self.duration[edge])
+            cost += float(costs[edge])
+        return distance, duration, cost
+
+    def route(self, route_path: List[Dict], weight: str = 'duration', method: str = 'astar') -> Dict:
+        """
+        Route through an ordered list of stops, shaped like a Mapbox
+        Directions response (`geometry` is polyline6)
+
+        Raises `NoRouteError` when any leg is unreachable
+        """
+        snapped = [self.nearest_node(float(stop['latitude']), float(stop['longitude'])) for stop in route_path]
+
+        legs = []
+        nodes = [snapped[0][0]]
+        for (source, _), (target, _) in zip(snapped[:-1], snapped[1:]):
+            path, _ = self.shortest_path(source, target, weight=weight, method=method)
+            distance, duration, cost = self._path_totals(path, weight=weight)
+            legs.append({
+                'distance': distance, 'duration': duration, 'weight': cost,
+                'summary': '', 'steps': [],
+            })
+            nodes.extend(path[1:])
+
+        nodes = np.array(nodes, dtype=np.int32)
+        return {
+            'code': 'Ok',
+            'routes': [{
+                'geometry': encode_polyline(np.column_stack((self.node_lat[nodes], self.node_lng[nodes]))),
+                'legs': legs,
+                'distance': sum(leg['distance'] for leg in legs),
+                'duration': sum(leg['duration'] for leg in legs),
+                'weight_name': weight,
+                'weight': sum(leg['weight'] for leg in legs),
+            }],
+            'waypoints': [
+                {
+                    'name': stop.get('display', ''),
+                    'location': [float(self.node_lng[node]), float(self.node_lat[node])],
+                    'distance': snap_distance,
+                }
+                for stop, (node, snap_distance) in zip(route_path, snapped)
+            ],
+        }
@@ -0,0 +1,160 @@
+"""
+Stop Sequencing -> Reorder stops to shorten a route before it is requested
+
+Nearest neighbour construction followed by 2-opt and Or-opt improvement over
+a crow flies distance matrix. Routes of a handful of stops are solved exactly.
+"""
+from utils.geometry import lat_lng_dist_matrix
+
+from itertools import permutations
+import numpy as np
+import time
+from typing import Dict, List
+
+
+def nearest_neighbour_tour(dist: np.ndarray, start: int, end: int = None) -> List[int]:
+    n = len(dist)
+    visited = np.zeros(n, dtype=bool)
+    visited[start] = True
+    if end is not None:
+        visited[end] = True
+    tour = [start]
+    current = start
+    for _ in range(n - int(visited.sum())):
+        row = np.where(visited, np.inf, dist[current])
+        current = int(np.argmin(row))
+        visited[current] = True
+        tour.append(current)
+    if end is not None and end != start:
+        tour.append(end)
+    return tour
+
+
+def two_opt(tour: List[int], dist: np.ndarray, deadline: float = None) -> List[int]:
+    """
+    Reverse segments while it shortens the path, endpoints stay fixed
+    """
+    tour = np.array(tour)
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 2):
+            # Gain of reversing tour[i:j+1] for every j at once
+            a, b = tour[i - 1], tour[i]
+            c, d = tour[i + 1:n - 1], tour[i + 2:n]
+            delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-9:
+                j += i + 1
+                tour[i:j + 1] = tour[i:j + 1][::-1]
+                improved = True
+            if deadline is not None and time.monotonic() > deadline:
+                return tour.tolist()
+    return tour.tolist()
+
+
+def or_opt(tour: List[int], dist: np.ndarray, deadline: float = None) -> List[int]:
+    """
+    Move chains of 1 to 3 stops to a cheaper position, endpoints stay fixed
+    """
+    tour = list(tour)
+    improved = True
+    while improved:
+        improved = False
+        for length in (1, 2, 3):
+            i = 1
+            while i + length < len(tour):
+                chain = tour[i:i + length]
+                prev, nxt = tour[i - 1], tour[i + length]
+                removal_gain = dist[prev, chain[0]] + dist[chain[-1], nxt] - dist[prev, nxt]
+                rest = np.array(tour[:i] + tour[i + length:])
+                # Insert between rest[k] and rest[k + 1], forwards or reversed
+                left, right = rest[:-1], rest[1:]
+                base = dist[left, right]
+                forward = dist[left, chain[0]] + dist[chain[-1], right] - base
+                backward = dist[left, chain[-1]] + dist[chain[0], right] - base
+                costs = np.minimum(forward, backward)
+                k = int(np.argmin(costs))
+                if costs[k] < removal_gain - 1e-9:
+                    insert = chain if forward[k] <= backward[k] else chain[::-1]
+                    tour = rest[:k + 1].tolist() + insert + rest[k + 1:].tolist()
+                    improved = True
+                else:
+                    i += 1
+                if deadline is not None and time.monotonic() > deadline:
+                    return tour
+    return tour
+
+
+# Largest route ordered by trying every permutation (7! = 5040 paths)
+BRUTE_FORCE_MAX_STOPS = 7
+
+
+def brute_force_order(dist: np.ndarray, fix_start: bool, fix_end: bool) -> List[int]:
+    """
+    Shortest path over every order of the free stops, ties keep the input order
+    """
+    n = len(dist)
+    head = [0] if fix_start else []
+    tail = [n - 1] if fix_end else []
+    middle = list(range(len(head), n - len(tail)))
+    orders = np.array(list(permutations(middle)), dtype=np.intp).reshape(-1, len(middle))
+    paths = np.hstack([
+        np.full((len(orders), len(head)), 0, dtype=np.intp),
+        orders,
+        np.full((len(orders), len(tail)), n - 1, dtype=np.intp),
+    ])
+    lengths = dist[paths[:, :-1], paths[:, 1:]].sum(axis=1)
+    return paths[int(np.argmin(lengths))].tolist()
+
+
+def optimize_stop_order(route_path: List[Dict],
+                        fix_start: bool = True,
+                        fix_end: bool = False,
+                        time_limit: float = 1.0) -> List[Dict]:
+    """
+    Reorder stops to shorten the crow flies route
+
+    Parameters
+    -----------
+        route_path list
+            Stops, each with `latitude` and `longitude`
+        fix_start bool
+            Keep the first stop first (e.g. the depot)
+        fix_end bool
+            Keep the last stop last
+        time_limit float
+            Seconds allowed for the improvement phase
+    Returns
+    -----------
+        route_path list
+            Same stops in the optimized order
+    """
+    n = len(route_path)
+    if n < 3:
+        return list(route_path)
+
+    points = [(float(stop['latitude']), float(stop['longitude'])) for stop in route_path]
+    dist = lat_lng_dist_matrix(points, points)
+
+    if n <= BRUTE_FORCE_MAX_STOPS:
+        return [route_path[index] for index in brute_force_order(dist, fix_start, fix_end)]
+
+    # Free endpoints are modelled with a dummy node at zero distance from all
+    # stops, the optimized path is then a closed tour broken at the dummy
+    if not fix_start or not fix_end:
+        dist = np.pad(dist, ((0, 1), (0, 1)))
+        dummy = n
+    start = 0 if fix_start else dummy
+    end = (n - 1) if fix_end else dummy
+
+    deadline = time.monotonic() + time_limit
+    tour = nearest_neighbour_tour(dist, start, end)
+    if start == end:
+        # Closed tour through the dummy, close it so 2-opt can move the break
+        tour = tour + [start]
+    tour = two_opt(tour, dist, deadline)
+    tour = or_opt(tour, dist, deadline)
+
+    return [route_path[index] for index in tour if index < n]
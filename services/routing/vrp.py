@@ -0,0 +1,524 @@
+"""
+Vehicle Routing -> Split stops across trucks with capacity and time windows
+
+Clarke-Wright savings construction followed by relocate, exchange, 2-opt*
+and 2-opt local search restricted to each stop's nearest neighbours.
+Randomized restarts run in a process pool and the best plan is kept.
+
+Node 0 of every matrix is the depot, stop `i` is node `i + 1`.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.cache import DAY
+from utils.geometry import lat_lng_dist_matrix
+from utils.queue import publish_task
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import math
+import numpy as np
+import os
+import time
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+logger = logging.getLogger('service')
+
+VRP_TASK = 'route.vrp'
+VRP_RESULT_TTL = DAY
+DEFAULT_SPEED_MPH = 25
+NEIGHBOURS = 25
+EPSILON = 1e-9
+
+VRPSolution = namedtuple('VRPSolution', ['routes', 'distance', 'unassigned', 'feasible'])
+
+
+class VRPProblem(object):
+    """
+    Parameters
+    -----------
+        distances np.ndarray
+            (n + 1, n + 1) travel cost, node 0 is the depot, inf where an
+            arc cannot be driven
+        durations np.ndarray
+            (n + 1, n + 1) travel seconds, defaults to `distances`
+        demands array-like
+            Load of every stop (n,), defaults to 1
+        capacity float
+            Load a vehicle carries, defaults to unlimited
+        ready array-like
+            Earliest service start per node (n + 1,) in seconds, depot first
+        due array-like
+            Latest service start per node (n + 1,), the depot value is the
+            latest return
+        service array-like
+            Seconds spent at every node (n + 1,)
+        num_vehicles int
+            Vehicles available, defaults to unlimited
+    """
+
+    def __init__(self,
+                 distances: np.ndarray,
+                 durations: np.ndarray = None,
+                 demands=None,
+                 capacity: float = None,
+                 ready=None,
+                 due=None,
+                 service=None,
+                 num_vehicles: int = None):
+        self.distances = np.asarray(distances, dtype=np.float64)
+        size = len(self.distances)
+        self.durations = self.distances if durations is None else np.asarray(durations, dtype=np.float64)
+        demands = np.ones(size - 1) if demands is None else np.asarray(demands, dtype=np.float64)
+        self.demands = np.concatenate(([0.], demands))
+        self.capacity = math.inf if capacity is None else float(capacity)
+        self.ready = np.zeros(size) if ready is None else np.asarray(ready, dtype=np.float64)
+        self.due = np.full(size, math.inf) if due is None else np.asarray(due, dtype=np.float64)
+        self.service = np.zeros(size) if service is None else np.asarray(service, dtype=np.float64)
+        self.num_vehicles = num_vehicles
+        self.has_time_windows = bool(np.isfinite(self.due).any() or self.ready.any())
+        self.has_unroutable = not np.isfinite(self.distances).all()
+        # Nearest nodes of every stop, candidate moves are limited to them
+        k = min(NEIGHBOURS, size - 2)
+        if k > 0:
+            costs = self.distances[1:, 1:] + np.diag(np.full(size - 1, np.inf))
+            self.neighbours = np.argpartition(costs, k - 1, axis=1)[:, :k] + 1
+        else:
+            self.neighbours = np.empty((size - 1, 0), dtype=np.int64)
+
+    @property
+    def num_stops(self) -> int:
+        return len(self.distances) - 1
+
+    def route_cost(self, route: List[int]) -> float:
+        path = [0] + route + [0]
+        return float(self.distances[path[:-1], path[1:]].sum())
+
+    def route_feasible(self, route: List[int]) -> bool:
+        if self.demands[route].sum() > self.capacity + EPSILON:
+            return False
+        if self.has_unroutable and math.isinf(self.route_cost(route)):
+            return False
+        if not self.has_time_windows:
+            return True
+        durations, ready, due, service = self.durations, self.ready, self.due, self.service
+        clock, previous = ready[0], 0
+        for node in route:
+            clock = max(clock + service[previous] + durations[previous, node], ready[node])
+            if clock > due[node]:
+                return False
+            previous = node
+        return clock + service[previous] + durations[previous, 0] <= due[0]
+
+    def schedule_bounds(self, route: List[int]) -> Tuple[float, float]:
+        """
+        (service end at the last stop starting as early as possible, latest
+        arrival at the first stop that keeps the route feasible)
+        """
+        durations, ready, due, service = self.durations, self.ready, self.due, self.service
+        clock, previous = ready[0], 0
+        for node in route:
+            clock = max(clock + service[previous] + durations[previous, node], ready[node])
+            previous = node
+        finish = clock + service[previous]
+
+        latest = min(due[route[-1]], due[0] - service[route[-1]] - durations[route[-1], 0])
+        for node, following in zip(route[-2::-1], route[:0:-1]):
+            latest = min(due[node], latest - service[node] - durations[node, following])
+        return finish, latest
+
+
+def build_distance_matrix(depot: Dict, stops: List[Dict]) -> np.ndarray:
+    """
+    Crow flies miles between the depot and every stop, depot first
+    """
+    points = [(float(stop['latitude']), float(stop['longitude'])) for stop in [depot] + list(stops)]
+    return lat_lng_dist_matrix(points, points)
+
+
+def savings_construction(problem: VRPProblem, rng: np.random.Generator = None,
+                         shape: float = 1.) -> List[List[int]]:
+    """
+    Clarke-Wright savings, merging route ends in order of
+    `d(i, 0) + d(0, j) - shape * d(i, j)` with an optional random perturbation
+    """
+    distances = problem.distances
+    n = problem.num_stops
+    routes, route_of, load, bounds = {}, {}, {}, {}
+    for node in range(1, n + 1):
+        if problem.route_feasible([node]):
+            routes[node] = [node]
+            route_of[node] = node
+            load[node] = problem.demands[node]
+            bounds[node] = problem.schedule_bounds([node])
+
+    if n > 1:
+        first = np.repeat(np.arange(1, n + 1), problem.neighbours.shape[1])
+        second = problem.neighbours.ravel()
+        savings = distances[first, 0] + distances[0, second] - shape * distances[first, second]
+        if rng is not None:
+            savings = savings * rng.uniform(0.95, 1.05, len(savings))
+        order = np.argsort(-savings, kind='stable')
+        order = order[savings[order] > 0]
+
+        for i, j in zip(first[order].tolist(), second[order].tolist()):
+            a, b = route_of.get(i), route_of.get(j)
+            if a is None or b is None or a == b:
+                continue
+            # `i` has to end its route and `j` start the other
+            if routes[a][-1] != i or routes[b][0] != j:
+                continue
+            if load[a] + load[b] > problem.capacity + EPSILON:
+                continue
+            if problem.has_time_windows and (
+                bounds[a][0] + problem.durations[i, j] > bounds[b][1] + EPSILON
+            ):
+                continue
+            # Keep the longer list and relabel the shorter one
+            merged = routes[a] + routes[b]
+            keep, drop = (a, b) if len(routes[a]) >= len(routes[b]) else (b, a)
+            for node in routes[drop]:
+                route_of[node] = keep
+            routes[keep], load[keep] = merged, load[a] + load[b]
+            bounds[keep] = problem.schedule_bounds(merged) if problem.has_time_windows else (0, math.inf)
+            del routes[drop], load[drop], bounds[drop]
+
+    return list(routes.values())
+
+
+def reduce_vehicles(problem: VRPProblem, routes: List[List[int]], deadline: float = None) -> List[List[int]]:
+    """
+    Merge routes, cheapest feasible pair first, while more are used than
+    `problem.num_vehicles`
+    """
+    routes = [list(route) for route in routes]
+    distances = problem.distances
+    while problem.num_vehicles is not None and len(routes) > problem.num_vehicles:
+        best = None
+        for a, route_a in enumerate(routes):
+            for b, route_b in enumerate(routes):
+                if a == b:
+                    continue
+                cost = distances[route_a[-1], route_b[0]] - distances[route_a[-1], 0] - distances[0, route_b[0]]
+                if best is not None and cost >= best[0]:
+                    continue
+                if problem.route_feasible(route_a + route_b):
+                    best = (cost, a, b)
+        if best is None or (deadline is not None and time.time() > deadline):
+            break
+        _, a, b = best
+        routes[a] = routes[a] + routes[b]
+        del routes[b]
+    return routes
+
+
+class _LocalSearch(object):
+
+    def __init__(self, problem: VRPProblem, routes: List[List[int]], deadline: float = None):
+        self.problem = problem
+        self.distances = problem.distances
+        self.deadline = deadline
+        self.routes = [list(route) for route in routes if route]
+        self.costs = [problem.route_cost(route) for route in self.routes]
+        self._index()
+
+    def _index(self):
+        self.route_of = {}
+        self.position = {}
+        for index, route in enumerate(self.routes):
+            for position, node in enumerate(route):
+                self.route_of[node] = index
+                self.position[node] = position
+
+    def _neighbours(self, node: int) -> Tuple[int, int]:
+        route = self.routes[self.route_of[node]]
+        position = self.position[node]
+        previous = route[position - 1] if position > 0 else 0
+        following = route[position + 1] if position + 1 < len(route) else 0
+        return previous, following
+
+    def _try(self, changes: Dict[int, List[int]]) -> bool:
+        # Apply replacement routes when they are cheaper and feasible
+        problem = self.problem
+        costs = {index: problem.route_cost(route) for index, route in changes.items()}
+        if sum(costs.values()) >= sum(self.costs[index] for index in changes) - EPSILON:
+            return False
+        if not all(problem.route_feasible(route) for route in changes.values() if route):
+            return False
+        for index, route in changes.items():
+            self.routes[index] = route
+            self.costs[index] = costs[index]
+            for position, node in enumerate(route):
+                self.route_of[node] = index
+                self.position[node] = position
+        return True
+
+    def _relocate(self, u: int, v: int) -> bool:
+        d = self.distances
+        a, b = self.route_of[u], self.route_of[v]
+        previous, following = self._neighbours(u)
+        v_previous, v_following = self._neighbours(v)
+        removal = d[previous, u] + d[u, following] - d[previous, following]
+        for after in (True, False):
+            left, right = (v, v_following) if after else (v_previous, v)
+            if left == u or right == u:
+                continue
+            if d[left, u] + d[u, right] - d[left, right] - removal >= -EPSILON:
+                continue
+            source = [node for node in self.routes[a] if node != u]
+            target = source if a == b else list(self.routes[b])
+            position = target.index(v) + (1 if after else 0)
+            target = target[:position] + [u] + target[position:]
+            if self._try({a: target} if a == b else {a: source, b: target}):
+                return True
+        return False
+
+    def _exchange(self, u: int, v: int) -> bool:
+        a, b = self.route_of[u], self.route_of[v]
+        if a == b:
+            return False
+        d = self.distances
+        up, uf = self._neighbours(u)
+        vp, vf = self._neighbours(v)
+        delta = (d[up, v] + d[v, uf] + d[vp, u] + d[u, vf]) - (d[up, u] + d[u, uf] + d[vp, v] + d[v, vf])
+        if delta >= -EPSILON:
+            return False
+        route_a = [v if node == u else node for node in self.routes[a]]
+        route_b = [u if node == v else node for node in self.routes[b]]
+        return self._try({a: route_a, b: route_b})
+
+    def _two_opt(self, u: int, v: int) -> bool:
+        d = self.distances
+        a, b = self.route_of[u], self.route_of[v]
+        i, j = self.position[u], self.position[v]
+        _, uf = self._neighbours(u)
+        _, vf = self._neighbours(v)
+        if d[u, v] + d[uf, vf] - d[u, uf] - d[v, vf] >= -EPSILON:
+            # Tails crossed over: u -> vf and v -> uf (2-opt*)
+            if a == b or d[u, vf] + d[v, uf] - d[u, uf] - d[v, vf] >= -EPSILON:
+                return False
+            route_a, route_b = self.routes[a], self.routes[b]
+            return self._try({a: route_a[:i + 1] + route_b[j + 1:], b: route_b[:j + 1] + route_a[i + 1:]})
+        if a != b:
+            # u -> v and uf -> vf across routes, join one head with the other reversed
+            route_a, route_b = self.routes[a], self.routes[b]
+            return self._try({
+                a: route_a[:i + 1] + route_b[:j + 1][::-1],
+                b: route_a[i + 1:][::-1] + route_b[j + 1:],
+            })
+        if i > j:
+            i, j = j, i
+        route = self.routes[a]
+        return self._try({a: route[:i + 1] + route[i + 1:j + 1][::-1] + route[j + 1:]})
+
+    def run(self) -> List[List[int]]:
+        moves = (self._relocate, self._exchange, self._two_opt)
+        nodes = list(self.route_of)
+        improved = True
+        while improved:
+            improved = False
+            for u in nodes:
+                for v in self.problem.neighbours[u - 1].tolist():
+                    if v not in self.route_of:
+                        continue
+                    for move in moves:
+                        if move(u, v):
+                            improved = True
+                            break
+                if self.deadline is not None and time.time() > self.deadline:
+                    return self.result()
+        return self.result()
+
+    def result(self) -> List[List[int]]:
+        return [route for route in self.routes if route]
+
+
+def solve_restart(problem: VRPProblem, seed: int = 0, deadline: float = None) -> Tuple[List[List[int]], float]:
+    """
+    One construction plus local search, seed 0 is the plain savings order
+    """
+    rng = np.random.default_rng(seed) if seed else None
+    shape = 1. if rng is None else rng.uniform(0.6, 1.8)
+    routes = savings_construction(problem, rng=rng, shape=shape)
+    routes = reduce_vehicles(problem, routes, deadline)
+    routes = _LocalSearch(problem, routes, deadline).run()
+    return routes, sum(problem.route_cost(route) for route in routes)
+
+
+_worker_problem = None
+
+
+def _init_worker(problem: VRPProblem):
+    global _worker_problem
+    _worker_problem = problem
+
+
+def _solve_in_worker(seed: int, deadline: float) -> Tuple[List[List[int]], float]:
+    return solve_restart(_worker_problem, seed, deadline)
+
+
+def _rank(problem: VRPProblem, result: Tuple[List[List[int]], float]) -> Tuple:
+    routes, distance = result
+    excess = max(0, len(routes) - problem.num_vehicles) if problem.num_vehicles is not None else 0
+    return excess, distance
+
+
+def solve_vrp(problem: VRPProblem,
+              restarts: int = 8,
+              time_limit: float = 60,
+              max_workers: int = None,
+              seed: int = 0) -> VRPSolution:
+    """
+    Best plan over randomized restarts
+
+    Parameters
+    -----------
+        problem VRPProblem
+            Matrices, demands and constraints
+        restarts int
+            Independent constructions, the first is the deterministic one
+        time_limit float
+            Wall seconds for the whole solve, searches stop at the deadline
+        max_workers int
+            Worker processes, defaults to the CPU count, 1 solves in process
+        seed int
+            Base seed of the randomized restarts
+    Returns
+    -----------
+        solution VRPSolution
+            `routes` as stop indexes (node - 1) per vehicle, total `distance`,
+            `unassigned` stops no vehicle can serve and whether the vehicle
+            limit holds
+    """
+    deadline = time.time() + time_limit
+    seeds = [0] + [seed * restarts + index for index in range(1, restarts)] if restarts > 1 else [0]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(seeds))
+
+    if max_workers <= 1:
+        results = [solve_restart(problem, restart_seed, deadline) for restart_seed in seeds]
+    else:
+        # The problem goes to each worker once, not with every restart
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker, initargs=(problem,)
+        ) as executor:
+            results = list(executor.map(_solve_in_worker, seeds, [deadline] * len(seeds)))
+
+    routes, distance = min(results, key=lambda result: _rank(problem, result))
+    served = {node for route in routes for node in route}
+    return VRPSolution(
+        routes=[[node - 1 for node in route] for route in routes],
+        distance=distance,
+        unassigned=[node - 1 for node in range(1, problem.num_stops + 1) if node not in served],
+        feasible=problem.num_vehicles is None or len(routes) <= problem.num_vehicles,
+    )
+
+
+def build_vrp_problem(depot: Dict,
+                      stops: List[Dict],
+                      capacity: float = None,
+                      num_vehicles: int = None,
+                      matrix: str = 'crow',
+                      speed_mph: float = DEFAULT_SPEED_MPH) -> VRPProblem:
+    """
+    Problem from stop dicts
+
+    Parameters
+    -----------
+        depot dict
+            `latitude`, `longitude` and optional `ready` / `due` seconds of the shift
+        stops list
+            `latitude`, `longitude`, optional `demand` (default 1), `ready`,
+            `due` and `service` seconds
+        capacity float
+            Vehicle capacity in demand units
+        num_vehicles int
+            Vehicles available
+        matrix str
+            `crow` for `lat_lng_dist` miles driven at `speed_mph`, `mapbox`
+            for Mapbox Matrix API meters and seconds
+        speed_mph float
+            Average speed turning crow flies miles into seconds
+    """
+    nodes = [depot] + list(stops)
+    if matrix == 'mapbox':
+        from services.mapbox.matrix import get_matrix
+        result = get_matrix([(float(node['latitude']), float(node['longitude'])) for node in nodes])
+        # Unroutable cells (nan) become arcs no route may use
+        unroutable = np.isnan(result.distances) | np.isnan(result.durations)
+        distances = np.where(unroutable, np.inf, result.distances)
+        durations = np.where(unroutable, np.inf, result.durations)
+    else:
+        distances = build_distance_matrix(depot, stops)
+        durations = distances / speed_mph * 3600
+
+    def column(field: str, default: float) -> np.ndarray:
+        return np.array([
+            default if node.get(field) is None else float(node[field]) for node in nodes
+        ], dtype=np.float64)
+
+    return VRPProblem(
+        distances, durations, demands=column('demand', 1.)[1:], capacity=capacity,
+        ready=column('ready', 0.), due=column('due', math.inf), service=column('service', 0.),
+        num_vehicles=num_vehicles,
+    )
+
+
+def vrp_route_paths(solution: VRPSolution, depot: Dict, stops: List[Dict]) -> List[List[Dict]]:
+    """
+    One route path per vehicle, depot to depot, ready for `get_directions`
+    """
+    return [[depot] + [stops[index] for index in route] + [depot] for route in solution.routes]
+
+
+def _result_key(job_id: str) -> str:
+    return f"vrp_result:{job_id}"
+
+
+def enqueue_vrp(depot: Dict, stops: List[Dict], **options) -> str:
+    """
+    Queue a `route.vrp` task for large plans, returns the job id for
+    `get_vrp_result`
+    """
+    job_id = uuid4().hex
+    cache.set(_result_key(job_id), {'status': 'queued'}, VRP_RESULT_TTL)
+    publish_task(
+        task=VRP_TASK,
+        params={'job_id': job_id, 'depot': depot, 'stops': list(stops), **options},
+        queue=settings.RABBITMQ_ROUTING_QUEUE
+    )
+    return job_id
+
+
+def get_vrp_result(job_id: str) -> Dict:
+    """
+    {'status': 'queued' | 'running' | 'done' | 'failed', ...}, None for
+    unknown or expired jobs
+    """
+    return cache.get(_result_key(job_id))
+
+
+def run_vrp_task(params: Dict):
+    job_id = params['job_id']
+    cache.set(_result_key(job_id), {'status': 'running'}, VRP_RESULT_TTL)
+    start = time.monotonic()
+    try:
+        problem = build_vrp_problem(
+            params['depot'], params['stops'],
+            capacity=params.get('capacity'), num_vehicles=params.get('num_vehicles'),
+            matrix=params.get('matrix', 'crow'), speed_mph=params.get('speed_mph', DEFAULT_SPEED_MPH),
+        )
+        solution = solve_vrp(
+            problem, restarts=params.get('restarts', 8), time_limit=params.get('time_limit', 60),
+            max_workers=params.get('max_workers'),
+        )
+    except Exception:
+        cache.set(_result_key(job_id), {'status': 'failed'}, VRP_RESULT_TTL)
+        raise
+    cache.set(_result_key(job_id), dict(solution._asdict(), status='done'), VRP_RESULT_TTL)
+    logger.info(
+        f"Solved VRP `{job_id}` with {problem.num_stops} stops into {len(solution.routes)} routes, "
+        f"{len(solution.unassigned)} unassigned in {time.monotonic() - start:.1f}s",
+        extra={'task': VRP_TASK}
+    )
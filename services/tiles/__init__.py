@@ -0,0 +1,2 @@
+from .clusters import add_stops_to_cluster_index, get_cluster_index
+from .vector import get_stop_tile, get_tile_version, invalidate_stop_tiles
@@ -0,0 +1,140 @@
+"""
+Cluster Indexes -> One marker clustering index per customer dataset, kept
+per process and reused until the customer's stop data version changes
+
+Stops are loaded lazily by geohash cell, a view only reads the cells around
+it the first time and the whole dataset is read once a view spans too many
+cells. New stops are added to the index incrementally.
+"""
+from utils.cluster import ClusterIndex
+from utils.geometry import geohash_cells, geohash_encode
+
+from .vector import get_tile_version
+
+from collections import OrderedDict
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('service')
+
+MAX_CLUSTER_INDEXES = 64
+LOAD_PRECISION = 3 # Geohash cells of ~156 x 156 km are loaded as a unit
+MAX_LOAD_CELLS = 32 # Views spanning more cells load the whole dataset
+
+
+class _CustomerIndex(object):
+    def __init__(self, version: int):
+        self.version = version
+        self.index = ClusterIndex()
+        self.cells = set() # Loaded geohash cells
+        self.complete = False # Every cell loaded
+        self.ids = set()
+        self.lock = threading.Lock()
+
+    def is_loaded(self, stop: Dict) -> bool:
+        return self.complete or _stop_cell(stop) in self.cells
+
+    def add(self, stops: List[Dict]):
+        # A stop can come both from a load and an incremental add, keep one
+        stops = [stop for stop in stops if stop.get('id') is None or stop['id'] not in self.ids]
+        self.ids.update(stop['id'] for stop in stops if stop.get('id') is not None)
+        self.index.add(stops)
+
+
+_indexes = OrderedDict() # customer id -> _CustomerIndex
+_indexes_lock = threading.Lock()
+
+
+def _stop_cell(stop: Dict) -> str:
+    return geohash_encode(float(stop['latitude']), float(stop['longitude']), LOAD_PRECISION)
+
+
+def _get_entry(customer_id) -> _CustomerIndex:
+    version = get_tile_version(customer_id)
+    if version is None:
+        # Cache down, the stop data may have changed, build a throwaway index
+        return _CustomerIndex(version)
+    with _indexes_lock:
+        entry = _indexes.get(customer_id)
+        if entry is None or entry.version != version:
+            entry = _indexes[customer_id] = _CustomerIndex(version)
+        _indexes.move_to_end(customer_id)
+        while len(_indexes) > MAX_CLUSTER_INDEXES:
+            _indexes.popitem(last=False)
+    return entry
+
+
+def get_cluster_index(customer_id,
+                      load_stops: Callable[[List[str]], List[Dict]],
+                      bbox: Tuple[float, float, float, float] = None,
+                      zoom: float = None) -> ClusterIndex:
+    """
+    Cluster index for a customer holding at least every stop that can show
+    up in `get_clusters(bbox, zoom)`
+
+    Parameters
+    -----------
+        load_stops callable
+            Stops (with `id`, `latitude` and `longitude`) in a list of geohash
+            cells, every stop when passed None. Only called for cells not
+            loaded yet
+        bbox tuple
+            (min_lng, min_lat, max_lng, max_lat) to be queried, None loads
+            the whole dataset
+        zoom float
+            Zoom to be queried, clusters near the bbox edge reach past it
+    """
+    entry = _get_entry(customer_id)
+    cells = None
+    if bbox is not None:
+        if zoom is not None:
+            bbox = entry.index.cluster_bbox(bbox, zoom)
+        cells = geohash_cells(bbox, LOAD_PRECISION, max_cells=MAX_LOAD_CELLS)
+
+    with entry.lock:
+        if entry.complete:
+            return entry.index
+        if cells is not None:
+            cells = [cell for cell in cells if cell not in entry.cells]
+            if not cells:
+                return entry.index
+        wanted = set(cells) if cells is not None else None
+        stops = [
+            stop for stop in load_stops(cells)
+            if (_stop_cell(stop) in wanted if wanted is not None else not entry.is_loaded(stop))
+        ]
+        entry.add(stops)
+        if wanted is None:
+            entry.complete = True
+        else:
+            entry.cells.update(wanted)
+
+    logger.info(
+        f"Loaded {len(stops)} stops from {len(cells) if cells is not None else 'all'} cells into the "
+        f"cluster index for customer `{customer_id}` ({len(entry.index)} stops)",
+        extra={'task': 'ClusterIndex'}
+    )
+    return entry.index
+
+
+def add_stops_to_cluster_index(customer_id, stops: List[Dict], previous_version: Optional[int]):
+    """
+    Incrementally add new stops to this process' index instead of rebuilding
+
+    `previous_version` is what `invalidate_stop_tiles` returned for the
+    change. The index only moves to the new version when it was built at
+    the previous one, otherwise it missed other changes (updates, deletes or
+    writes from other processes) and is dropped. Stops in cells not loaded
+    yet are left to the load
+    """
+    with _indexes_lock:
+        entry = _indexes.get(customer_id)
+        if entry is None:
+            return
+        if previous_version is None or entry.version != previous_version:
+            del _indexes[customer_id]
+            return
+        entry.version = previous_version + 1
+    with entry.lock:
+        entry.add([stop for stop in stops if entry.is_loaded(stop)])
@@ -0,0 +1,116 @@
+"""
+Vector Tiles -> Stop tiles encoded server side and cached per customer
+
+A shared cache outage degrades to building tiles on every request, the
+version is then unknown (None) and responses are neither cached nor given
+an ETag.
+"""
+from django.core.cache import cache
+
+from utils.cache import DAY
+from utils.mvt import DEFAULT_BUFFER, DEFAULT_EXTENT, encode_tile, lng_lat_to_tile
+
+import logging
+import numpy as np
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger('service')
+
+TILE_CACHE_PREFIX = 'mvt'
+TILE_CACHE_TTL = DAY
+STOP_LAYER = 'stops'
+STOP_PROPERTIES = ('display', 'marker')
+
+
+def _version_key(customer_id) -> str:
+    return f"{TILE_CACHE_PREFIX}_version:{customer_id}"
+
+
+def get_tile_version(customer_id) -> Optional[int]:
+    """
+    Version of a customer's stop data, None when the cache is unavailable
+    """
+    try:
+        version = cache.get(_version_key(customer_id))
+        if version is None:
+            version = int(time.time() * 1000)
+            cache.add(_version_key(customer_id), version, None)
+    except Exception:
+        logger.warning(f"Tile version read failed for customer `{customer_id}`", exc_info=True)
+        return None
+    return version
+
+
+def invalidate_stop_tiles(customer_id) -> Optional[int]:
+    """
+    Drop every cached tile for a customer by moving to a new version, stale
+    tiles then expire on their own
+
+    The version moves up by one atomically, the version replaced is returned
+    so callers know which data their change applies to. None when there was
+    no version yet or the cache is unavailable
+    """
+    key = _version_key(customer_id)
+    try:
+        try:
+            return cache.incr(key) - 1
+        except ValueError:
+            # No version yet, start one unless another process just did
+            if not cache.add(key, int(time.time() * 1000), None):
+                cache.incr(key)
+            return None
+    except Exception:
+        logger.warning(f"Tile invalidation failed for customer `{customer_id}`", exc_info=True)
+        return None
+
+
+def tile_cache_key(customer_id, z: int, x: int, y: int, version: int) -> str:
+    return f"{TILE_CACHE_PREFIX}:{customer_id}:v{version}:{z}:{x}:{y}"
+
+
+def build_stop_tile(stops: List[Dict], z: int, x: int, y: int,
+                    extent: int = DEFAULT_EXTENT, buffer: int = DEFAULT_BUFFER) -> bytes:
+    """
+    Encode the stops falling inside tile z/x/y (plus buffer) as a `stops` layer
+    """
+    if not stops:
+        return b''
+    lng = np.fromiter((float(stop['longitude']) for stop in stops), dtype=np.float64, count=len(stops))
+    lat = np.fromiter((float(stop['latitude']) for stop in stops), dtype=np.float64, count=len(stops))
+    pixels = lng_lat_to_tile(lng, lat, z, x, y, extent)
+    inside = np.all((pixels >= -buffer) & (pixels <= extent + buffer), axis=1)
+
+    features = []
+    for index in np.flatnonzero(inside).tolist():
+        stop = stops[index]
+        features.append({
+            'id': stop.get('id', index),
+            'type': 'Point',
+            'coordinates': pixels[index],
+            'properties': {key: stop.get(key) for key in STOP_PROPERTIES},
+        })
+    return encode_tile({STOP_LAYER: features}, extent)
+
+
+def get_stop_tile(customer_id, z: int, x: int, y: int, get_stops: Callable[[], List[Dict]]) -> bytes:
+    """
+    Cached stop tile for a customer, `get_stops` is only called on a miss
+    """
+    version = get_tile_version(customer_id)
+    if version is None:
+        return build_stop_tile(get_stops(), z, x, y)
+
+    key = tile_cache_key(customer_id, z, x, y, version)
+    try:
+        tile = cache.get(key)
+    except Exception:
+        logger.warning(f"Tile cache read failed for `{key}`", exc_info=True)
+        tile = None
+    if tile is None:
+        tile = build_stop_tile(get_stops(), z, x, y)
+        try:
+            cache.set(key, tile, TILE_CACHE_TTL)
+        except Exception:
+            logger.warning(f"Tile cache write failed for `{key}`", exc_info=True)
+    return tile
@@ -1,5 +1,119 @@
+from django.core.cache import cache
+
+import logging
+import threading
+import time
+from typing import Callable, Tuple
+from uuid import uuid4
+
+logger = logging.getLogger('service')
+
 MINUTE=60
 HOUR=MINUTE*60
 DAY=HOUR*24
 WEEK=DAY*7
-MONTH=DAY*30
\ No newline at end of file
+MONTH=DAY*30
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(key: str,
+                  compute: Callable[[], object],
+                  lookup: Callable[[], Tuple[bool, object]],
+                  lock_ttl: int = 30,
+                  wait: float = 10,
+                  poll_interval: float = 0.05):
+    """
+    Run `compute` once for `key` across threads and processes
+
+    Threads in this process share one in-flight call. Across processes the
+    first caller takes a Redis lock (`cache.add`) and computes, the others
+    poll `lookup` until the leader has stored the result. Once the lock is
+    released or `wait` runs out a waiting caller computes itself, so a dead
+    leader costs latency but never an error.
+
+    Parameters
+    -----------
+        key str
+            Cache key the result is stored under
+        compute callable
+            Produces (and stores) the value
+        lookup callable
+            Returns (found, value) from the shared cache
+        lock_ttl int
+            Seconds before an abandoned lock expires
+        wait float
+            Seconds a caller waits for the leader
+    Returns
+    -----------
+        value
+            Result of `compute` or the value found by `lookup`
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        flight.done.wait(wait)
+        if flight.done.is_set() and flight.error is None:
+            return flight.value
+        found, value = lookup()
+        return value if found else compute()
+
+    try:
+        flight.value = _distributed_flight(key, compute, lookup, lock_ttl, wait, poll_interval)
+        return flight.value
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def _distributed_flight(key, compute, lookup, lock_ttl, wait, poll_interval):
+    lock_key = f"lock:{key}"
+    token = uuid4().hex
+    try:
+        acquired = cache.add(lock_key, token, lock_ttl)
+    except Exception:
+        logger.warning(f"Single flight lock failed for `{key}`", exc_info=True)
+        return compute()
+
+    if acquired:
+        try:
+            return compute()
+        finally:
+            try:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+            except Exception:
+                logger.warning(f"Single flight unlock failed for `{key}`", exc_info=True)
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        found, value = lookup()
+        if found:
+            return value
+        try:
+            locked = cache.get(lock_key) is not None
+        except Exception:
+            logger.warning(f"Single flight lock check failed for `{key}`", exc_info=True)
+            break
+        if not locked:
+            # Leader finished without storing anything, or died
+            break
+    found, value = lookup()
+    return value if found else compute()
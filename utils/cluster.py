@@ -0,0 +1,172 @@
+"""
+Marker Clustering -> Hierarchical grid clustering index (supercluster style)
+
+Points are projected once to normalized Web Mercator. Every zoom level keeps
+aggregates (count and coordinate sums) per grid cell sized to the cluster
+radius in screen pixels. Adding points merges their aggregates into the
+existing cells without revisiting old points, and queries are a vectorized
+bbox filter over one zoom level.
+"""
+from utils.geometry import inverse_web_mercator, web_mercator
+
+import numpy as np
+import threading
+from typing import Dict, List, Tuple
+
+
+class ClusterIndex(object):
+    """
+    Parameters
+    -----------
+        min_zoom int
+            Lowest zoom with clusters
+        max_zoom int
+            Highest zoom with clusters, above it individual points are returned
+        radius int
+            Cluster radius in pixels
+        extent int
+            Tile size in pixels the radius is measured against
+    """
+
+    def __init__(self, min_zoom: int = 0, max_zoom: int = 16, radius: int = 60, extent: int = 256):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.radius = radius
+        self.extent = extent
+        self._xy = np.empty((0, 2), dtype=np.float64)
+        self._points = []
+        # zoom -> (sorted cell ids, counts, coordinate sums, first point index)
+        self._cells = {
+            zoom: (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                   np.empty((0, 2)), np.empty(0, dtype=np.int64))
+            for zoom in range(min_zoom, max_zoom + 1)
+        }
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cells_per_side(self, zoom: int) -> int:
+        return max(1, int((2 ** zoom) * self.extent / self.radius))
+
+    def add(self, points: List[Dict]) -> 'ClusterIndex':
+        """
+        Add points, each with `latitude` and `longitude`, other keys are
+        returned as properties of unclustered points
+        """
+        if not points:
+            return self
+        lng = np.fromiter((float(point['longitude']) for point in points), dtype=np.float64, count=len(points))
+        lat = np.fromiter((float(point['latitude']) for point in points), dtype=np.float64, count=len(points))
+        xy = web_mercator(lng, lat)
+
+        with self._lock:
+            offset = len(self._points)
+            self._points.extend(points)
+            self._xy = np.vstack((self._xy, xy))
+
+            for zoom, (cell_ids, counts, sums, first) in self._cells.items():
+                side = self._cells_per_side(zoom)
+                grid = np.minimum((xy * side).astype(np.int64), side - 1)
+                # Merge the new points into the existing cell aggregates
+                cell_ids = np.concatenate((cell_ids, grid[:, 1] * side + grid[:, 0]))
+                counts = np.concatenate((counts, np.ones(len(xy), dtype=np.int64)))
+                sums = np.vstack((sums, xy))
+                first = np.concatenate((first, np.arange(offset, offset + len(xy), dtype=np.int64)))
+                unique, index, inverse = np.unique(cell_ids, return_index=True, return_inverse=True)
+                merged_counts = np.zeros(len(unique), dtype=np.int64)
+                merged_sums = np.zeros((len(unique), 2))
+                np.add.at(merged_counts, inverse, counts)
+                np.add.at(merged_sums, inverse, sums)
+                # `index` is the first occurrence, existing cells keep their first point
+                self._cells[zoom] = (unique, merged_counts, merged_sums, first[index])
+        return self
+
+    def _zoom_arrays(self, zoom: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        cell_ids, counts, sums, first = self._cells[zoom]
+        return cell_ids, counts, sums / np.maximum(counts, 1)[:, None], first
+
+    @staticmethod
+    def _bbox_mask(xy: np.ndarray, bbox: Tuple[float, float, float, float]) -> np.ndarray:
+        min_lng, min_lat, max_lng, max_lat = bbox
+        corners = web_mercator([min_lng, max_lng], [max_lat, min_lat])
+        (min_x, min_y), (max_x, max_y) = corners
+        mask_y = (xy[:, 1] >= min_y) & (xy[:, 1] <= max_y)
+        if min_lng <= max_lng:
+            return mask_y & (xy[:, 0] >= min_x) & (xy[:, 0] <= max_x)
+        # Bbox crossing the antimeridian
+        return mask_y & ((xy[:, 0] >= min_x) | (xy[:, 0] <= max_x))
+
+    def cluster_bbox(self, bbox: Tuple[float, float, float, float], zoom: float) -> Tuple[float, float, float, float]:
+        """
+        Bbox holding every point that can count towards `get_clusters(bbox, zoom)`,
+        a cluster centroid inside `bbox` has members up to one grid cell away
+        """
+        zoom = max(self.min_zoom, int(zoom))
+        if zoom > self.max_zoom:
+            return bbox
+        pad = 1 / self._cells_per_side(zoom)
+        min_lng, min_lat, max_lng, max_lat = bbox
+        (min_x, min_y), (max_x, max_y) = web_mercator([min_lng, max_lng], [max_lat, min_lat])
+        (min_lng, max_lat), (max_lng, min_lat) = inverse_web_mercator(
+            [[max(min_x - pad, 0), max(min_y - pad, 0)], [min(max_x + pad, 1), min(max_y + pad, 1)]]
+        ).tolist()
+        # Grown to the edge of the projection, reach the poles too
+        return (
+            min_lng, -90. if max_y + pad >= 1 else min_lat,
+            max_lng, 90. if min_y - pad <= 0 else max_lat,
+        )
+
+    def get_clusters(self, bbox: Tuple[float, float, float, float], zoom: float) -> List[Dict]:
+        """
+        Clusters and single points inside a bbox at a zoom level
+
+        Parameters
+        -----------
+            bbox tuple
+                (min_lng, min_lat, max_lng, max_lat)
+            zoom float
+                Map zoom, fractional zooms use the level below
+        Returns
+        -----------
+            clusters list
+                {'cluster': bool, 'count': int, 'longitude': float, 'latitude': float,
+                 'cluster_id': str} for clusters, the original point plus
+                 `'cluster': False` for single points
+        """
+        zoom = max(self.min_zoom, int(zoom))
+        if zoom > self.max_zoom:
+            mask = self._bbox_mask(self._xy, bbox)
+            return [dict(self._points[index], cluster=False) for index in np.flatnonzero(mask).tolist()]
+
+        cell_ids, counts, centroids, first = self._zoom_arrays(zoom)
+        mask = self._bbox_mask(centroids, bbox)
+        lng_lat = inverse_web_mercator(centroids[mask])
+        results = []
+        for cell_id, count, (lng, lat), index in zip(
+            cell_ids[mask].tolist(), counts[mask].tolist(), lng_lat.tolist(), first[mask].tolist()
+        ):
+            if count == 1:
+                results.append(dict(self._points[index], cluster=False))
+            else:
+                results.append({
+                    'cluster': True, 'count': count, 'longitude': lng, 'latitude': lat,
+                    'cluster_id': f"{zoom}:{cell_id}",
+                })
+        return results
+
+    def get_cluster_expansion_zoom(self, cluster_id: str) -> int:
+        """
+        First zoom at which the points of a cluster stop being one cluster
+        """
+        zoom, cell_id = (int(part) for part in cluster_id.split(':'))
+        side = self._cells_per_side(zoom)
+        cell_x, cell_y = cell_id % side, cell_id // side
+        grid = np.minimum((self._xy * side).astype(np.int64), side - 1)
+        members = self._xy[(grid[:, 0] == cell_x) & (grid[:, 1] == cell_y)]
+        for next_zoom in range(zoom + 1, self.max_zoom + 1):
+            next_side = self._cells_per_side(next_zoom)
+            cells = np.minimum((members * next_side).astype(np.int64), next_side - 1)
+            if len(np.unique(cells[:, 1] * next_side + cells[:, 0])) > 1:
+                return next_zoom
+        return self.max_zoom + 1
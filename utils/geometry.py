@@ -1,6 +1,9 @@
+import math
 import numpy as np
 
 EARTH_RADIUS_MILES = 3958.756
+METERS_PER_MILE = 1609.344
+MAX_MERCATOR_LAT = 85.0511287798
 
 
 def lat_lng_dist(lat_lng_1: tuple, lat_lng_2: tuple) -> float:
@@ -21,11 +24,869 @@ def lat_lng_dist(lat_lng_1: tuple, lat_lng_2: tuple) -> float:
 		Float
 			Distance as the crow flies from origin lat/lng to destination lat/lng assuming the earth is a sphere or radius EARTH_RADIUS_MILES miles.
 	"""
-	lat1_rad = float(lat_lng_1[0]) * np.pi / 180
-	lng1_rad = float(lat_lng_1[1]) * np.pi / 180
-	lat2_rad = float(lat_lng_2[0]) * np.pi / 180
-	lng2_rad = float(lat_lng_2[1]) * np.pi / 180
-	dlat = lat2_rad - lat1_rad
-	dlng = lng2_rad - lng1_rad
-	a = np.sin(dlat/2) ** 2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlng/2) ** 2
-	return 2 * EARTH_RADIUS_MILES * np.arctan(a ** .5 / (1-a) ** .5)
\ No newline at end of file
+	# Plain `math`, scalar numpy calls cost more than the arithmetic
+	lat1_rad = float(lat_lng_1[0]) * math.pi / 180
+	lng1_rad = float(lat_lng_1[1]) * math.pi / 180
+	lat2_rad = float(lat_lng_2[0]) * math.pi / 180
+	lng2_rad = float(lat_lng_2[1]) * math.pi / 180
+	a = math.sin((lat2_rad - lat1_rad)/2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin((lng2_rad - lng1_rad)/2) ** 2
+	a = min(a, 1.)
+	return 2 * EARTH_RADIUS_MILES * math.atan2(math.sqrt(a), math.sqrt(1-a))
+
+
+def _radians(lat_lngs) -> np.ndarray:
+	return np.radians(np.asarray(lat_lngs, dtype=np.float64).reshape(-1, 2))
+
+
+def _haversine(lat1, lng1, lat2, lng2, cos_lat1=None, cos_lat2=None, out=None) -> np.ndarray:
+	# Inputs in radians and broadcastable, cosines can be passed in precomputed
+	cos_lat1 = np.cos(lat1) if cos_lat1 is None else cos_lat1
+	cos_lat2 = np.cos(lat2) if cos_lat2 is None else cos_lat2
+	a = np.sin((lat2 - lat1)/2) ** 2 + cos_lat1 * cos_lat2 * np.sin((lng2 - lng1)/2) ** 2
+	np.minimum(a, 1., out=a)
+	distance = np.arctan2(np.sqrt(a), np.sqrt(1-a))
+	distance *= 2 * EARTH_RADIUS_MILES
+	if out is None:
+		return distance
+	out[...] = distance
+	return out
+
+
+def lat_lng_dist_one_to_many(lat_lng: tuple, lat_lngs, dtype=np.float64) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Distance as the crow flies from one point to many, the vectorized
+		form of `lat_lng_dist`.
+
+	Parameters
+	-----------
+		lat_lng: Tuple (float,float)
+			(<float: orig_lat>, <float: orig_lng>)
+		lat_lngs: array-like (m, 2)
+			[(<float: lat>, <float: lng>), ...]
+		dtype: np.float32 | np.float64
+			Result dtype, math is always done in float64
+
+	Returns
+	-----------
+		np.ndarray (m,)
+			Distance in miles to each point in `lat_lngs`
+	"""
+	origin = _radians(lat_lng)[0]
+	rad = _radians(lat_lngs)
+	return _haversine(origin[0], origin[1], rad[:, 0], rad[:, 1]).astype(dtype, copy=False)
+
+
+def lat_lng_dist_paired(lat_lngs_1, lat_lngs_2, dtype=np.float64) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Row-wise distance as the crow flies, `lat_lngs_1[i]` to `lat_lngs_2[i]`.
+
+	Parameters
+	-----------
+		lat_lngs_1: array-like (n, 2)
+			[(<float: lat>, <float: lng>), ...]
+		lat_lngs_2: array-like (n, 2)
+			[(<float: lat>, <float: lng>), ...]
+		dtype: np.float32 | np.float64
+			Result dtype, math is always done in float64
+
+	Returns
+	-----------
+		np.ndarray (n,)
+			Distance in miles for each pair
+	"""
+	rad_1 = _radians(lat_lngs_1)
+	rad_2 = _radians(lat_lngs_2)
+	if len(rad_1) != len(rad_2):
+		raise ValueError('lat_lngs_1 and lat_lngs_2 must have the same length')
+	return _haversine(rad_1[:, 0], rad_1[:, 1], rad_2[:, 0], rad_2[:, 1]).astype(dtype, copy=False)
+
+
+MATRIX_CHUNK_ELEMENTS = 2 ** 20
+
+
+def lat_lng_dist_matrix(lat_lngs_1, lat_lngs_2, dtype=np.float64, chunk_elements: int = MATRIX_CHUNK_ELEMENTS) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Pairwise distance as the crow flies between two sets of points, the
+		vectorized form of `lat_lng_dist`.
+
+	Parameters
+	-----------
+		lat_lngs_1: array-like (n, 2)
+			[(<float: lat>, <float: lng>), ...]
+		lat_lngs_2: array-like (m, 2)
+			[(<float: lat>, <float: lng>), ...]
+		dtype: np.float32 | np.float64
+			Result dtype, float32 halves the memory of large matrices
+		chunk_elements: int
+			Rows are processed in blocks of about this many cells so float64
+			temporaries stay bounded whatever the matrix size
+
+	Returns
+	-----------
+		np.ndarray (n, m)
+			Distance in miles from each point in `lat_lngs_1` to each point in `lat_lngs_2`
+	"""
+	rad_1 = _radians(lat_lngs_1)
+	rad_2 = _radians(lat_lngs_2)
+	cos_1 = np.cos(rad_1[:, 0])
+	cos_2 = np.cos(rad_2[:, 0])
+	result = np.empty((len(rad_1), len(rad_2)), dtype=dtype)
+	rows = max(1, chunk_elements // max(1, len(rad_2)))
+	for start in range(0, len(rad_1), rows):
+		block = slice(start, start + rows)
+		_haversine(
+			rad_1[block, None, 0], rad_1[block, None, 1], rad_2[None, :, 0], rad_2[None, :, 1],
+			cos_lat1=cos_1[block, None], cos_lat2=cos_2[None, :], out=result[block]
+		)
+	return result
+
+
+def bbox_around(lat: float, lng: float, miles: float) -> tuple:
+	"""
+	Description
+	-----------
+		Bounding box holding every point within `miles` of a point. Boxes
+		crossing the antimeridian come back with min_lng > max_lng, boxes
+		reaching a pole span every longitude.
+
+	Parameters
+	-----------
+		lat: float
+			Latitude
+		lng: float
+			Longitude
+		miles: float
+			Radius
+
+	Returns
+	-----------
+		Tuple (float,float,float,float)
+			(<float: min_lng>, <float: min_lat>, <float: max_lng>, <float: max_lat>)
+	"""
+	dlat = math.degrees(float(miles) / EARTH_RADIUS_MILES)
+	min_lat, max_lat = float(lat) - dlat, float(lat) + dlat
+	if min_lat <= -90 or max_lat >= 90:
+		return (-180., max(min_lat, -90.), 180., min(max_lat, 90.))
+	# Widest longitude span is at the latitude farthest from the equator
+	dlng = math.degrees(math.asin(min(1., math.sin(float(miles) / EARTH_RADIUS_MILES) / math.cos(math.radians(lat)))))
+	if dlng >= 180:
+		return (-180., min_lat, 180., max_lat)
+	min_lng, max_lng = float(lng) - dlng, float(lng) + dlng
+	if min_lng < -180:
+		min_lng += 360
+	if max_lng > 180:
+		max_lng -= 360
+	return (min_lng, min_lat, max_lng, max_lat)
+
+
+def web_mercator(lng, lat) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Project coordinates to normalized Web Mercator, the unit square used by
+		map tiles with (0, 0) at the top left.
+
+	Parameters
+	-----------
+		lng: array-like (n,)
+			Longitudes
+		lat: array-like (n,)
+			Latitudes, clipped to the Web Mercator limit
+
+	Returns
+	-----------
+		np.ndarray (n, 2)
+			[[<float: x>, <float: y>], ...] in [0, 1]
+	"""
+	lng = np.asarray(lng, dtype=np.float64)
+	lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+	x = (lng + 180) / 360
+	y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+	return np.column_stack((x, y))
+
+
+def inverse_web_mercator(xy) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Inverse of `web_mercator`.
+
+	Parameters
+	-----------
+		xy: array-like (n, 2)
+			Normalized Web Mercator coordinates
+
+	Returns
+	-----------
+		np.ndarray (n, 2)
+			[[<float: lng>, <float: lat>], ...]
+	"""
+	xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+	lng = xy[:, 0] * 360 - 180
+	lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * xy[:, 1]))))
+	return np.column_stack((lng, lat))
+
+def polyline_deltas(polyline: str) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Integer deltas stored in an encoded polyline, before the cumulative
+		sum and scaling, vectorized over the whole string.
+
+	Parameters
+	-----------
+		polyline: str
+			Encoded polyline string
+
+	Returns
+	-----------
+		np.ndarray (n, 2) int64
+			[[<int: lat delta>, <int: lng delta>], ...], the first row is absolute
+	"""
+	if not polyline:
+		return np.empty((0, 2), dtype=np.int64)
+	chunks = np.frombuffer(polyline.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+	# Chunk below 0x20 terminates a value, every value starts after a terminator
+	ends = np.flatnonzero(chunks < 0x20)
+	starts = np.concatenate(([0], ends[:-1] + 1))
+	position = np.arange(chunks.size) - np.repeat(starts, ends - starts + 1)
+	values = np.add.reduceat((chunks & 0x1f) << (5 * position), starts)
+	# Zigzag decode
+	values = (values >> 1) ^ -(values & 1)
+	return values.reshape(-1, 2)
+
+
+def decode_polyline(polyline: str, precision: int = 6) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Decode an encoded polyline (Mapbox `polyline6` by default), vectorized
+		over the whole string.
+
+	Parameters
+	-----------
+		polyline: str
+			Encoded polyline string
+		precision: int
+			Decimal places encoded, 6 for `polyline6`, 5 for `polyline`
+
+	Returns
+	-----------
+		np.ndarray (n, 2) float64
+			[[<float: lat>, <float: lng>], ...]
+	"""
+	# Undo the delta encoding
+	return np.cumsum(polyline_deltas(polyline), axis=0) / 10 ** precision
+
+
+def encode_polyline_deltas(deltas) -> str:
+	"""
+	Description
+	-----------
+		Encode integer deltas as a polyline, the inverse of `polyline_deltas`,
+		vectorized over the whole array.
+
+	Parameters
+	-----------
+		deltas: array-like (n, 2) int
+			[(<int: lat delta>, <int: lng delta>), ...], the first row is absolute
+
+	Returns
+	-----------
+		str
+			Encoded polyline string
+	"""
+	values = np.asarray(deltas, dtype=np.int64).ravel()
+	if values.size == 0:
+		return ''
+	# Zigzag encode so small negative deltas stay short
+	values = (values << 1) ^ (values >> 63)
+	# 7 chunks of 5 bits cover any delta on the globe at precision 6
+	shifts = 5 * np.arange(7)
+	chunks = (values[:, None] >> shifts) & 0x1f
+	lengths = np.maximum(1, (np.floor(np.log2(np.maximum(values, 1))).astype(np.int64) // 5) + 1)
+	used = np.arange(7) < lengths[:, None]
+	more = np.arange(7) < (lengths - 1)[:, None]
+	chunks = chunks | (more * 0x20)
+	return (chunks[used] + 63).astype(np.uint8).tobytes().decode('ascii')
+
+
+def encode_polyline(coordinates, precision: int = 6) -> str:
+	"""
+	Description
+	-----------
+		Encode coordinates as a polyline (Mapbox `polyline6` by default),
+		vectorized over the whole coordinate array.
+
+	Parameters
+	-----------
+		coordinates: array-like (n, 2)
+			[(<float: lat>, <float: lng>), ...]
+		precision: int
+			Decimal places encoded, 6 for `polyline6`, 5 for `polyline`
+
+	Returns
+	-----------
+		str
+			Encoded polyline string
+	"""
+	coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+	scaled = np.round(coordinates * 10 ** precision).astype(np.int64)
+	return encode_polyline_deltas(np.diff(scaled, axis=0, prepend=0))
+
+
+def _local_meters(coordinates: np.ndarray) -> np.ndarray:
+	# Equirectangular projection around the mean latitude, accurate enough for
+	# tolerance checks over the span of a route
+	lat0 = np.radians(coordinates[:, 0].mean())
+	meters_per_radian = EARTH_RADIUS_MILES * METERS_PER_MILE
+	return np.column_stack((
+		np.radians(coordinates[:, 1]) * np.cos(lat0) * meters_per_radian,
+		np.radians(coordinates[:, 0]) * meters_per_radian,
+	))
+
+
+def simplify_coordinates(coordinates, tolerance_meters: float) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Douglas-Peucker line simplification, endpoints are always kept.
+
+	Parameters
+	-----------
+		coordinates: array-like (n, 2)
+			[(<float: lat>, <float: lng>), ...]
+		tolerance_meters: float
+			Max distance in meters a removed vertex may be from the simplified line
+
+	Returns
+	-----------
+		np.ndarray (m, 2)
+			Subset of the input coordinates, m <= n
+	"""
+	coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+	if len(coordinates) < 3 or tolerance_meters <= 0:
+		return coordinates
+	points = _local_meters(coordinates)
+	keep = np.zeros(len(points), dtype=bool)
+	keep[0] = keep[-1] = True
+
+	stack = [(0, len(points) - 1)]
+	while stack:
+		first, last = stack.pop()
+		if last - first < 2:
+			continue
+		start = points[first]
+		segment = points[last] - start
+		offsets = points[first + 1:last] - start
+		length_sq = segment @ segment
+		if length_sq == 0:
+			distances = np.hypot(offsets[:, 0], offsets[:, 1])
+		else:
+			# Perpendicular distance to the chord
+			distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length_sq ** .5
+		index = int(np.argmax(distances))
+		if distances[index] > tolerance_meters:
+			split = first + 1 + index
+			keep[split] = True
+			stack.append((first, split))
+			stack.append((split, last))
+
+	return coordinates[keep]
+
+
+def simplify_polyline(polyline: str, tolerance_meters: float, precision: int = 6) -> str:
+	"""
+	Description
+	-----------
+		Decode, simplify and re-encode a polyline.
+
+	Parameters
+	-----------
+		polyline: str
+			Encoded polyline string
+		tolerance_meters: float
+			Max distance in meters a removed vertex may be from the simplified line
+		precision: int
+			Decimal places encoded, 6 for `polyline6`, 5 for `polyline`
+
+	Returns
+	-----------
+		str
+			Encoded simplified polyline string
+	"""
+	return encode_polyline(
+		simplify_coordinates(decode_polyline(polyline, precision), tolerance_meters), precision
+	)
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_MAX_PRECISION = 12
+
+
+def geohash_encode(lat: float, lng: float, precision: int = GEOHASH_MAX_PRECISION) -> str:
+	"""
+	Description
+	-----------
+		Geohash of a point, nearby points share a prefix so a bbox becomes a
+		handful of string range scans on an ordinary index.
+
+	Parameters
+	-----------
+		lat: float
+			Latitude
+		lng: float
+			Longitude
+		precision: int
+			Characters, 12 is ~4 cm
+
+	Returns
+	-----------
+		str
+			Geohash
+	"""
+	lat_range = [-90.0, 90.0]
+	lng_range = [-180.0, 180.0]
+	chars = []
+	bits = 0
+	value = 0
+	even = True
+	while len(chars) < precision:
+		interval, coordinate = (lng_range, lng) if even else (lat_range, lat)
+		mid = (interval[0] + interval[1]) / 2
+		value <<= 1
+		if coordinate >= mid:
+			value |= 1
+			interval[0] = mid
+		else:
+			interval[1] = mid
+		even = not even
+		bits += 1
+		if bits == 5:
+			chars.append(GEOHASH_ALPHABET[value])
+			bits = value = 0
+	return ''.join(chars)
+
+
+def _geohash_cell_size(precision: int) -> tuple:
+	lng_bits = (5 * precision + 1) // 2
+	lat_bits = (5 * precision) // 2
+	return 180 / 2 ** lat_bits, 360 / 2 ** lng_bits
+
+
+def _geohash_grid(bbox: tuple, precision: int) -> tuple:
+	min_lng, min_lat, max_lng, max_lat = bbox
+	min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+	min_lng, max_lng = max(min_lng, -180.0), min(max_lng, 180.0)
+	height, width = _geohash_cell_size(precision)
+	rows = range(int((min_lat + 90) // height), int(min(max_lat + 90, 180 - 1e-9) // height) + 1)
+	cols = range(int((min_lng + 180) // width), int(min(max_lng + 180, 360 - 1e-9) // width) + 1)
+	return height, width, rows, cols
+
+
+def _geohash_grid_cells(precision: int, height: float, width: float, rows: range, cols: range) -> list:
+	return sorted({
+		geohash_encode((row + .5) * height - 90, (col + .5) * width - 180, precision)
+		for row in rows for col in cols
+	})
+
+
+def geohash_cells(bbox: tuple, precision: int, max_cells: int = None) -> list:
+	"""
+	Description
+	-----------
+		Geohash cells of one precision intersecting a bounding box.
+
+	Parameters
+	-----------
+		bbox: Tuple (float,float,float,float)
+			(<float: min_lng>, <float: min_lat>, <float: max_lng>, <float: max_lat>)
+		precision: int
+			Characters per geohash
+		max_cells: int
+			Upper bound on the number of cells, None when the bbox needs more
+
+	Returns
+	-----------
+		List [str]
+			Sorted geohashes, None above `max_cells`
+	"""
+	height, width, rows, cols = _geohash_grid(bbox, precision)
+	if max_cells is not None and len(rows) * len(cols) > max_cells:
+		return None
+	return _geohash_grid_cells(precision, height, width, rows, cols)
+
+
+def geohash_cover(bbox: tuple, max_cells: int = 16) -> list:
+	"""
+	Description
+	-----------
+		Geohash prefixes covering a bounding box, at the finest precision that
+		needs no more than `max_cells` prefixes.
+
+	Parameters
+	-----------
+		bbox: Tuple (float,float,float,float)
+			(<float: min_lng>, <float: min_lat>, <float: max_lng>, <float: max_lat>)
+		max_cells: int
+			Upper bound on the number of prefixes returned
+
+	Returns
+	-----------
+		List [str]
+			Sorted geohash prefixes, empty string when the bbox needs the whole world
+	"""
+	best = None
+	for precision in range(1, GEOHASH_MAX_PRECISION + 1):
+		grid = _geohash_grid(bbox, precision)
+		if len(grid[2]) * len(grid[3]) > max_cells:
+			break
+		best = (precision,) + grid
+	if best is None:
+		return ['']
+	return _geohash_grid_cells(*best)
+
+
+def geohash_prefix_range(prefix: str) -> tuple:
+	"""
+	Description
+	-----------
+		Half open string range [low, high) holding every geohash starting with
+		`prefix`, high is None when the range is unbounded above.
+
+	Parameters
+	-----------
+		prefix: str
+			Geohash prefix
+
+	Returns
+	-----------
+		Tuple (str,str)
+			(<str: low>, <str: high or None>)
+	"""
+	chars = list(prefix)
+	while chars:
+		index = GEOHASH_ALPHABET.index(chars[-1])
+		if index + 1 < len(GEOHASH_ALPHABET):
+			chars[-1] = GEOHASH_ALPHABET[index + 1]
+			return prefix, ''.join(chars)
+		chars.pop()
+	return prefix, None
+
+
+def lat_lng_to_unit_xyz(lat_lngs) -> np.ndarray:
+	"""
+	Description
+	-----------
+		Points on the unit sphere, euclidean (chord) distance between them is
+		monotonic in great circle distance.
+
+	Parameters
+	-----------
+		lat_lngs: array-like (n, 2)
+			[(<float: lat>, <float: lng>), ...]
+
+	Returns
+	-----------
+		np.ndarray (n, 3)
+			Unit vectors
+	"""
+	rad = np.radians(np.asarray(lat_lngs, dtype=np.float64).reshape(-1, 2))
+	cos_lat = np.cos(rad[:, 0])
+	return np.column_stack((cos_lat * np.cos(rad[:, 1]), cos_lat * np.sin(rad[:, 1]), np.sin(rad[:, 0])))
+
+
+def chord_to_miles(chord) -> np.ndarray:
+	return 2 * EARTH_RADIUS_MILES * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+def miles_to_chord(miles: float) -> float:
+	return 2 * np.sin(min(float(miles) / EARTH_RADIUS_MILES, np.pi) / 2)
+
+
+class SpatialIndex(object):
+	"""
+	Description
+	-----------
+		Nearest neighbour index, a KD-tree over unit sphere coordinates stored
+		in flat arrays. k-nearest and radius queries visit O(log n) nodes.
+		Inserts land in a small brute force buffer and deletes are tombstones,
+		both are folded into a rebuilt tree once they grow.
+
+	Parameters
+	-----------
+		lat_lngs: array-like (n, 2)
+			[(<float: lat>, <float: lng>), ...]
+		ids: array-like (n,)
+			Numeric or string ids, defaults to the row number
+		leaf_size: int
+			Points per leaf
+	"""
+	_ARRAYS = (
+		'xyz', 'ids', 'alive', 'node_start', 'node_end', 'node_left', 'node_right',
+		'node_min', 'node_max', 'buffer_xyz', 'buffer_ids', 'buffer_alive',
+	)
+
+	def __init__(self, lat_lngs=None, ids=None, leaf_size: int = 32):
+		self.leaf_size = leaf_size
+		lat_lngs = np.empty((0, 2)) if lat_lngs is None else np.asarray(lat_lngs, dtype=np.float64).reshape(-1, 2)
+		ids = np.arange(len(lat_lngs)) if ids is None else self._as_ids(ids)
+		if len(ids) != len(lat_lngs):
+			raise ValueError('ids and lat_lngs must have the same length')
+		self._build(*self._last_unique(lat_lng_to_unit_xyz(lat_lngs), ids))
+
+	@staticmethod
+	def _as_ids(ids) -> np.ndarray:
+		ids = np.asarray(ids).reshape(-1)
+		if ids.dtype == object:
+			raise ValueError('ids must be numbers or strings')
+		return ids
+
+	@staticmethod
+	def _last_unique(xyz: np.ndarray, ids: np.ndarray) -> tuple:
+		# A repeated id keeps its last coordinates, earlier rows would stay
+		# alive in the tree with no position pointing at them
+		if len(ids) < 2:
+			return xyz, ids
+		_, last = np.unique(ids[::-1], return_index=True)
+		if len(last) == len(ids):
+			return xyz, ids
+		keep = np.sort(len(ids) - 1 - last)
+		return xyz[keep], ids[keep]
+
+	def _build(self, xyz: np.ndarray, ids: np.ndarray):
+		order = np.arange(len(xyz))
+		nodes = {'start': [], 'end': [], 'left': [], 'right': [], 'min': [], 'max': []}
+
+		def build(start: int, end: int) -> int:
+			node = len(nodes['start'])
+			points = xyz[order[start:end]]
+			nodes['start'].append(start)
+			nodes['end'].append(end)
+			nodes['min'].append(points.min(axis=0))
+			nodes['max'].append(points.max(axis=0))
+			nodes['left'].append(-1)
+			nodes['right'].append(-1)
+			if end - start > self.leaf_size:
+				# Split the widest axis at the median
+				axis = int(np.argmax(nodes['max'][node] - nodes['min'][node]))
+				mid = (start + end) // 2
+				part = np.argpartition(points[:, axis], mid - start)
+				order[start:end] = order[start:end][part]
+				nodes['left'][node] = build(start, mid)
+				nodes['right'][node] = build(mid, end)
+			return node
+
+		if len(xyz):
+			build(0, len(xyz))
+		self.xyz = xyz[order]
+		self.ids = ids[order]
+		self.alive = np.ones(len(xyz), dtype=bool)
+		self.node_start = np.array(nodes['start'], dtype=np.int64)
+		self.node_end = np.array(nodes['end'], dtype=np.int64)
+		self.node_left = np.array(nodes['left'], dtype=np.int64)
+		self.node_right = np.array(nodes['right'], dtype=np.int64)
+		self.node_min = np.array(nodes['min']).reshape(-1, 3)
+		self.node_max = np.array(nodes['max']).reshape(-1, 3)
+		self.buffer_xyz = np.empty((0, 3))
+		self.buffer_ids = ids[:0]
+		self.buffer_alive = np.empty(0, dtype=bool)
+		self._index_nodes()
+
+	def _index_nodes(self):
+		# Python lists for the traversal, scalar numpy access is slow
+		self._bounds = list(zip(self.node_min.tolist(), self.node_max.tolist()))
+		self._children = list(zip(self.node_left.tolist(), self.node_right.tolist()))
+		self._ranges = list(zip(self.node_start.tolist(), self.node_end.tolist()))
+		self._positions = {key: position for position, key in enumerate(self.ids.tolist()) if self.alive[position]}
+		offset = len(self.ids)
+		self._positions.update(
+			(key, offset + position) for position, key in enumerate(self.buffer_ids.tolist())
+			if self.buffer_alive[position]
+		)
+
+	def __len__(self):
+		return len(self._positions)
+
+	def __contains__(self, key):
+		return key in self._positions
+
+	def rebuild(self):
+		alive = np.concatenate((self.alive, self.buffer_alive))
+		self._build(np.vstack((self.xyz, self.buffer_xyz))[alive], np.concatenate((self.ids, self.buffer_ids))[alive])
+
+	def insert(self, lat_lngs, ids):
+		"""
+		Add points, an existing id is moved to its new coordinates, an id
+		repeated in `ids` takes its last coordinates
+		"""
+		ids = self._as_ids(ids)
+		xyz = lat_lng_to_unit_xyz(lat_lngs)
+		if len(ids) != len(xyz):
+			raise ValueError('ids and lat_lngs must have the same length')
+		xyz, ids = self._last_unique(xyz, ids)
+		self.delete(ids)
+		offset = len(self.ids) + len(self.buffer_ids)
+		self.buffer_xyz = np.vstack((self.buffer_xyz, xyz))
+		self.buffer_ids = np.concatenate((self.buffer_ids, ids))
+		self.buffer_alive = np.concatenate((self.buffer_alive, np.ones(len(ids), dtype=bool)))
+		self._positions.update((key, offset + position) for position, key in enumerate(ids.tolist()))
+		if len(self.buffer_ids) > max(self.leaf_size * 8, len(self.ids) // 4):
+			self.rebuild()
+
+	def delete(self, ids) -> int:
+		"""
+		Remove points by id, unknown ids are ignored, returns the number removed
+		"""
+		removed = 0
+		for key in self._as_ids(ids).tolist():
+			position = self._positions.pop(key, None)
+			if position is None:
+				continue
+			if position < len(self.ids):
+				self.alive[position] = False
+			else:
+				self.buffer_alive[position - len(self.ids)] = False
+			removed += 1
+		if len(self.ids) and int(self.alive.sum()) < len(self.ids) // 2:
+			self.rebuild()
+		return removed
+
+	def _min_dist2(self, node: int, q: tuple) -> float:
+		low, high = self._bounds[node]
+		total = 0.
+		for value, lo, hi in zip(q, low, high):
+			if value < lo:
+				total += (lo - value) ** 2
+			elif value > hi:
+				total += (value - hi) ** 2
+		return total
+
+	def _leaf_dist2(self, node: int, q: np.ndarray) -> tuple:
+		start, end = self._ranges[node]
+		dist2 = ((self.xyz[start:end] - q) ** 2).sum(axis=1)
+		positions = np.arange(start, end)
+		alive = self.alive[start:end]
+		return dist2[alive], positions[alive]
+
+	def _buffer_dist2(self, q: np.ndarray) -> tuple:
+		dist2 = ((self.buffer_xyz - q) ** 2).sum(axis=1)
+		positions = np.arange(len(self.buffer_ids)) + len(self.ids)
+		return dist2[self.buffer_alive], positions[self.buffer_alive]
+
+	def _result(self, dist2: np.ndarray, positions: np.ndarray) -> tuple:
+		order = np.argsort(dist2, kind='stable')
+		ids = np.concatenate((self.ids, self.buffer_ids))[positions[order]]
+		return ids, chord_to_miles(np.sqrt(dist2[order]))
+
+	def query(self, lat: float, lng: float, k: int = 1) -> tuple:
+		"""
+		Description
+		-----------
+			k nearest points.
+
+		Parameters
+		-----------
+			lat: float
+				Latitude
+			lng: float
+				Longitude
+			k: int
+				Number of neighbours, none for k <= 0
+
+		Returns
+		-----------
+			Tuple (np.ndarray, np.ndarray)
+				(<ids nearest first>, <distances in miles>), shorter than k when the index holds fewer points
+		"""
+		if k <= 0:
+			return self.ids[:0], np.empty(0)
+		q = lat_lng_to_unit_xyz([(lat, lng)])[0]
+		best_dist2, best_positions = self._buffer_dist2(q)
+		q_tuple = tuple(q.tolist())
+
+		def keep(dist2, positions):
+			if len(dist2) > k:
+				part = np.argpartition(dist2, k - 1)[:k]
+				return dist2[part], positions[part]
+			return dist2, positions
+
+		best_dist2, best_positions = keep(best_dist2, best_positions)
+		stack = [(0., 0)] if len(self._ranges) else []
+		while stack:
+			dist2, node = stack.pop()
+			if len(best_dist2) == k and dist2 >= best_dist2.max():
+				continue
+			left, right = self._children[node]
+			if left < 0:
+				leaf_dist2, leaf_positions = self._leaf_dist2(node, q)
+				best_dist2, best_positions = keep(
+					np.concatenate((best_dist2, leaf_dist2)), np.concatenate((best_positions, leaf_positions))
+				)
+				continue
+			near = [(self._min_dist2(child, q_tuple), child) for child in (left, right)]
+			# Farther child first so the nearer one is popped next
+			stack.extend(sorted(near, reverse=True))
+		return self._result(best_dist2, best_positions)
+
+	def query_radius(self, lat: float, lng: float, miles: float) -> tuple:
+		"""
+		Description
+		-----------
+			Every point within a great circle radius.
+
+		Parameters
+		-----------
+			lat: float
+				Latitude
+			lng: float
+				Longitude
+			miles: float
+				Radius
+
+		Returns
+		-----------
+			Tuple (np.ndarray, np.ndarray)
+				(<ids nearest first>, <distances in miles>)
+		"""
+		q = lat_lng_to_unit_xyz([(lat, lng)])[0]
+		q_tuple = tuple(q.tolist())
+		radius2 = miles_to_chord(miles) ** 2
+		found = [self._buffer_dist2(q)]
+		stack = [0] if len(self._ranges) else []
+		while stack:
+			node = stack.pop()
+			if self._min_dist2(node, q_tuple) > radius2:
+				continue
+			left, right = self._children[node]
+			if left < 0:
+				found.append(self._leaf_dist2(node, q))
+			else:
+				stack.extend((left, right))
+		dist2 = np.concatenate([dist2 for dist2, _ in found])
+		positions = np.concatenate([positions for _, positions in found])
+		inside = dist2 <= radius2
+		return self._result(dist2[inside], positions[inside])
+
+	def save(self, file):
+		"""
+		Write the index with `np.savez`, no pickled objects so any worker can
+		load it safely
+		"""
+		np.savez(file, leaf_size=self.leaf_size, **{name: getattr(self, name) for name in self._ARRAYS})
+
+	@classmethod
+	def load(cls, file) -> 'SpatialIndex':
+		with np.load(file, allow_pickle=False) as data:
+			index = cls.__new__(cls)
+			index.leaf_size = int(data['leaf_size'])
+			for name in cls._ARRAYS:
+				setattr(index, name, data[name])
+		index._index_nodes()
+		return index
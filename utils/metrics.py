@@ -0,0 +1,242 @@
+"""
+Metrics -> In-process counters and histograms flushed to Redis, rendered in
+the Prometheus text format
+
+Every process aggregates samples in memory and a background thread adds them
+to one Redis hash at most every `METRICS_FLUSH_INTERVAL` seconds, so the hot
+path never waits on the network. Histogram buckets are stored cumulative, so summing the deltas of
+all workers still gives a valid histogram.
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import threading
+from time import monotonic
+from typing import Dict, Iterator, Tuple
+
+logger = logging.getLogger('service')
+
+# Seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+WAYPOINT_BUCKETS = (2, 5, 10, 25, 50, 100, 250)
+
+METRICS_KEY = 'metrics:v1'
+METRIC_TYPES_KEY = 'metrics:v1:types'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name: str, labels: Dict) -> str:
+    if not labels:
+        return name
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{pairs}}}"
+
+
+def _format_le(bound: float) -> str:
+    return repr(float(bound)) if bound != int(bound) else f"{int(bound)}.0"
+
+
+class MetricsRegistry(object):
+    """
+    Parameters
+    -----------
+        flush_interval float
+            Seconds between flushes to Redis, 0 flushes after every sample
+            unless the previous flush is still running
+    """
+
+    def __init__(self, flush_interval: float = None):
+        self.flush_interval = flush_interval
+        self._pending = defaultdict(float) # series -> value since the last flush
+        self._local = defaultdict(float) # series -> value since start, used without Redis
+        self._types = {}
+        self._lock = threading.Lock()
+        self._last_flush = monotonic()
+        self._flushing = False
+        self._redis = None
+
+    @property
+    def enabled(self) -> bool:
+        return getattr(settings, 'METRICS_ENABLED', True)
+
+    def _get_flush_interval(self) -> float:
+        if self.flush_interval is not None:
+            return self.flush_interval
+        return getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+
+    def _add(self, samples: Dict[str, float], name: str, metric_type: str):
+        with self._lock:
+            self._types[name] = metric_type
+            for series, value in samples.items():
+                self._pending[series] += value
+                self._local[series] += value
+            # At most one flush in flight, samples arriving meanwhile wait for the next
+            due = not self._flushing and monotonic() - self._last_flush >= self._get_flush_interval()
+            if due:
+                self._flushing = True
+        if due:
+            threading.Thread(target=self._flush_in_background, name='metrics-flush', daemon=True).start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            self._flushing = False
+
+    def incr(self, name: str, value: float = 1, **labels):
+        """
+        Add to the counter `name`
+        """
+        if not self.enabled:
+            return
+        self._add({_series(name, labels): value}, name, 'counter')
+
+    def observe(self, name: str, value: float, buckets: Tuple = LATENCY_BUCKETS, **labels):
+        """
+        Record one value in the histogram `name`
+        """
+        if not self.enabled:
+            return
+        samples = {
+            _series(f"{name}_bucket", dict(labels, le=_format_le(bound))): 1
+            for bound in buckets if value <= bound
+        }
+        samples[_series(f"{name}_bucket", dict(labels, le='+Inf'))] = 1
+        samples[_series(f"{name}_sum", labels)] = value
+        samples[_series(f"{name}_count", labels)] = 1
+        # Buckets a value does not reach still have to be exported as 0
+        for bound in buckets:
+            samples.setdefault(_series(f"{name}_bucket", dict(labels, le=_format_le(bound))), 0)
+        self._add(samples, name, 'histogram')
+
+    @contextmanager
+    def timer(self, name: str, buckets: Tuple = LATENCY_BUCKETS, **labels) -> Iterator[None]:
+        """
+        Observe the seconds spent in the block
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, buckets=buckets, **labels)
+
+    def _get_redis(self):
+        if self._redis is None:
+            try:
+                from django_redis import get_redis_connection
+                self._redis = get_redis_connection('default')
+            except Exception:
+                # Not a redis cache, samples stay in process
+                self._redis = False
+        return self._redis
+
+    def flush(self) -> bool:
+        """
+        Add the pending samples to the shared hash, returns False when they
+        stay in process (no Redis or the write failed)
+        """
+        with self._lock:
+            self._last_flush = monotonic()
+            pending, self._pending = self._pending, defaultdict(float)
+            types = dict(self._types)
+        redis = self._get_redis()
+        if not redis:
+            return False
+        if not pending:
+            return True
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            for series, value in pending.items():
+                pipeline.hincrbyfloat(cache.make_key(METRICS_KEY), series, value)
+            pipeline.hset(cache.make_key(METRIC_TYPES_KEY), mapping=types)
+            pipeline.execute()
+        except Exception:
+            logger.warning("Metrics flush failed", exc_info=True)
+            # Keep the deltas for the next flush
+            with self._lock:
+                for series, value in pending.items():
+                    self._pending[series] += value
+            return False
+        return True
+
+    def collect(self) -> Tuple[Dict[str, float], Dict[str, str]]:
+        """
+        Cluster wide samples from Redis, this process only without it
+
+        Returns
+        -----------
+            samples dict
+                {series: value}
+            types dict
+                {metric name: 'counter' | 'histogram'}
+        """
+        if self.flush():
+            try:
+                redis = self._get_redis()
+                samples = redis.hgetall(cache.make_key(METRICS_KEY))
+                types = redis.hgetall(cache.make_key(METRIC_TYPES_KEY))
+                return (
+                    {series.decode('utf-8'): float(value) for series, value in samples.items()},
+                    {name.decode('utf-8'): value.decode('utf-8') for name, value in types.items()},
+                )
+            except Exception:
+                logger.warning("Metrics read failed, serving this process only", exc_info=True)
+        with self._lock:
+            return dict(self._local), dict(self._types)
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition of `collect()`
+        """
+        samples, types = self.collect()
+        families = defaultdict(list)
+        for series, value in samples.items():
+            base = series.split('{', 1)[0]
+            name = base
+            for suffix in ('_bucket', '_sum', '_count'):
+                if base.endswith(suffix) and types.get(base[:-len(suffix)]) == 'histogram':
+                    name = base[:-len(suffix)]
+                    break
+            families[name].append((series, value))
+
+        lines = []
+        for name in sorted(families):
+            lines.append(f"# TYPE {name} {types.get(name, 'untyped')}")
+            for series, value in sorted(families[name], key=_sample_sort_key):
+                lines.append(f"{series} {int(value) if value == int(value) else repr(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+            self._local.clear()
+            self._types.clear()
+
+
+def _sample_sort_key(sample: Tuple[str, float]) -> Tuple:
+    # Buckets in ascending `le` order, Prometheus expects +Inf last
+    series = sample[0]
+    labels = series.partition('{')[2]
+    le = None
+    for pair in labels.rstrip('}').split(','):
+        if pair.startswith('le="'):
+            le = pair[4:-1]
+            labels = labels.replace(pair, '')
+    bound = float('inf') if le == '+Inf' else float(le) if le is not None else -1
+    return series.split('{', 1)[0], labels, bound
+
+
+METRICS = MetricsRegistry()
+
+incr = METRICS.incr
+observe = METRICS.observe
+timer = METRICS.timer
@@ -1,8 +1,11 @@
 from django.contrib.auth.mixins import UserPassesTestMixin
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from django.views.generic.base import ContextMixin
 
+from hashlib import sha1
 import logging
 
 api_logger = logging.getLogger('api')
@@ -58,4 +61,41 @@ class CustomerViewMixin(CustomerPermissionsViewMixin):
         else:
             if obj.customer != customer:
                 raise Exception('Cross customer exception error')
-        super().save_model(request, obj, form, change)
\ No newline at end of file
+        super().save_model(request, obj, form, change)
+
+
+def make_etag(*parts) -> str:
+    """
+    Strong ETag value from the parts that determine a response
+    """
+    return sha1(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class ConditionalGetMixin:
+    """
+    ETag / `If-None-Match` handling and a per view Cache-Control policy
+
+    `get_etag` runs before the handler, a matching `If-None-Match` returns
+    304 without calling it. Views only need to put everything the response
+    depends on into the ETag. A handler marks a degraded response (e.g. an
+    upstream failed) with `Cache-Control: no-store`, it then gets no ETag
+    and the view policy is not applied.
+    """
+    cache_control = None # patch_cache_control kwargs, e.g. {'private': True, 'max_age': 60}
+
+    def get_etag(self, request, *args, **kwargs) -> str:
+        return None
+
+    def get_cache_control(self) -> dict:
+        return self.cache_control or {}
+
+    def dispatch(self, request, *args, **kwargs):
+        response = condition(etag_func=self.get_etag)(super().dispatch)(request, *args, **kwargs)
+        if 'no-store' in response.get('Cache-Control', ''):
+            # Revalidating would keep the degraded body around
+            del response['ETag']
+            return response
+        cache_control = self.get_cache_control()
+        if cache_control and response.status_code in (200, 204, 304):
+            patch_cache_control(response, **cache_control)
+        return response
@@ -1,6 +1,11 @@
 from django.conf import settings
 from django.db import models
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
 
+from utils.geometry import EARTH_RADIUS_MILES, bbox_around
+
+import math
 import uuid
 
 class Common(models.Model):
@@ -22,4 +27,93 @@ class Common(models.Model):
 		return self._meta
 
 	class Meta:
-		abstract = True
\ No newline at end of file
+		abstract = True
+
+
+class GeoQuerySetMixin:
+	"""
+	Spatial filters for models with latitude / longitude columns on plain
+	PostgreSQL. Queries narrow rows with a bounding box range filter an index
+	can serve, then refine with exact haversine in SQL.
+	"""
+	latitude_field = 'latitude'
+	longitude_field = 'longitude'
+
+	def bbox_q(self, bbox: tuple) -> Q:
+		"""
+		Bounding box (min_lng, min_lat, max_lng, max_lat) as a Q, min_lng >
+		max_lng crosses the antimeridian
+		"""
+		min_lng, min_lat, max_lng, max_lat = bbox
+		lat_q = Q(**{f'{self.latitude_field}__gte': min_lat, f'{self.latitude_field}__lte': max_lat})
+		if min_lng <= max_lng:
+			return lat_q & Q(**{f'{self.longitude_field}__gte': min_lng, f'{self.longitude_field}__lte': max_lng})
+		return lat_q & (
+			Q(**{f'{self.longitude_field}__gte': min_lng}) | Q(**{f'{self.longitude_field}__lte': max_lng})
+		)
+
+	def within_bbox(self, bbox: tuple):
+		return self.filter(self.bbox_q(bbox))
+
+	def annotate_in_bbox(self, bbox: tuple, name: str = 'in_bbox'):
+		"""
+		Flag rows inside the bbox instead of filtering them out, plain
+		lat/lng ranges since every row is read anyway
+		"""
+		return self.annotate(**{name: Case(
+			When(GeoQuerySetMixin.bbox_q(self, bbox), then=Value(True)),
+			default=Value(False), output_field=models.BooleanField()
+		)})
+
+	def distance_expression(self, lat: float, lng: float):
+		"""
+		Haversine distance in miles from a point to each row
+		"""
+		row_lat = Radians(F(self.latitude_field))
+		row_lng = Radians(F(self.longitude_field))
+		a = (
+			Power(Sin((row_lat - math.radians(lat)) / 2), 2) +
+			math.cos(math.radians(lat)) * Cos(row_lat) * Power(Sin((row_lng - math.radians(lng)) / 2), 2)
+		)
+		# Rounding can push `a` a hair above 1, ASIN would raise
+		return 2 * EARTH_RADIUS_MILES * ASin(Sqrt(Least(a, 1.)), output_field=models.FloatField())
+
+	def annotate_distance(self, lat: float, lng: float, name: str = 'distance'):
+		return self.annotate(**{name: self.distance_expression(lat, lng)})
+
+	def within_radius(self, lat: float, lng: float, miles: float,
+					  name: str = 'distance', order_by_distance: bool = False):
+		"""
+		Description
+		-----------
+			Rows within a great circle radius, annotated with their distance.
+
+		Parameters
+		-----------
+			lat: float
+				Latitude
+			lng: float
+				Longitude
+			miles: float
+				Radius
+			name: str
+				Distance annotation name
+			order_by_distance: bool
+				Nearest rows first
+
+		Returns
+		-----------
+			QuerySet
+		"""
+		qs = self.within_bbox(bbox_around(lat, lng, miles)).annotate_distance(lat, lng, name=name)
+		qs = qs.filter(**{f'{name}__lte': miles})
+		if order_by_distance:
+			qs = qs.order_by(name)
+		return qs
+
+
+class GeoQuerySet(GeoQuerySetMixin, models.QuerySet):
+	pass
+
+
+GeoManager = models.Manager.from_queryset(GeoQuerySet)
@@ -0,0 +1,171 @@
+"""
+Mapbox Vector Tile (MVT v2) encoding
+
+Minimal protobuf writer for the vector tile spec, enough for point and line
+layers without pulling in a protobuf dependency.
+https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+"""
+from utils.geometry import web_mercator
+
+import math
+import numpy as np
+import struct
+from typing import Dict, List, Tuple
+
+DEFAULT_EXTENT = 4096
+DEFAULT_BUFFER = 64
+
+GEOMETRY_TYPES = {'Point': 1, 'LineString': 2}
+
+_CMD_MOVE_TO = 1
+_CMD_LINE_TO = 2
+
+
+def tile_bounds(z: int, x: int, y: int, buffer: int = 0,
+                extent: int = DEFAULT_EXTENT) -> Tuple[float, float, float, float]:
+    """
+    Tile bounds as (min_lng, min_lat, max_lng, max_lat), grown by `buffer`
+    tile pixels on every side. A buffer past the edge of the map is clamped,
+    up to the pole when it crosses the top or bottom row
+    """
+    n = 2 ** z
+    pad = buffer / extent
+
+    def lng(column):
+        return min(max(column / n * 360 - 180, -180.), 180.)
+
+    def lat(row):
+        if row < 0:
+            return 90.
+        if row > n:
+            return -90.
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (lng(x - pad), lat(y + 1 + pad), lng(x + 1 + pad), lat(y - pad))
+
+
+def lng_lat_to_tile(lng, lat, z: int, x: int, y: int, extent: int = DEFAULT_EXTENT) -> np.ndarray:
+    """
+    Project coordinates to integer tile space, (0, 0) is the top left corner
+    """
+    n = 2 ** z
+    pixels = (web_mercator(lng, lat) * n - (x, y)) * extent
+    return np.round(pixels).astype(np.int64)
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes_field(field: int, data: bytes) -> bytes:
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _packed(field: int, values: List[int]) -> bytes:
+    return _bytes_field(field, b''.join(_varint(value) for value in values))
+
+
+def _value(value) -> bytes:
+    if isinstance(value, bool):
+        return _key(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        return _key(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    return _bytes_field(1, str(value).encode('utf-8'))
+
+
+def _geometry(geometry_type: str, coordinates: np.ndarray) -> List[int]:
+    commands = []
+    cursor_x = cursor_y = 0
+    if geometry_type == 'Point':
+        points = coordinates.reshape(-1, 2)
+        commands.append(_CMD_MOVE_TO | (len(points) << 3))
+        for px, py in points.tolist():
+            commands.extend((_zigzag(px - cursor_x), _zigzag(py - cursor_y)))
+            cursor_x, cursor_y = px, py
+        return commands
+
+    points = coordinates.reshape(-1, 2)
+    # Drop repeated vertices, zero length LineTo segments are invalid
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(np.diff(points, axis=0) != 0, axis=1)
+    points = points[keep].tolist()
+    if len(points) < 2:
+        return []
+    px, py = points[0]
+    commands.extend((_CMD_MOVE_TO | (1 << 3), _zigzag(px), _zigzag(py)))
+    cursor_x, cursor_y = px, py
+    commands.append(_CMD_LINE_TO | ((len(points) - 1) << 3))
+    for px, py in points[1:]:
+        commands.extend((_zigzag(px - cursor_x), _zigzag(py - cursor_y)))
+        cursor_x, cursor_y = px, py
+    return commands
+
+
+def encode_layer(name: str, features: List[Dict], extent: int = DEFAULT_EXTENT) -> bytes:
+    """
+    Encode one layer
+
+    Parameters
+    -----------
+        name str
+            Layer name
+        features list
+            {'id': int, 'type': 'Point' | 'LineString',
+             'coordinates': tile space array (n, 2), 'properties': dict}
+    Returns
+    -----------
+        layer bytes
+            Encoded `Tile.Layer` message
+    """
+    keys, values = {}, {}
+    encoded_features = []
+    for feature in features:
+        geometry = _geometry(feature['type'], np.asarray(feature['coordinates']))
+        if not geometry:
+            continue
+        tags = []
+        for key, value in (feature.get('properties') or {}).items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value).__name__, value), len(values)))
+        message = b''
+        if feature.get('id') is not None:
+            message += _key(1, 0) + _varint(int(feature['id']))
+        if tags:
+            message += _packed(2, tags)
+        message += _key(3, 0) + _varint(GEOMETRY_TYPES[feature['type']])
+        message += _packed(4, geometry)
+        encoded_features.append(message)
+
+    layer = _key(15, 0) + _varint(2) + _bytes_field(1, name.encode('utf-8'))
+    layer += b''.join(_bytes_field(2, feature) for feature in encoded_features)
+    layer += b''.join(_bytes_field(3, key.encode('utf-8')) for key in keys)
+    layer += b''.join(_bytes_field(4, _value(value)) for _, value in values)
+    layer += _key(5, 0) + _varint(extent)
+    return layer
+
+
+def encode_tile(layers: Dict[str, List[Dict]], extent: int = DEFAULT_EXTENT) -> bytes:
+    """
+    Encode a tile from `{layer name: features}`, empty layers are skipped
+    """
+    return b''.join(
+        _bytes_field(3, encode_layer(name, features, extent))
+        for name, features in layers.items() if features
+    )
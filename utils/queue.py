@@ -23,11 +23,16 @@ class QueueConnection(object):
         self.queues = queues
         self.connection = None
     
-    def _get_connection_params(self, connection_attempts: int = 5, heartbeat: int = None):
+    def _get_connection_params(self, connection_attempts: int = 5, heartbeat: int = None, timeout: float = None):
         credentials = pika.PlainCredentials(self.user, self.password)
+        # Bound connecting, the AMQP handshake and a blocked broker, pika's own
+        # defaults are used otherwise
+        timeouts = {
+            'socket_timeout': timeout, 'stack_timeout': timeout, 'blocked_connection_timeout': timeout
+        } if timeout else {}
         return pika.ConnectionParameters(
             host=self.host, port=self.port, virtual_host=self.virtual_host,
-            credentials=credentials, connection_attempts=connection_attempts, heartbeat=heartbeat
+            credentials=credentials, connection_attempts=connection_attempts, heartbeat=heartbeat, **timeouts
         )
 
     def _establish_connection(self, initial=False, wait=True):
@@ -80,9 +85,11 @@ class QueueConnection(object):
             self._establish_connection()
             return self.connection.channel()
 
-    def _send_message(self, queue: str, message: str) -> bool:
+    def _send_message(self, queue: str, message: str, connection_attempts: int = 5, timeout: float = None) -> bool:
         # Establish Connection
-        connection = pika.BlockingConnection(self._get_connection_params())
+        connection = pika.BlockingConnection(
+            self._get_connection_params(connection_attempts=connection_attempts, timeout=timeout)
+        )
         channel = connection.channel()
         # Declare Queue
         channel.queue_declare(queue=queue, durable=True)
@@ -95,10 +102,22 @@ class QueueConnection(object):
         ))
         connection.close()
 
-    def publish(self, queue: str, message: str, fail_count: int = 0) -> bool:
+    def publish(self, queue: str, message: str, fail_count: int = 0, fail_fast: bool = False) -> bool:
+        """
+        Publish `message` to `queue`, retried up to `MAX_FAIL` times
+
+        With `fail_fast` a single connection attempt bounded by
+        `settings.RABBITMQ_PUBLISH_TIMEOUT` is made and the first failure
+        raises, for best effort messages sent from a web request
+        """
         try:
             # Send Message
-            self._send_message(queue=queue, message=message)
+            if fail_fast:
+                self._send_message(
+                    queue=queue, message=message, connection_attempts=1, timeout=settings.RABBITMQ_PUBLISH_TIMEOUT
+                )
+            else:
+                self._send_message(queue=queue, message=message)
             logger.info(
                 f'Queue=`{queue}` Submitted message: {message[0:100]}',
                 extra={'task': 'QueueConnection'}
@@ -109,7 +128,7 @@ class QueueConnection(object):
                 'Failed to publish message', exc_info=True,
                 extra={'task': 'QueueConnection'}
             )
-            if fail_count >= MAX_FAIL:
+            if fail_fast or fail_count >= MAX_FAIL:
                 raise e
             # Increment Fail Count
             fail_count += 1
@@ -144,11 +163,52 @@ QUEUE_CONNECTION = QueueConnection()
 def publish_task(task: str,
                  params: dict,
                  queue: str = 'default',
-                 connection: QueueConnection = QUEUE_CONNECTION) -> bool:
+                 connection: QueueConnection = QUEUE_CONNECTION,
+                 fail_fast: bool = False) -> bool:
     # Build Message
     message = json.dumps({
         "task": task, "params": params}, cls=DjangoJSONEncoder
     )
 
     # Publish Message
-    return connection.publish(queue=queue, message=message)
+    return connection.publish(queue=queue, message=message, fail_fast=fail_fast)
+
+
+def build_task_callback(handlers: dict):
+    """
+    Consumer callback dispatching `publish_task` messages by task name
+
+    Parameters
+    -----------
+        handlers dict
+            Task name -> callable taking the message `params` dict
+    Returns
+    -----------
+        callback callable
+            `on_message_callback` for `QueueConnection.consume`
+    """
+    def callback(channel, method, properties, body):
+        try:
+            message = json.loads(body)
+            handler = handlers[message['task']]
+        except (ValueError, KeyError, TypeError):
+            logger.error(
+                f'Dropping unknown or malformed message: {str(body)[0:100]}',
+                exc_info=True, extra={'task': 'QueueConsumer'}
+            )
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+
+        try:
+            handler(message.get('params') or {})
+        except Exception:
+            # Do not requeue, a failing task would otherwise loop forever
+            logger.error(
+                f'Task `{message["task"]}` failed', exc_info=True,
+                extra={'task': 'QueueConsumer'}
+            )
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    return callback
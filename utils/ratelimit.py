@@ -0,0 +1,113 @@
+"""
+Rate Limiting -> Cluster wide limits on outbound calls to metered APIs
+"""
+from django.core.cache import cache
+
+import logging
+from time import monotonic, sleep, time
+from typing import Tuple
+
+logger = logging.getLogger('service')
+
+
+# Token bucket kept in a Redis hash, refilled from Redis server time so every
+# host sees the same clock. Returns {allowed, seconds until enough tokens}
+TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+
+class TokenBucket(object):
+    """
+    Cluster wide rate limit shared by every worker through the cache
+
+    Uses an atomic Lua token bucket when the cache is django-redis, otherwise
+    falls back to a fixed one minute window counter.
+
+    Parameters
+    -----------
+        name str
+            Bucket name, one per upstream quota
+        rate_per_minute float
+            Sustained rate
+        burst int
+            Bucket capacity, defaults to a sixth of the per minute rate
+    """
+
+    def __init__(self, name: str, rate_per_minute: float, burst: int = None):
+        self.name = name
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst if burst is not None else max(1, int(rate_per_minute // 6))
+        self._script = None
+
+    def _redis_script(self):
+        if self._script is None:
+            try:
+                from django_redis import get_redis_connection
+                self._script = get_redis_connection('default').register_script(TOKEN_BUCKET_SCRIPT)
+            except Exception:
+                # Not a redis cache, use the window counter
+                self._script = False
+        return self._script
+
+    def acquire(self, tokens: int = 1) -> Tuple[bool, float]:
+        """
+        Take tokens without blocking, returns (allowed, seconds to retry after)
+
+        Fails open when the cache is down, the upstream still enforces its quota
+        """
+        try:
+            script = self._redis_script()
+            if script:
+                allowed, wait = script(
+                    keys=[cache.make_key(f"token_bucket:{self.name}")],
+                    args=[self.rate_per_minute / 60., self.burst, tokens]
+                )
+                return bool(allowed), float(wait)
+            return self._acquire_window(tokens)
+        except Exception:
+            logger.warning(f"Rate limiter `{self.name}` unavailable", exc_info=True)
+            return True, 0.
+
+    def _acquire_window(self, tokens: int) -> Tuple[bool, float]:
+        now = time()
+        key = f"token_window:{self.name}:{int(now // 60)}"
+        cache.add(key, 0, 120)
+        count = cache.incr(key, tokens)
+        if count <= self.rate_per_minute:
+            return True, 0.
+        return False, 60 - now % 60
+
+    def wait(self, timeout: float, tokens: int = 1) -> bool:
+        """
+        Block up to `timeout` seconds for tokens, returns False if none came
+        """
+        deadline = monotonic() + timeout
+        while True:
+            allowed, retry_after = self.acquire(tokens)
+            if allowed:
+                return True
+            remaining = deadline - monotonic()
+            if remaining <= 0 or retry_after > remaining:
+                return False
+            sleep(max(retry_after, 0.01))
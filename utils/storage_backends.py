@@ -1,9 +1,9 @@
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 
-from storages.backends.s3boto3 import S3Boto3Storage
-
-if settings.USE_DO_SPACES:
+if settings.USE_REMOTE_FILE_SYSTEM:
+	# Only the remote file system needs django-storages / boto3
+	from storages.backends.s3boto3 import S3Boto3Storage
 
 	class StaticStorage(S3Boto3Storage):
 		location = settings.AWS_STATIC_LOCATION
@@ -30,6 +30,13 @@ if settings.USE_DO_SPACES:
 		file_overwrite = True
 		custom_domain = False
 
+
+	class TileCacheStorage(S3Boto3Storage):
+		location = settings.AWS_TILE_CACHE_LOCATION
+		default_acl = 'private'
+		file_overwrite = True
+		custom_domain = False
+
 else:
 	
 	class StaticStorage(FileSystemStorage):
@@ -45,4 +52,17 @@ else:
 
 
 	class PrivateDataStorage(FileSystemStorage):
-		pass
\ No newline at end of file
+		pass
+
+
+	class TileCacheStorage(FileSystemStorage):
+		"""Base map tile cache, overwrites in place like `file_overwrite = True`"""
+
+		def __init__(self, **kwargs):
+			kwargs.setdefault('location', settings.TILE_CACHE_ROOT)
+			super().__init__(**kwargs)
+
+		def get_available_name(self, name, max_length=None):
+			if self.exists(name):
+				self.delete(name)
+			return name